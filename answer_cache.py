@@ -0,0 +1,94 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# AIチャットの回答を質問の埋め込みとともに保存し、ほぼ同じ質問には保存済みの回答を返すキャッシュ
+# インデックスの版（Drive上のZIPのmd5）が変わると、古い版の回答はすべて無効になる
+ANSWER_CACHE_FILE = "answer_cache.db"
+# この類似度（コサイン）以上の質問を同じ質問とみなす
+ANSWER_SIMILARITY_THRESHOLD = 0.95
+# 1つのインデックスの版・検索方式あたりに保持する最大件数（古いものから削除）
+MAX_ENTRIES = 1000
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class AnswerCache:
+    def __init__(self, path=ANSWER_CACHE_FILE, threshold=ANSWER_SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, index_version TEXT NOT NULL, mode TEXT NOT NULL,"
+            " question TEXT NOT NULL, embedding BLOB NOT NULL, answer TEXT, sources TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_version ON answers (index_version, mode)")
+        self._conn.commit()
+
+    # 最も類似した質問の回答を返す（閾値未満、または回答が必要なのに未生成の場合はNone）
+    def lookup(self, index_version, mode, embedding, require_answer=False):
+        query = "SELECT question, embedding, answer, sources FROM answers WHERE index_version = ? AND mode = ?"
+        if require_answer:
+            query += " AND answer IS NOT NULL"
+        with self._lock:
+            rows = self._conn.execute(query, (index_version, mode)).fetchall()
+        if not rows:
+            return None
+
+        matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        similarities = matrix @ normalize(embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        question, _, answer, sources = rows[best]
+        return {
+            "question": question,
+            "answer": answer,
+            "sources": json.loads(sources),
+            "similarity": float(similarities[best]),
+        }
+
+    # 回答を保存し、他の版のエントリと上限を超えた古いエントリを削除
+    def store(self, index_version, mode, question, embedding, answer, sources):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers WHERE index_version != ?", (index_version,))
+            self._conn.execute(
+                "INSERT INTO answers (index_version, mode, question, embedding, answer, sources, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (index_version, mode, question, normalize(embedding).tobytes(), answer,
+                 json.dumps(sources, ensure_ascii=False, default=str), time.time()),
+            )
+            self._conn.execute(
+                "DELETE FROM answers WHERE index_version = ? AND mode = ? AND id NOT IN ("
+                " SELECT id FROM answers WHERE index_version = ? AND mode = ? ORDER BY id DESC LIMIT ?)",
+                (index_version, mode, index_version, mode, MAX_ENTRIES),
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# 保存先ディレクトリを作成してキャッシュを開く
+def open_answer_cache(path=ANSWER_CACHE_FILE):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return AnswerCache(path)
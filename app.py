@@ -1,11 +1,9 @@
 import streamlit as st
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
-import sqlite3
-import os
 import tempfile
-import shutil
 import base64
+import math
 
 from streamlit_pdf_viewer import pdf_viewer
 import pandas as pd
@@ -15,10 +13,9 @@ import time
 import requests
 from langdetect import detect
 from bs4 import BeautifulSoup
-from sqlalchemy import Column, Integer, String, Boolean, create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
 
-from database import get_session, Metadata
+from database import get_session, Metadata, apply_row_changes, init_db, load_metadata_df, query_metadata_page, load_records, get_db_version, load_facets
+from db_sync import get_db_sync
 
 from openai import OpenAI
 from llama_index.core import download_loader, VectorStoreIndex, Settings, SimpleDirectoryReader
@@ -28,7 +25,7 @@ import urllib.parse
 import pytesseract
 from pdf2image import convert_from_path
 # 関数読込
-from function import download_file,upload_db_to_google_drive
+from function import download_file,upload_db_to_google_drive,thread_local_drive
 
 # ページ設定
 st.set_page_config(layout="wide")
@@ -36,6 +33,8 @@ st.set_page_config(layout="wide")
 # ファイル名設定
 # データベースファイル
 DB_FILE = "literature_database.db"
+# 文献リストの1ページあたりの表示件数の選択肢
+PAGE_SIZES = [50, 100, 200, 500]
 # キーワード，カテゴリ格納ファイル
 keywords_categories_file= 'keywords_categories.csv'
 
@@ -64,24 +63,18 @@ def initialize_app():
             st.stop()
 
             
-    # データベース確認と読み込み
-    if not os.path.exists(DB_FILE):
-        db_temp_path = download_db_from_drive(st.session_state["drive"], DB_FILE)
-        if db_temp_path:
-            shutil.copy(db_temp_path, DB_FILE)  # ダウンロードしたファイルをアプリケーションの作業ディレクトリにコピー
-        else:
-            st.warning(f"{DB_FILE} がGoogle Driveに見つかりません。新しいデータベースを作成します。")
-            initialize_db()
-
+    # データベース確認と読み込み（Google Driveのスナップショットを取得し、他の環境での変更のジャーナルを反映）
     try:
-        conn = sqlite3.connect(DB_FILE)
-        df = pd.read_sql("SELECT * FROM metadata", conn)
-    except sqlite3.OperationalError:
-        st.warning("データベースが空です。新しいデータベースを作成します。")
-        initialize_db()
-        df = pd.DataFrame()
+        pulled = get_db_sync(DB_FILE, st.session_state["drive"], thread_local_drive).pull()
+    except Exception as e:
+        st.error(f"Google Driveからデータベースを取得中にエラーが発生しました: {e}")
+        pulled = {}
+    if pulled is None:
+        st.warning(f"{DB_FILE} がGoogle Driveに見つかりません。新しいデータベースを作成します。")
 
-    st.session_state["df"] = df
+    # テーブルが無ければ作成し、既存データベースのスキーマを最新化（インデックス・著者とキーワードの対応表を含む）
+    initialize_db()
+    # 全文献のデータフレームは、必要なページで初めて読み込む（get_metadata_df）
 
 
     # Google Driveからキーワードとカテゴリを読み込み
@@ -105,57 +98,23 @@ def initialize_app():
 
 # SQLiteデータベースを初期化
 def initialize_db():
-    Base = declarative_base()
-    class Metadata(Base):
-        __tablename__ = 'metadata'
-        id = Column(Integer, primary_key=True, autoincrement=True)
-        タイトル = Column(String)
-        著者 = Column(String)
-        ジャーナル = Column(String)
-        巻 = Column(String)
-        号 = Column(String)
-        開始ページ = Column(String)
-        終了ページ = Column(String)
-        年 = Column(Integer)
-        要約 = Column(String)
-        キーワード = Column(String)
-        カテゴリ = Column(String)
-        doi = Column(String, nullable=False)
-        doi_url = Column(String)
-        ファイルリンク = Column(String)
-        メモ = Column(String)
-        Read = Column(Boolean, default=False)
-
-    DATABASE_URL=f"sqlite:///{DB_FILE}"
-    engine=create_engine(DATABASE_URL)
-    Base.metadata.create_all(engine)
-    SessionLocal=sessionmaker(bind=engine)
-
-def download_db_from_drive(drive, db_file_name):
-    exists, file_id = file_exists_in_drive(drive, db_file_name)
-    if not exists:
-        st.error(f"{db_file_name} がGoogle Driveに見つかりません。")
-        return None
+    init_db(DB_FILE)
 
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".db") as temp_file:
-            file = drive.CreateFile({'id': file_id})
-            file.GetContentFile(temp_file.name)
-            return temp_file.name  # ダウンロードしたファイルのパスを返す
-    except Exception as e:
-        st.error(f"Google Driveからデータベースをダウンロード中にエラーが発生しました: {e}")
-        return None
+# 絞り込み項目の値と件数を読み込む（データベースの版をキーにキャッシュする）
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_cached_facets(db_file, db_version):
+    return load_facets(db_file)
+
+# 件数の多い順に「値 (件数)」で選択肢を表示するセレクトボックス（未選択はNone）
+def facet_selectbox(label, values):
+    counts = dict(values)
+    return st.selectbox(label, options=[None] + list(counts), format_func=lambda x: "すべて" if x is None else f"{x} ({counts[x]})")
 
 # SQLiteデータベースを読み込む
 def read_db():
-    conn = sqlite3.connect(DB_FILE)
-    DATABASE_URL=f"sqlite:///{DB_FILE}"
-    engine=create_engine(DATABASE_URL)
-    SessionLocal=sessionmaker(bind=engine)
     if 'df' not in st.session_state:
         try:
-            df = pd.read_sql("SELECT * FROM metadata", conn)
-            st.session_state["df"] = df
+            st.session_state["df"] = load_metadata_df(DB_FILE)
         except Exception as e:
             st.error(f"データの読み込み中にエラーが発生しました：{e}")
 
@@ -253,63 +212,60 @@ def main():
     # 初期化
     initialize_app()
 
-    # メインコンテンツを表示
-    if 'refresh_data' in st.session_state and st.session_state['refresh_data']:
-        # データベースの再読み込み処理
-        conn = sqlite3.connect(DB_FILE)
-        df = pd.read_sql("SELECT * FROM metadata", conn)
-        st.session_state["df"] = df
-
-        # フラグをリセット
-        st.session_state['refresh_data'] = False
-
     # タブ別表示
     items=["データベース表示","文献追加","ナレッジ検索","設定"]
     tabs=st.tabs(items)
     with tabs[0]:
 
-        # カテゴリカラムのユニークな値を抽出
-        unique_category = st.session_state["df"]["カテゴリ"].unique()
-        # journalカラムのユニークな値を抽出
-        unique_journals = st.session_state["df"]["ジャーナル"].unique()
-        # authorsカラムのユニークな名前を抽出（カンマ区切りで抽出）
-        authors = st.session_state["df"]["著者"].str.split(',').explode().str.strip().unique()
-        # keywordsカラムのユニークなキーワードを抽出（カンマ区切りで抽出）
-        keywords = st.session_state["df"]["キーワード"].str.split(',').explode().str.strip().unique()
+        # カテゴリ・ジャーナル・著者・キーワードの選択肢と件数（件数の多い順。データベースの版が変わったときだけ読み直す）
+        facets = load_cached_facets(DB_FILE, get_db_version(DB_FILE))
 
         st.markdown('#### :mag:フィルタリング項目')
         col1, col2, col3, col4, col5, col6 = st.columns(6)
         with col1:
             selected_status = st.selectbox("既読・未読", options=[None, True, False], format_func=lambda x: "すべて" if x is None else ("既読" if x else "未読"))
         with col2:
-            selected_category = st.selectbox("カテゴリ", options=[None] + list(unique_category), format_func=lambda x: "すべて" if x is None else x)
+            selected_category = facet_selectbox("カテゴリ", facets["カテゴリ"])
         with col3:
-            selected_keyword = st.selectbox("キーワード", options=[None] + list(keywords), format_func=lambda x: "すべて" if x is None else x)
+            selected_keyword = facet_selectbox("キーワード", facets["キーワード"])
         with col4:
-            selected_journal = st.selectbox("ジャーナル", options=[None] + list(unique_journals), format_func=lambda x: "すべて" if x is None else x)
+            selected_journal = facet_selectbox("ジャーナル", facets["ジャーナル"])
         with col5:
-            selected_author = st.selectbox("著者", options=[None] + list(authors), format_func=lambda x: "すべて" if x is None else x)
+            selected_author = facet_selectbox("著者", facets["著者"])
         with col6:
             text_for_filter = st.text_input("検索語句")
 
-        # フィルタリング条件に基づいてデータをフィルタリング
-        filtered_df = st.session_state["df"].copy()
-
-        if selected_status is not None:
-            filtered_df = filtered_df[filtered_df["Read"] == selected_status]
-        if selected_category is not None:
-            filtered_df = filtered_df[filtered_df["カテゴリ"]  == selected_category]
-        if selected_journal is not None:
-            filtered_df = filtered_df[filtered_df["ジャーナル"] == selected_journal]
-        if selected_author is not None:
-            filtered_df = filtered_df[filtered_df["著者"].str.contains(selected_author)]
-        if selected_keyword is not None:
-            filtered_df = filtered_df[filtered_df["キーワード"].str.contains(selected_keyword)]
-        if text_for_filter:
-            filtered_df = filtered_df[filtered_df.apply(lambda row: row.astype(str).str.contains(text_for_filter, case=False).any(), axis=1)]
+        # 絞り込み条件と検索語句はSQLに変換し、表示するページの分だけをデータベースから取得する
+        # （既読・カテゴリ・ジャーナルはインデックス、著者・キーワードは対応表、検索語句は全文検索の索引を使う）
+        filters = {
+            "read": selected_status,
+            "category": selected_category,
+            "journal": selected_journal,
+            "author": selected_author,
+            "keyword": selected_keyword,
+        }
+        # 条件を変えたら1ページ目に戻す
+        filter_key = (tuple(filters.values()), text_for_filter)
+        if st.session_state.get("list_filter_key") != filter_key:
+            st.session_state["list_filter_key"] = filter_key
+            st.session_state["list_page"] = 1
 
         # DataFrameを表示
         st.markdown('#### :open_book:文献リスト表示')
+        col1, col2, col3 = st.columns([1, 1, 4])
+        with col1:
+            page_size = st.selectbox("表示件数", PAGE_SIZES, key="list_page_size")
+        with col2:
+            page_number = st.number_input("ページ", min_value=1, step=1, key="list_page")
+        page_df, total = query_metadata_page(DB_FILE, text=text_for_filter, limit=page_size, offset=(page_number - 1) * page_size, **filters)
+        page_count = max(math.ceil(total / page_size), 1)
+        if page_number > page_count:
+            page_number = page_count
+            page_df, total = query_metadata_page(DB_FILE, text=text_for_filter, limit=page_size, offset=(page_number - 1) * page_size, **filters)
+        with col3:
+            first = (page_number - 1) * page_size + 1 if total else 0
+            st.caption(f"全{total}件中 {first}〜{first + len(page_df) - 1 if total else 0}件を表示（{page_number}/{page_count}ページ）")
+
         # 表示画面用のcolumn_config設定
         column_config={'doi_url': st.column_config.LinkColumn('Web', display_text='URL'),
         'Read': st.column_config.CheckboxColumn('Read'),
@@ -318,8 +274,8 @@ def main():
             help="キーワード",
             width="medium",
         )}
-        #特定カラムを表示上除外して，データを表示
-        st.dataframe(filtered_df.drop(columns=['開始ページ', '終了ページ','ファイルリンク']), column_config=column_config, hide_index=True, use_container_width=True)
+        # 一覧用のカラム（要約・メモは先頭のみ）だけを表示
+        st.dataframe(page_df, column_config=column_config, hide_index=True, use_container_width=True)
 
         st.markdown('#### :pencil:データ編集')
         # データ編集のチェックボックス
@@ -335,34 +291,23 @@ def main():
                 options=st.session_state["categories_all"],
                 required=True,
             )}
-            # ユーザーが行を追加・削除できるようにする
-            edited_df = st.data_editor(filtered_df, num_rows="dynamic", column_config=column_config_edit)
+            # 表示中のページの文献をすべてのカラムで取得し、ユーザーが行を追加・削除できるようにする
+            edit_df = load_records(DB_FILE, page_df["id"])
+            st.data_editor(edit_df, num_rows="dynamic", column_config=column_config_edit, key="metadata_editor")
 
-            # 変更を保存
+            # 変更を保存（編集・追加・削除された行だけを反映）
             if st.button("変更を保存"):
-                conn = sqlite3.connect(DB_FILE)
-                # 一時的なテーブルを作成（'id'列を除く）
-                edited_df.to_sql("temp_metadata", conn, if_exists="replace", index=False)
-                # 元データベースから削除されるべき行を特定する
-                existing_ids = pd.read_sql("SELECT id FROM metadata", conn)['id']
-                new_ids = edited_df['id']
-                ids_to_delete = existing_ids[~existing_ids.isin(new_ids)]
-                # 元のテーブルに全カラムを挿入
-                with conn:
-                    # 対応するidを持つ行を削除
-                    if not ids_to_delete.empty:
-                        conn.execute(f"DELETE FROM metadata WHERE id IN ({','.join(map(str, ids_to_delete))})")
-                    # 編集したデータフレームの内容を元のデータフレームに追加
-                    conn.execute("DELETE FROM metadata WHERE id IN (SELECT id FROM temp_metadata)")
-                    conn.execute("""
-                        INSERT INTO metadata (タイトル, 著者,ジャーナル,巻,号,開始ページ,終了ページ,年,要約,キーワード,カテゴリ,doi,doi_url,ファイルリンク,メモ,Read)
-                        SELECT タイトル, 著者,ジャーナル,巻,号,開始ページ,終了ページ,年,要約,キーワード,カテゴリ,doi,doi_url,ファイルリンク,メモ,Read FROM temp_metadata
-                    """)
-                    conn.execute("DROP TABLE temp_metadata")
-
-                # データを再読み込みし、セッション状態を更新
-                df = pd.read_sql("SELECT * FROM metadata", conn)
-                st.session_state["df"] = df
+                changes = st.session_state["metadata_editor"]
+                # 編集内容の行番号は表示中のデータフレーム内の位置なので、idに変換する
+                row_ids = edit_df["id"].tolist()
+                updated = {row_ids[int(position)]: values for position, values in changes["edited_rows"].items()}
+                deleted = [row_ids[int(position)] for position in changes["deleted_rows"]]
+                try:
+                    apply_row_changes(DB_FILE, updated=updated, added=changes["added_rows"], deleted=deleted)
+                except Exception as e:
+                    st.error(f"変更の保存中にエラーが発生しました: {e}")
+                    st.stop()
+
                 st.success("変更が保存されました．間もなくリロードします．")
                 # Google Driveにデータベースをアップロード
                 upload_db_to_google_drive(DB_FILE, st.session_state['drive'])
@@ -376,7 +321,7 @@ def main():
 
         if file_view:
             # id-タイトルの形式で選択肢を作成
-            options = filtered_df.apply(lambda row: f"{row['id']}-{row['タイトル']}", axis=1)
+            options = page_df.apply(lambda row: f"{row['id']}-{row['タイトル']}", axis=1)
 
             # レコード選択のためのセレクトボックス（初期選択なし）
             selected_option = st.selectbox("PDFファイル選択", options, index=None)  # 初期選択なし
@@ -384,7 +329,8 @@ def main():
             # 選択されたレコードのファイルリンクを取得
             if selected_option:
                 selected_index = options[options == selected_option].index[0]
-                selected_file_path = filtered_df.loc[selected_index, 'ファイルリンク']
+                record = load_records(DB_FILE, [page_df.loc[selected_index, 'id']]).iloc[0]
+                selected_file_path = record['ファイルリンク']
 
                 # Google DriveからファイルIDを抽出
                 if selected_file_path:
@@ -398,14 +344,14 @@ def main():
 
                     # 論文情報の表示をサイドバーに追加
                     st.sidebar.markdown("### 論文情報")
-                    title = filtered_df.loc[selected_index, 'タイトル']
-                    authors = filtered_df.loc[selected_index, '著者']
-                    journal = filtered_df.loc[selected_index, 'ジャーナル']
-                    year = filtered_df.loc[selected_index, '年']
-                    category = filtered_df.loc[selected_index, 'カテゴリ']
-                    keywords = filtered_df.loc[selected_index, 'キーワード']
-                    abstract = filtered_df.loc[selected_index, '要約']
-                    notes = filtered_df.loc[selected_index, 'メモ']
+                    title = record['タイトル']
+                    authors = record['著者']
+                    journal = record['ジャーナル']
+                    year = record['年']
+                    category = record['カテゴリ']
+                    keywords = record['キーワード']
+                    abstract = record['要約']
+                    notes = record['メモ']
 
                     st.sidebar.markdown(f"**タイトル**: {title}")
                     st.sidebar.markdown(f"**著者**: {authors}")
@@ -431,6 +377,10 @@ def main():
         if st.button("AI Summary"):
             st.switch_page("pages/AI_summary.py")
 
+        st.markdown("### 文献リストの一括取り込み（BibTeX・RIS・CSL-JSON）")
+        if st.button("Bulk Import"):
+            st.switch_page("pages/Bulk_import.py")
+
 
     with tabs[2]:
         st.markdown("### AIチャットボット")
@@ -484,6 +434,19 @@ def main():
             for keyword in st.session_state["keywords_all"]  + new_keywords:
                 st.write(keyword)
 
+        st.markdown("### Google Driveとの同期")
+        db_sync = get_db_sync(DB_FILE, st.session_state['drive'], thread_local_drive)
+        if db_sync.last_error is not None:
+            st.error(f"前回の同期に失敗しました（自動で再試行します）: {db_sync.last_error}")
+        if db_sync.last_synced is not None:
+            st.caption(f"最終同期: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(db_sync.last_synced))}")
+        if st.button("今すぐ同期", disabled=not db_sync.pending()):
+            try:
+                db_sync.flush()
+                st.success("Google Driveと同期しました。")
+            except Exception as e:
+                st.error(f"同期に失敗しました: {e}")
+
 if __name__ == "__main__":
     # アプリケーションを実行
     main()
@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ivf_index import IVFIndex, exact_top_k, ivf_top_k
+
+# 近似最近傍インデックス（IVF）と厳密検索の再現率・レイテンシを比較するベンチマーク
+# 実行例: python benchmarks/ann_benchmark.py --rows 200000 --dim 256
+
+
+# 文献チャンクの埋め込みを模した、トピックごとに偏りのある正規化済みベクトルを生成
+def synthetic_vectors(rows, dim, topics, rng, dtype):
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    labels = rng.integers(0, topics, rows)
+    vectors = centers[labels] + 0.8 * rng.standard_normal((rows, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(dtype), centers
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--topics", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dtype", default="float16")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrix, centers = synthetic_vectors(args.rows, args.dim, args.topics, rng, args.dtype)
+    queries = centers[rng.integers(0, args.topics, args.queries)] + 0.8 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    # インデックスの学習（前半で学習し、後半は追加として割り当て）
+    start = time.perf_counter()
+    index = IVFIndex.train(matrix, np.arange(args.rows // 2))
+    train_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index.add(matrix, np.arange(args.rows // 2, args.rows))
+    add_seconds = time.perf_counter() - start
+    print(f"rows={args.rows} dim={args.dim} dtype={args.dtype} lists={len(index.centroids)}")
+    print(f"train: {train_seconds:.2f}s  incremental add ({args.rows - args.rows // 2} rows): {add_seconds:.2f}s")
+
+    # 厳密検索の結果を正解とする
+    truth = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        truth.append(set(exact_top_k(matrix, query, args.top_k).tolist()))
+        latencies.append(time.perf_counter() - start)
+    print(f"{'method':>12} {'recall@' + str(args.top_k):>10} {'p50 ms':>8} {'p95 ms':>8}")
+    print(f"{'exact':>12} {1.0:>10.3f} {np.percentile(latencies, 50) * 1000:>8.2f} {np.percentile(latencies, 95) * 1000:>8.2f}")
+
+    for nprobe in args.nprobe:
+        hits = 0
+        latencies = []
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            found = ivf_top_k(index, matrix, query, args.top_k, nprobe)
+            latencies.append(time.perf_counter() - start)
+            hits += len(expected & set(found.tolist()))
+        recall = hits / (len(queries) * args.top_k)
+        print(f"{'nprobe=' + str(nprobe):>12} {recall:>10.3f} {np.percentile(latencies, 50) * 1000:>8.2f} {np.percentile(latencies, 95) * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
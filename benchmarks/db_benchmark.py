@@ -0,0 +1,122 @@
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+from database import Metadata
+
+# 文献の追加（1件ずつ）と要約の書き込み（1行ずつ）のスループットを、
+# 以前の方式（呼び出しごとのエンジン作成・既定のジャーナル設定）と共通のデータアクセス層で比較する
+# 実行例: python benchmarks/db_benchmark.py --records 500 --dir .
+
+
+def record_values(i):
+    return {
+        "doi": f"10.1000/bench.{i:06d}",
+        "タイトル": f"Benchmark paper {i}",
+        "著者": f"Author {i}",
+        "ジャーナル": "J. Bench.",
+        "年": 2000 + i % 25,
+        "カテゴリ": "benchmark",
+        "Read": False,
+    }
+
+
+def summary_values(i):
+    return {"要約": "要約" * 200, "キーワード": "a,b,c", "カテゴリ": "benchmark", "text_hash": f"{i:064d}"}
+
+
+# 以前の store_metadata_in_db と同じく、呼び出しごとにエンジンとセッションを作成して追加する
+def legacy_insert(db_file, values):
+    engine = create_engine(f"sqlite:///{db_file}")
+    session = sessionmaker(bind=engine)()
+    try:
+        if session.query(Metadata).filter_by(doi=values["doi"]).first() is None:
+            session.add(Metadata(**values))
+            session.commit()
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def shared_insert(db_file, values):
+    session = database.get_session(db_file)
+    try:
+        if session.query(Metadata).filter(func.lower(Metadata.doi) == values["doi"].lower()).first() is None:
+            session.add(Metadata(**values))
+            session.commit()
+    finally:
+        session.close()
+
+
+# 以前の AI_summary と同じく、sqlite3の接続で1行ずつ更新してコミットする
+def legacy_updates(db_file, row_ids):
+    conn = sqlite3.connect(db_file)
+    try:
+        for row_id in row_ids:
+            values = summary_values(row_id)
+            with conn:
+                conn.execute(
+                    f"UPDATE metadata SET {', '.join(f'{c} = ?' for c in values)} WHERE id = ?",
+                    tuple(values.values()) + (row_id,),
+                )
+    finally:
+        conn.close()
+
+
+def shared_updates(db_file, row_ids):
+    for row_id in row_ids:
+        database.update_record(db_file, row_id, summary_values(row_id))
+
+
+def run(db_file, records, insert, update):
+    start = time.perf_counter()
+    for i in range(records):
+        insert(db_file, record_values(i))
+    insert_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    update(db_file, list(range(1, records + 1)))
+    update_seconds = time.perf_counter() - start
+    return records / insert_seconds, records / update_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=300)
+    parser.add_argument("--dir", default=None, help="データベースを作成するディレクトリ（fsyncの影響を見るため実際のディスクを指定する）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        # 以前の方式は同じスキーマで、既定のジャーナル（DELETE）に戻したファイルで計測する
+        legacy_file = os.path.join(work_dir, "legacy.db")
+        database.init_db(legacy_file)
+        database.dispose_engine(legacy_file)
+        conn = sqlite3.connect(legacy_file)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+
+        shared_file = os.path.join(work_dir, "shared.db")
+        database.init_db(shared_file)
+
+        results = {
+            "legacy": run(legacy_file, args.records, legacy_insert, legacy_updates),
+            "shared": run(shared_file, args.records, shared_insert, shared_updates),
+        }
+        database.dispose_engine(shared_file)
+
+    print(f"records={args.records}")
+    print(f"{'':>8} {'insert/s':>10} {'update/s':>10}")
+    for label, (inserts, updates) in results.items():
+        print(f"{label:>8} {inserts:>10.1f} {updates:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
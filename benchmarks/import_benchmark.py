@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import func
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+from bibliography import parse_bibliography
+from database import Metadata
+
+# 文献リストの一括取り込み（BibTeXの読み込み・登録済みDOIの除外・executemanyによる追加）の処理時間を、
+# 1件ずつORMで重複を確認して追加する方式（PDFアップロードと同じ）と比較する
+# 実行例: python benchmarks/import_benchmark.py --entries 5000 --existing 1000 --dir .
+
+
+def synthetic_bibtex(entries):
+    return "\n".join(
+        f"@article{{key{i},\n"
+        f"  title = {{Imported paper {i} on M{{\\\"o}}ssbauer spectroscopy}},\n"
+        f"  author = {{Author{i % 300}, Taro and Coauthor{i % 50}, Hanako}},\n"
+        f"  journal = {{J. Import. {i % 40}}},\n"
+        f"  volume = {{{i % 60}}}, number = {{{i % 12}}}, pages = {{{i}--{i + 9}}},\n"
+        f"  year = {{{1990 + i % 35}}},\n"
+        f"  doi = {{10.1000/import.{i:06d}}},\n"
+        f"  keywords = {{keyword{i % 80}, keyword{i % 17}}}\n"
+        f"}}"
+        for i in range(entries)
+    )
+
+
+def per_record_import(db_file, records):
+    session = database.get_session(db_file)
+    try:
+        for record in records:
+            if session.query(Metadata).filter(func.lower(Metadata.doi) == record["doi"].lower()).first() is None:
+                session.add(Metadata(**record))
+                session.commit()
+    finally:
+        session.close()
+
+
+def bulk_import(db_file, records):
+    existing = database.find_existing_dois(db_file, [record["doi"] for record in records])
+    return database.insert_records(db_file, [record for record in records if record["doi"].lower() not in existing])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--existing", type=int, default=1000, help="事前に登録しておく文献数（取り込み対象と同じDOI）")
+    parser.add_argument("--dir", default=None, help="データベースを作成するディレクトリ（fsyncの影響を見るため実際のディスクを指定する）")
+    args = parser.parse_args()
+
+    text = synthetic_bibtex(args.entries)
+    start = time.perf_counter()
+    records = parse_bibliography(text, "library.bib")
+    parse_seconds = time.perf_counter() - start
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        for label, run in (("per-record", per_record_import), ("bulk", bulk_import)):
+            db_file = os.path.join(work_dir, f"{label}.db")
+            database.init_db(db_file)
+            database.insert_records(db_file, [dict(record) for record in records[:args.existing]])
+            start = time.perf_counter()
+            run(db_file, [dict(record) for record in records])
+            results[label] = time.perf_counter() - start
+            with database.get_engine(db_file).connect() as conn:
+                count = conn.exec_driver_sql("SELECT COUNT(*) FROM metadata").scalar()
+            database.dispose_engine(db_file)
+            assert count == args.entries, count
+
+    print(f"entries={args.entries} existing={args.existing} parse: {parse_seconds:.2f}s")
+    for label, seconds in results.items():
+        print(f"{label:>10} {seconds:>8.2f}s {(args.entries - args.existing) / seconds:>10.1f} records/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from functools import lru_cache
+
+import numpy as np
+from llama_index.core import Settings, StorageContext, VectorStoreIndex
+from llama_index.core.llms import MockLLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rag
+from rag_benchmark import HashingEmbedding, synthetic_corpus
+
+# インデックスのZIPを旧形式（LlamaIndex標準のJSON）と現在の形式で比較し、サイズと読み込み時間を計測する
+# --zip を指定すると既存のZIP（全体インデックス・PDFごとのインデックス）を変換して計測する
+# 実行例: python benchmarks/index_format_benchmark.py --papers 300
+#         python benchmarks/index_format_benchmark.py --zip library_index.zip --output library_index_v1.zip
+
+
+@lru_cache(maxsize=None)
+def projection_matrix(dim):
+    return np.random.default_rng(dim).standard_normal((dim, dim)).astype(np.float32)
+
+
+# 実際の埋め込みと同様に、すべての成分が非零の密なベクトルを返す疑似埋め込みモデル
+# （疎なベクトルはJSONのZIPで極端に圧縮され、旧形式のサイズを過小評価するため）
+class DenseHashingEmbedding(HashingEmbedding):
+    @classmethod
+    def class_name(cls):
+        return "DenseHashingEmbedding"
+
+    def _vector(self, text):
+        sparse = np.asarray(super()._vector(text), dtype=np.float32)
+        dense = projection_matrix(self.dim) @ sparse
+        norm = np.linalg.norm(dense)
+        return (dense / norm if norm else dense).tolist()
+
+
+# 合成文献から旧形式（SimpleVectorStore・SimpleDocumentStoreのJSON）のインデックスのZIPを作成
+def build_legacy_zip(papers, zip_path):
+    corpus, _ = synthetic_corpus(papers, 6, 30, 0.2, np.random.default_rng(0))
+    index = VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults())
+    for file_id, record, documents in corpus:
+        index.insert_nodes(rag.documents_to_nodes(documents, rag.record_metadata(file_id, record, content_hash=file_id)))
+    persist_dir = tempfile.mkdtemp()
+    try:
+        index.storage_context.persist(persist_dir=persist_dir)
+        shutil.make_archive(zip_path[:-len(".zip")], "zip", persist_dir)
+    finally:
+        shutil.rmtree(persist_dir, ignore_errors=True)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+# ZIPの展開・インデックスの読み込み・最初の検索の時間と、展開後のサイズを計測
+def measure(zip_path, queries):
+    extract_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        shutil.unpack_archive(zip_path, extract_dir, "zip")
+        unzip_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = rag.load_index_dir(extract_dir)
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for query in queries:
+            rag.retrieve_library(index, query)
+        query_seconds = (time.perf_counter() - start) / max(len(queries), 1)
+        return {
+            "zip": os.path.getsize(zip_path),
+            "extracted": directory_size(extract_dir),
+            "unzip": unzip_seconds,
+            "load": load_seconds,
+            "query": query_seconds,
+            "nodes": index.vector_store.count(),
+        }
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zip", help="計測する既存のインデックスのZIP（省略時は合成文献から作成）")
+    parser.add_argument("--output", help="変換後のZIPの保存先（省略時は一時ファイル）")
+    parser.add_argument("--papers", type=int, default=300)
+    parser.add_argument("--embed-dim", type=int, default=1536)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        if args.zip:
+            # 既存のZIPは実際の埋め込みモデルの設定で読み込む（検索時のみ埋め込みAPIを呼び出す）
+            source_zip = args.zip
+            queries = []
+        else:
+            rag._settings_configured = True
+            Settings.embed_model = DenseHashingEmbedding(dim=args.embed_dim)
+            Settings.llm = MockLLM(max_tokens=64)
+            source_zip = os.path.join(work_dir, "legacy_index.zip")
+            build_legacy_zip(args.papers, source_zip)
+            queries = ["ペロブスカイトの転移温度", "transition temperature of compound"] * 5
+
+        target_zip = args.output or os.path.join(work_dir, rag.LIBRARY_INDEX_FILE)
+        start = time.perf_counter()
+        manifest = rag.convert_index_zip(source_zip, target_zip)
+        convert_seconds = time.perf_counter() - start
+
+        before = measure(source_zip, queries)
+        after = measure(target_zip, queries)
+        print(f"nodes={after['nodes']} format={manifest['format']} convert: {convert_seconds:.2f}s")
+        print(f"{'':>8} {'zip MB':>8} {'files MB':>9} {'unzip s':>8} {'load s':>7} {'query ms':>9}")
+        for label, result in (("before", before), ("after", after)):
+            print(f"{label:>8} {result['zip'] / 1024 / 1024:>8.2f} {result['extracted'] / 1024 / 1024:>9.2f} "
+                  f"{result['unzip']:>8.2f} {result['load']:>7.2f} {result['query'] * 1000:>9.2f}")
+        for name, size in manifest["files"].items():
+            print(f"  {name}: {size / 1024:.1f} KB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+from llama_index.core import Document, Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.node_parser import SentenceSplitter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rag
+from extractive import tokenize_sentence
+
+# RAG（インデックス生成・検索・回答生成）の品質とレイテンシを計測するオフラインのベンチマーク
+# 日英の合成文献と正解付きの質問を、決定的な疑似埋め込みモデルと疑似LLMで評価する（APIは呼び出さない）
+# 実行例: python benchmarks/rag_benchmark.py --papers 200 --chunk-size 512 --min-recall 0.8
+# 小さな合成文献での recall@k と MRR の下限は tests/test_rag_benchmark.py で確認する
+
+# 文献の本文に混ぜる定型文（質問の正解以外の紛らわしい文）
+FILLER_JA = [
+    "本研究では{topic}の特性を系統的に評価した。",
+    "{topic}の合成条件を最適化し、再現性を確認した。",
+    "測定は室温および大気圧下で行った。",
+    "得られた結果は先行研究とおおむね一致している。",
+    "{topic}の構造はX線回折により同定した。",
+    "今後は{topic}の長期安定性について検討する必要がある。",
+]
+FILLER_EN = [
+    "In this study we systematically evaluated the properties of {topic}.",
+    "The synthesis conditions of {topic} were optimized and found to be reproducible.",
+    "All measurements were carried out at room temperature and ambient pressure.",
+    "These results are broadly consistent with previous reports.",
+    "The structure of {topic} was identified by X-ray diffraction.",
+    "Further work is needed on the long-term stability of {topic}.",
+]
+TOPICS_JA = ["ペロブスカイト", "リチウムイオン電池", "金属有機構造体", "有機半導体", "固体電解質", "光触媒"]
+TOPICS_EN = ["perovskite films", "lithium-ion cathodes", "metal-organic frameworks", "organic semiconductors",
+             "solid electrolytes", "photocatalysts"]
+# 正解となる文（化合物名と物性値）と、それを問う質問
+FACT_JA = "化合物{name}の転移温度は{value}Kであった。"
+FACT_EN = "The transition temperature of compound {name} was {value} K."
+QUESTION_JA = "{name}の転移温度は何Kですか？"
+QUESTION_EN = "What is the transition temperature of {name}?"
+
+
+# トークンを特徴ハッシュで固定長ベクトルに写す、決定的な疑似埋め込みモデル（出現回数は対数で抑える）
+class HashingEmbedding(BaseEmbedding):
+    dim: int = 1024
+
+    @classmethod
+    def class_name(cls):
+        return "HashingEmbedding"
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token, count in Counter(tokenize_sentence(text)).items():
+            value = int.from_bytes(hashlib.md5(token.encode("utf-8")).digest()[:4], "little")
+            vector[value % self.dim] += (1.0 + np.log(count)) * (1.0 if value & 0x80000000 else -1.0)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_query_embedding(self, query):
+        return self._vector(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._vector(query)
+
+    def _get_text_embedding(self, text):
+        return self._vector(text)
+
+
+# 合成文献（PDFのページに相当するDocumentのリスト）と、正解の (ファイルID, ページ) 付きの質問を生成
+def synthetic_corpus(papers, pages, sentences_per_page, cross_lingual, rng):
+    corpus = []
+    questions = []
+    for paper in range(papers):
+        japanese = paper % 2 == 0
+        fillers = FILLER_JA if japanese else FILLER_EN
+        topic = (TOPICS_JA if japanese else TOPICS_EN)[paper % len(TOPICS_JA)]
+        file_id = f"file{paper:05d}"
+        name = f"{''.join(rng.choice(list('ABCDEFGHKLMNPRSTXZ'), 2))}-{paper:04d}"
+        fact_page = int(rng.integers(1, pages + 1))
+
+        documents = []
+        for page in range(1, pages + 1):
+            sentences = [fillers[i].format(topic=topic) for i in rng.integers(0, len(fillers), sentences_per_page)]
+            if page == fact_page:
+                fact = FACT_JA if japanese else FACT_EN
+                sentences.insert(int(rng.integers(0, len(sentences) + 1)), fact.format(name=name, value=int(rng.integers(100, 900))))
+            documents.append(Document(text=(" " if not japanese else "").join(sentences), metadata={"page_label": str(page)}))
+        record = {"id": paper + 1, "タイトル": f"{topic} study {paper}", "著者": f"Author {paper}", "年": 2000 + paper % 25, "ジャーナル": "J. Synth."}
+        corpus.append((file_id, record, documents))
+
+        # 一部の質問は本文と異なる言語で問う
+        ask_japanese = japanese != (rng.random() < cross_lingual)
+        question = (QUESTION_JA if ask_japanese else QUESTION_EN).format(name=name)
+        questions.append((question, file_id, str(fact_page)))
+    return corpus, questions
+
+
+# 埋め込みモデルとLLMを疑似モデルに置き換える（configure_settingsによる上書きを防ぐ）
+def use_fake_models(embed_dim=1024, chunk_size=1024, chunk_overlap=200):
+    rag._settings_configured = True
+    Settings.embed_model = HashingEmbedding(dim=embed_dim)
+    Settings.llm = MockLLM(max_tokens=64)
+    Settings.transformations = [SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)]
+
+
+# 合成文献から全体インデックスを生成（チャンク分割・埋め込み・ベクトルストアへの追加）
+def build_index(corpus):
+    index = rag.create_library_index()
+    for file_id, record, documents in corpus:
+        rag.add_documents(index, documents, rag.record_metadata(file_id, record, content_hash=file_id))
+    return index
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+# 正解のチャンクの順位から recall@k と MRR を計算
+def evaluate(index, lexical, questions, mode, top_k):
+    hits = 0
+    reciprocal_ranks = []
+    latencies = []
+    for question, file_id, page in questions:
+        start = time.perf_counter()
+        results = rag.retrieve_library(index, question, top_k=top_k, mode=mode, lexical=lexical)
+        latencies.append(time.perf_counter() - start)
+        rank = next(
+            (i for i, result in enumerate(results, start=1)
+             if result.node.metadata.get("drive_file_id") == file_id and result.node.metadata.get("page_label") == page),
+            None,
+        )
+        hits += rank is not None
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+    return hits / len(questions), float(np.mean(reciprocal_ranks)), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--papers", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=6)
+    parser.add_argument("--sentences-per-page", type=int, default=30)
+    parser.add_argument("--cross-lingual", type=float, default=0.2, help="本文と異なる言語で問う質問の割合")
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--embed-dim", type=int, default=1024)
+    parser.add_argument("--top-k", type=int, default=rag.SIMILARITY_TOP_K)
+    parser.add_argument("--modes", nargs="+", default=[rag.SEARCH_VECTOR, rag.SEARCH_LEXICAL, rag.SEARCH_HYBRID])
+    parser.add_argument("--min-recall", type=float, default=None, help="いずれかの方式の recall@k がこれを下回ると終了コード1")
+    args = parser.parse_args()
+
+    use_fake_models(args.embed_dim, args.chunk_size, args.chunk_overlap)
+
+    rng = np.random.default_rng(0)
+    corpus, questions = synthetic_corpus(args.papers, args.pages, args.sentences_per_page, args.cross_lingual, rng)
+
+    start = time.perf_counter()
+    index = build_index(corpus)
+    build_seconds = time.perf_counter() - start
+
+    # 保存（キーワード検索用インデックスを含む）と、保存したインデックスの読み込み
+    persist_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        rag.persist_library_index(index, persist_dir)
+        persist_seconds = time.perf_counter() - start
+        size = directory_size(persist_dir)
+
+        start = time.perf_counter()
+        loaded = rag.load_index_dir(persist_dir)
+        lexical = rag.load_lexical_index(persist_dir, loaded)
+        load_seconds = time.perf_counter() - start
+
+        print(f"papers={args.papers} pages={args.pages} chunks={loaded.vector_store.count()} "
+              f"chunk_size={args.chunk_size} overlap={args.chunk_overlap} dim={args.embed_dim}")
+        print(f"build: {build_seconds:.2f}s  persist: {persist_seconds:.2f}s  load: {load_seconds:.2f}s  "
+              f"size: {size / 1024 / 1024:.2f} MB")
+
+        print(f"{'mode':>8} {'recall@' + str(args.top_k):>10} {'MRR':>6} {'p50 ms':>8} {'p95 ms':>8}")
+        failed = False
+        for mode in args.modes:
+            recall, mrr, latencies = evaluate(loaded, lexical, questions, mode, args.top_k)
+            print(f"{mode:>8} {recall:>10.3f} {mrr:>6.3f} {np.percentile(latencies, 50) * 1000:>8.2f} "
+                  f"{np.percentile(latencies, 95) * 1000:>8.2f}")
+            failed |= args.min_recall is not None and recall < args.min_recall
+
+        # 回答生成（疑似LLM）を含む1問あたりの処理時間
+        latencies = []
+        for question, _, _ in questions[:50]:
+            start = time.perf_counter()
+            nodes = rag.retrieve_library(loaded, question, top_k=args.top_k, mode=rag.SEARCH_HYBRID, lexical=lexical)
+            "".join(rag.stream_answer(question, nodes))
+            latencies.append(time.perf_counter() - start)
+        print(f"hybrid + synthesis: p50 {np.percentile(latencies, 50) * 1000:.2f} ms  "
+              f"p95 {np.percentile(latencies, 95) * 1000:.2f} ms")
+    finally:
+        shutil.rmtree(persist_dir, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
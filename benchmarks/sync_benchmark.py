@@ -0,0 +1,168 @@
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import db_sync
+
+# データベースのGoogle Driveとの同期で、1回の編集あたりの転送量と時間を計測する
+# 以前の方式（編集のたびにファイル全体をアップロード）とジャーナルによる差分同期を、メモリ上の疑似Driveで比較し、
+# 別の環境（空のディレクトリ）で取得・反映した結果が元のデータベースと一致することを確認する
+# 実行例: python benchmarks/sync_benchmark.py --records 2000 --edits 50
+
+
+# PyDriveのGoogleDrive・GoogleDriveFileのうち、同期処理で使う操作だけを持つ疑似Drive
+class FakeDrive:
+    def __init__(self):
+        self.files = {}
+        self.uploaded_bytes = 0
+        self.journal_bytes = 0
+        self.downloaded_bytes = 0
+        self.requests = 0
+
+    def CreateFile(self, metadata=None):
+        return FakeFile(self, dict(metadata or {}))
+
+    def ListFile(self, param):
+        self.requests += 1
+        query = param["q"]
+        equals = re.match(r"title='(.*)' and trashed=false", query)
+        contains = re.match(r"title contains '(.*)' and trashed=false", query)
+        matched = [
+            entry for entry in self.files.values()
+            if (equals and entry["title"] == equals.group(1)) or (contains and contains.group(1) in entry["title"])
+        ]
+        return FakeList([FakeFile(self, dict(entry, content=None)) for entry in matched])
+
+
+class FakeList:
+    def __init__(self, files):
+        self.files = files
+
+    def GetList(self):
+        return self.files
+
+
+class FakeFile(dict):
+    def __init__(self, drive, metadata):
+        super().__init__({k: v for k, v in metadata.items() if k != "content"})
+        self.drive = drive
+        self.content = None
+
+    def FetchMetadata(self, fields=None):
+        self.drive.requests += 1
+        entry = self.drive.files[self["id"]]
+        self.update({k: v for k, v in entry.items() if k != "content"})
+
+    def SetContentFile(self, path):
+        with open(path, "rb") as f:
+            self.content = f.read()
+
+    def Upload(self):
+        self.drive.requests += 1
+        self.drive.uploaded_bytes += len(self.content)
+        if self["title"].endswith(db_sync.JOURNAL_SUFFIX):
+            self.drive.journal_bytes += len(self.content)
+        file_id = self.get("id") or f"file{len(self.drive.files) + 1}"
+        entry = self.drive.files.setdefault(file_id, {"id": file_id, "title": self["title"], "labels": {"trashed": False}})
+        entry.update(content=self.content, md5Checksum=hashlib.md5(self.content).hexdigest(), fileSize=str(len(self.content)))
+        self.update({k: v for k, v in entry.items() if k != "content"})
+
+    def GetContentFile(self, path):
+        self.drive.requests += 1
+        content = self.drive.files[self["id"]]["content"]
+        self.drive.downloaded_bytes += len(content)
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def Delete(self):
+        self.drive.requests += 1
+        del self.drive.files[self["id"]]
+
+
+def create_library(db_file, records, pages):
+    database.init_db(db_file)
+    database.insert_records(db_file, [
+        {"doi": f"10.1000/sync.{i:06d}", "タイトル": f"Synced paper {i}", "著者": f"Author {i % 300}, Coauthor {i % 50}",
+         "ジャーナル": f"J. Sync. {i % 40}", "年": 1990 + i % 35, "要約": f"要約 {i} " * 80, "キーワード": f"k{i % 80},k{i % 17}"}
+        for i in range(records)
+    ])
+    for row_id in range(1, records + 1):
+        database.store_fulltext(db_file, row_id, f"{row_id:032x}",
+                                [(str(page), f"Page {page} of paper {row_id}. " * 60) for page in range(1, pages + 1)], False)
+
+
+def snapshot_rows(db_file):
+    with database.get_engine(db_file).connect() as conn:
+        return (
+            conn.exec_driver_sql("SELECT * FROM metadata ORDER BY id").fetchall(),
+            conn.exec_driver_sql("SELECT * FROM fulltext ORDER BY metadata_id").fetchall(),
+            conn.exec_driver_sql("SELECT facet, value, count FROM facets ORDER BY facet, value").fetchall(),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--edits", type=int, default=50)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(work_dir, "device1", "literature_database.db")
+        os.makedirs(os.path.dirname(db_file))
+        create_library(db_file, args.records, args.pages)
+        database.clear_changes(db_file)
+
+        drive = FakeDrive()
+        sync = db_sync.DBSync(db_file, drive)
+        sync.sync()  # 最初のスナップショット
+        database_size = drive.uploaded_bytes
+        drive.uploaded_bytes = 0
+        drive.journal_bytes = 0
+
+        # 1件ずつ要約を更新し、編集ごとに同期する（追加・削除も含める）
+        start = time.perf_counter()
+        for i in range(args.edits):
+            row_id = 1 + (i * 37) % args.records
+            database.update_record(db_file, row_id, {"要約": f"更新した要約 {i}", "Read": True, "カテゴリ": f"c{i % 5}"})
+            if i % 10 == 0:
+                database.insert_records(db_file, [{"doi": f"10.1000/new.{i}", "タイトル": f"New {i}", "著者": "New Author"}])
+            if i % 10 == 5:
+                database.apply_row_changes(db_file, deleted=[args.records - i])
+            sync.flush()
+        sync_seconds = (time.perf_counter() - start) / args.edits
+        uploaded_bytes = drive.uploaded_bytes
+        journal_bytes = drive.journal_bytes
+
+        # 別の環境で取得・反映し、元のデータベースと一致することを確認
+        other_file = os.path.join(work_dir, "device2", "literature_database.db")
+        os.makedirs(os.path.dirname(other_file))
+        other = db_sync.DBSync(other_file, drive)
+        start = time.perf_counter()
+        result = other.pull()
+        pull_seconds = time.perf_counter() - start
+        assert snapshot_rows(other_file) == snapshot_rows(db_file), "同期後のデータベースが一致しません"
+
+        journals = sum(1 for entry in drive.files.values() if entry["title"].endswith(db_sync.JOURNAL_SUFFIX))
+        print(f"records={args.records} edits={args.edits} database={database_size / 1024 / 1024:.2f} MB")
+        print(f"full upload per edit:  {database_size / 1024:>10.1f} KB")
+        print(f"journal sync per edit: {uploaded_bytes / args.edits / 1024:>10.1f} KB  ({sync_seconds * 1000:.1f} ms)  "
+              f"journals only: {journal_bytes / args.edits / 1024:.1f} KB")
+        print(f"pull on a new device: {pull_seconds:.2f}s  downloaded={result['downloaded']} journals applied={result['journals']} "
+              f"(journals on Drive: {journals})")
+        database.dispose_engine(db_file)
+        database.dispose_engine(other_file)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+import json
+import os
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+# 他の文献管理ソフトの書き出し（BibTeX・RIS・CSL-JSON）を、metadataの表のカラムに対応した辞書のリストに変換する
+
+# DOIから文献情報を補完する際の並列数と、進捗を報告する単位
+RESOLVE_WORKERS = 8
+RESOLVE_BATCH = 40
+# 補完の対象とする（空の場合にDOIから取得する）カラム
+RESOLVED_COLUMNS = ["タイトル", "著者", "ジャーナル", "巻", "号", "開始ページ", "終了ページ", "年"]
+# 文献情報が見つからなかったことを表す値（get_metadata_from_doiが返す）
+NOT_FOUND = "Not found"
+
+# DOIの表記ゆれ（URL・"doi:"の接頭辞）をそろえる（大文字小文字はそのまま残し、比較するときに区別しない）
+def normalize_doi(value):
+    if not isinstance(value, str):
+        return None
+    doi = re.sub(r"^(https?://(dx\.)?doi\.org/|doi:\s*)", "", value.strip(), flags=re.IGNORECASE)
+    match = re.search(r"10\.\d{4,9}/\S+", doi)
+    return match.group(0).rstrip(".,;") if match else None
+
+def _year(value):
+    match = re.search(r"\d{4}", str(value or ""))
+    return int(match.group(0)) if match else None
+
+def _pages(value):
+    parts = [part.strip() for part in re.split(r"\s*[-–—]+\s*", str(value or "")) if part.strip()]
+    if not parts:
+        return None, None
+    return parts[0], parts[-1] if len(parts) > 1 else None
+
+# 著者名を「姓 名」の形にそろえる（"姓, 名"・"名 姓"のどちらの表記も受け付ける）
+def _author_name(name):
+    name = " ".join(name.split())
+    if "," in name:
+        parts = [part.strip() for part in name.split(",") if part.strip()]
+        return " ".join([parts[0], parts[-1]]) if len(parts) > 1 else parts[0] if parts else ""
+    words = name.split(" ")
+    return " ".join([words[-1]] + words[:-1]) if len(words) > 1 else name
+
+def _keywords(values):
+    names = [name.strip() for value in values for name in re.split(r"[,;]", value or "") if name.strip()]
+    return ",".join(dict.fromkeys(names)) or None
+
+def _record(title=None, authors=(), journal=None, volume=None, issue=None, pages=None, start_page=None,
+            end_page=None, year=None, doi=None, url=None, keywords=(), abstract=None, note=None):
+    first, last = _pages(pages)
+    doi = normalize_doi(doi) or normalize_doi(url)
+    return {
+        "タイトル": title or None,
+        # 著者のカラムはカンマ区切りのため、名前の中のカンマは除く
+        "著者": ", ".join(" ".join(name.replace(",", " ").split()) for name in authors if name) or None,
+        "ジャーナル": journal or None,
+        "巻": volume or None,
+        "号": issue or None,
+        "開始ページ": start_page or first,
+        "終了ページ": end_page or last,
+        "年": _year(year),
+        "doi": doi,
+        "doi_url": f"https://doi.org/{doi}" if doi else None,
+        "キーワード": _keywords(keywords),
+        "要約": abstract or None,
+        "メモ": note or None,
+        "Read": False,
+    }
+
+# --- BibTeX ---
+
+# LaTeXのアクセント記号を結合文字に置き換える
+LATEX_ACCENTS = {
+    '"': "\u0308", "'": "\u0301", "`": "\u0300", "^": "\u0302", "~": "\u0303", "=": "\u0304",
+    ".": "\u0307", "u": "\u0306", "v": "\u030c", "H": "\u030b", "c": "\u0327", "k": "\u0328",
+}
+LATEX_SYMBOLS = {
+    "ss": "ß", "o": "ø", "O": "Ø", "ae": "æ", "AE": "Æ", "oe": "œ", "OE": "Œ", "aa": "å", "AA": "Å",
+    "l": "ł", "L": "Ł", "i": "ı", "&": "&", "%": "%", "_": "_", "$": "$", "#": "#",
+}
+
+def _latex_to_text(value):
+    value = re.sub(
+        r"\\([\"'`^~=.uvHck])\s*\{?\s*(\\?[A-Za-z])\s*\}?",
+        lambda m: m.group(2).lstrip("\\") + LATEX_ACCENTS[m.group(1)],
+        value,
+    )
+    value = re.sub(r"\\(ss|ae|AE|oe|OE|aa|AA|[oOlLi])(?![A-Za-z])\s?|\\([&%_$#])",
+                   lambda m: LATEX_SYMBOLS[m.group(1) or m.group(2)], value)
+    value = re.sub(r"\\(emph|textit|textbf|textrm|mathrm|text)\s*", "", value)
+    value = value.replace("---", "—").replace("--", "–").replace("{", "").replace("}", "")
+    return unicodedata.normalize("NFC", " ".join(value.split()))
+
+# 開き括弧の直後から、対応する閉じ括弧までを読む（戻り値: 中身, 閉じ括弧の次の位置）
+def _read_group(text, position, close):
+    depth = 0
+    start = position
+    while position < len(text):
+        char = text[position]
+        if char == "\\":
+            position += 2
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+        elif char == close and depth == 0:
+            return text[start:position], position + 1
+        position += 1
+    return text[start:], position
+
+# フィールドの値（{...}・"..."・数値・@stringのマクロを#でつないだもの）を読む
+def _read_value(body, position, strings):
+    parts = []
+    while position < len(body):
+        char = body[position]
+        if char == "{":
+            part, position = _read_group(body, position + 1, "}")
+            parts.append(part)
+        elif char == '"':
+            part, position = _read_group(body, position + 1, '"')
+            parts.append(part)
+        else:
+            match = re.compile(r"[^\s,#]+").match(body, position)
+            if not match:
+                break
+            parts.append(strings.get(match.group(0).lower(), match.group(0)))
+            position = match.end()
+        match = re.compile(r"\s*#\s*").match(body, position)
+        if not match:
+            break
+        position = match.end()
+    return "".join(parts), position
+
+def _bibtex_fields(body, strings, has_key=True):
+    position = 0
+    if has_key:
+        _, position = _read_group(body, 0, ",")
+    fields = {}
+    field_pattern = re.compile(r"[\s,]*([^\s=,{}]+)\s*=\s*")
+    while True:
+        match = field_pattern.match(body, position)
+        if not match:
+            break
+        value, position = _read_value(body, match.end(), strings)
+        fields[match.group(1).lower()] = value
+    return fields
+
+# "and"で区切られた著者（{}で囲まれた団体名の中の"and"は区切らない）
+def _bibtex_authors(value):
+    names = []
+    depth = 0
+    start = 0
+    for match in re.finditer(r"[{}]|\s+and\s+", value):
+        token = match.group(0)
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            names.append(value[start:match.start()])
+            start = match.end()
+    names.append(value[start:])
+    authors = []
+    for name in (name.strip() for name in names):
+        if not name or name.lower() == "others":
+            continue
+        # 全体が{}で囲まれた名前（団体名）はそのまま使う
+        literal = name.startswith("{") and _read_group(name, 1, "}")[1] == len(name)
+        authors.append(_latex_to_text(name) if literal else _author_name(_latex_to_text(name)))
+    return authors
+
+# 指定したフィールドのうち最初に値があるものを返す
+def _bibtex_text(fields, *names):
+    return next((_latex_to_text(fields[name]) for name in names if fields.get(name)), None)
+
+def parse_bibtex(text):
+    records = []
+    strings = {}
+    entry_pattern = re.compile(r"@\s*(\w+)\s*([{(])")
+    position = 0
+    while True:
+        match = entry_pattern.search(text, position)
+        if not match:
+            break
+        entry_type = match.group(1).lower()
+        body, position = _read_group(text, match.end(), "}" if match.group(2) == "{" else ")")
+        if entry_type in ("comment", "preamble"):
+            continue
+        if entry_type == "string":
+            strings.update(_bibtex_fields(body, strings, has_key=False))
+            continue
+        fields = _bibtex_fields(body, strings)
+        records.append(_record(
+            title=_bibtex_text(fields, "title"),
+            authors=_bibtex_authors(fields.get("author") or fields.get("editor") or ""),
+            journal=_bibtex_text(fields, "journal", "journaltitle", "booktitle", "publisher"),
+            volume=_bibtex_text(fields, "volume"),
+            issue=_bibtex_text(fields, "number", "issue"),
+            pages=_bibtex_text(fields, "pages"),
+            year=_bibtex_text(fields, "year", "date"),
+            doi=_bibtex_text(fields, "doi"),
+            url=_bibtex_text(fields, "url"),
+            keywords=[_bibtex_text(fields, "keywords", "keyword")],
+            abstract=_bibtex_text(fields, "abstract"),
+            note=_bibtex_text(fields, "note", "annote"),
+        ))
+    return records
+
+# --- RIS ---
+
+RIS_LINE = re.compile(r"^([A-Z][A-Z0-9])  -(?: (.*))?$")
+
+def _ris_text(fields, *tags):
+    return next((fields[tag][0] for tag in tags if fields.get(tag)), None)
+
+def parse_ris(text):
+    records = []
+    fields = {}
+    last_tag = None
+    for line in text.splitlines():
+        match = RIS_LINE.match(line.rstrip())
+        if not match:
+            # タグのない行は直前のフィールドの続き
+            if last_tag and line.strip():
+                fields[last_tag][-1] += " " + line.strip()
+            continue
+        tag, value = match.group(1), (match.group(2) or "").strip()
+        if tag == "TY":
+            fields = {}
+        if tag == "ER":
+            records.append(_record(
+                title=_ris_text(fields, "TI", "T1", "CT", "BT"),
+                authors=[_author_name(name) for name in fields.get("AU", []) + fields.get("A1", [])],
+                journal=_ris_text(fields, "JF", "JO", "T2", "J2", "JA"),
+                volume=_ris_text(fields, "VL"),
+                issue=_ris_text(fields, "IS", "CP"),
+                pages=_ris_text(fields, "SP"),
+                end_page=_ris_text(fields, "EP"),
+                year=_ris_text(fields, "PY", "Y1", "DA"),
+                doi=_ris_text(fields, "DO"),
+                url=_ris_text(fields, "UR"),
+                keywords=fields.get("KW", []),
+                abstract=_ris_text(fields, "AB", "N2"),
+                note=_ris_text(fields, "N1"),
+            ))
+            fields = {}
+            last_tag = None
+            continue
+        fields.setdefault(tag, []).append(value)
+        last_tag = tag
+    return records
+
+# --- CSL-JSON ---
+
+def _csl_text(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return str(value).strip() if value not in (None, "") else None
+
+def _csl_author(author):
+    if author.get("literal"):
+        return author["literal"]
+    return " ".join(part for part in (author.get("family"), author.get("given")) if part)
+
+def _csl_year(issued):
+    if not isinstance(issued, dict):
+        return issued
+    parts = issued.get("date-parts") or [[None]]
+    return (parts[0] or [None])[0] or issued.get("raw") or issued.get("literal")
+
+def parse_csl_json(text):
+    items = json.loads(text)
+    if isinstance(items, dict):
+        items = items.get("items", [items])
+    records = []
+    for item in items:
+        keywords = item.get("keyword") or ""
+        records.append(_record(
+            title=_csl_text(item.get("title")),
+            authors=[_csl_author(author) for author in item.get("author") or item.get("editor") or []],
+            journal=_csl_text(item.get("container-title")) or _csl_text(item.get("publisher")),
+            volume=_csl_text(item.get("volume")),
+            issue=_csl_text(item.get("issue")),
+            pages=_csl_text(item.get("page")) or _csl_text(item.get("page-first")),
+            year=_csl_year(item.get("issued")),
+            doi=_csl_text(item.get("DOI")),
+            url=_csl_text(item.get("URL")),
+            keywords=keywords if isinstance(keywords, list) else [keywords],
+            abstract=_csl_text(item.get("abstract")),
+            note=_csl_text(item.get("note")),
+        ))
+    return records
+
+# ファイル名の拡張子（不明な場合は内容）から形式を判別して読み込む
+def parse_bibliography(text, file_name=""):
+    text = text.lstrip("\ufeff")
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in (".json", ".csljson") or (extension not in (".bib", ".ris") and text.lstrip()[:1] in ("[", "{")):
+        return parse_csl_json(text)
+    if extension == ".ris" or (extension != ".bib" and re.search(r"^TY  -", text, re.MULTILINE)):
+        return parse_ris(text)
+    return parse_bibtex(text)
+
+# --- DOIからの補完 ---
+
+def needs_metadata(record):
+    return bool(record.get("doi")) and any(not record.get(column) for column in ("タイトル", "著者", "ジャーナル", "年"))
+
+# 取得した文献情報で空のカラムだけを埋める
+def merge_metadata(record, metadata):
+    for column in RESOLVED_COLUMNS:
+        value = metadata.get(column)
+        if record.get(column) or value in (None, "", NOT_FOUND):
+            continue
+        record[column] = _year(value) if column == "年" else str(value)
+    return record
+
+# 文献情報が不足している文献を、DOIからRESOLVE_BATCH件ずつ並列に補完する
+# resolve: DOIを受け取り文献情報の辞書を返す関数／on_progress: (補完済みの件数, 対象の件数) を受け取る関数
+def resolve_missing(records, resolve, workers=RESOLVE_WORKERS, on_progress=None):
+    targets = [record for record in records if needs_metadata(record)]
+    failed = []
+    with ThreadPoolExecutor(workers) as executor:
+        for start in range(0, len(targets), RESOLVE_BATCH):
+            batch = targets[start:start + RESOLVE_BATCH]
+            futures = [executor.submit(resolve, record["doi"]) for record in batch]
+            for record, future in zip(batch, futures):
+                try:
+                    merge_metadata(record, future.result())
+                except Exception as e:
+                    failed.append((record["doi"], e))
+            if on_progress:
+                on_progress(start + len(batch), len(targets))
+    return failed
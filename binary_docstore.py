@@ -0,0 +1,125 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.kvstore.simple_kvstore import SimpleKVStore
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION
+
+# ノード（チャンク）の本文とメタデータを長さ付きのバイナリレコードで保存するドキュメントストア
+# LlamaIndex標準のJSON（日本語を\uXXXXでエスケープした1つの巨大なJSON）に比べて小さく、
+# 読み込み時はレコードの位置だけを走査し、各ノードは最初に参照されたときに復元する
+DOCSTORE_MAGIC = b"LMDOCS1\n"
+# レコードのヘッダ: コレクション名の長さ, キーの長さ, 値の長さ, フラグ
+RECORD_HEADER = struct.Struct("<IIIB")
+# 値をzlibで圧縮したことを示すフラグと、圧縮する最小サイズ
+FLAG_ZLIB = 1
+COMPRESS_MIN_BYTES = 256
+
+
+def encode_value(value):
+    data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) >= COMPRESS_MIN_BYTES:
+        return zlib.compress(data), FLAG_ZLIB
+    return data, 0
+
+
+def decode_value(data, flags):
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    return json.loads(data)
+
+
+class BinaryKVStore(SimpleKVStore):
+    def __init__(self, data=None):
+        super().__init__(data)
+        # 未復元の値の位置 {コレクション: {キー: (開始位置, 長さ, フラグ)}}
+        self._offsets = {}
+        self._buffer = None
+
+    def _decode(self, collection, key):
+        offset, length, flags = self._offsets[collection].pop(key)
+        value = decode_value(self._buffer[offset:offset + length], flags)
+        self._data.setdefault(collection, {})[key] = value
+        return value
+
+    def put(self, key, val, collection=DEFAULT_COLLECTION):
+        self._offsets.get(collection, {}).pop(key, None)
+        super().put(key, val, collection)
+
+    def get(self, key, collection=DEFAULT_COLLECTION):
+        if key in self._offsets.get(collection, {}):
+            return self._decode(collection, key).copy()
+        return super().get(key, collection)
+
+    def get_all(self, collection=DEFAULT_COLLECTION):
+        for key in list(self._offsets.get(collection, {})):
+            self._decode(collection, key)
+        return super().get_all(collection)
+
+    def delete(self, key, collection=DEFAULT_COLLECTION):
+        if self._offsets.get(collection, {}).pop(key, None) is not None:
+            self._data.get(collection, {}).pop(key, None)
+            return True
+        return super().delete(key, collection)
+
+    # 未復元の値は圧縮済みのバイト列をそのまま書き出す
+    # 読み込み中（メモリマップ中）のファイルを上書きしないよう、一時ファイルに書き込んでから置き換える
+    def persist(self, persist_path, fs=None):
+        os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+        with open(persist_path + ".tmp", "wb") as f:
+            f.write(DOCSTORE_MAGIC)
+            for collection in set(self._data) | set(self._offsets):
+                encoded_collection = collection.encode("utf-8")
+                for key, (offset, length, flags) in self._offsets.get(collection, {}).items():
+                    encoded_key = key.encode("utf-8")
+                    f.write(RECORD_HEADER.pack(len(encoded_collection), len(encoded_key), length, flags))
+                    f.write(encoded_collection + encoded_key + self._buffer[offset:offset + length])
+                for key, value in self._data.get(collection, {}).items():
+                    encoded_key = key.encode("utf-8")
+                    data, flags = encode_value(value)
+                    f.write(RECORD_HEADER.pack(len(encoded_collection), len(encoded_key), len(data), flags))
+                    f.write(encoded_collection + encoded_key + data)
+        os.replace(persist_path + ".tmp", persist_path)
+
+    # レコードの位置だけを読み込む（値の復元は参照時）
+    @classmethod
+    def from_persist_path(cls, persist_path, fs=None):
+        store = cls()
+        with open(persist_path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(DOCSTORE_MAGIC)] != DOCSTORE_MAGIC:
+            raise ValueError(f"{persist_path} はバイナリ形式のドキュメントストアではありません。")
+        position = len(DOCSTORE_MAGIC)
+        while position < len(buffer):
+            collection_length, key_length, value_length, flags = RECORD_HEADER.unpack_from(buffer, position)
+            position += RECORD_HEADER.size
+            collection = buffer[position:position + collection_length].decode("utf-8")
+            position += collection_length
+            key = buffer[position:position + key_length].decode("utf-8")
+            position += key_length
+            store._offsets.setdefault(collection, {})[key] = (position, value_length, flags)
+            position += value_length
+        store._buffer = buffer
+        return store
+
+    def to_dict(self):
+        for collection in list(self._offsets):
+            self.get_all(collection)
+        return super().to_dict()
+
+
+class BinaryDocumentStore(SimpleDocumentStore):
+    def __init__(self, simple_kvstore=None, namespace=None, **kwargs):
+        super().__init__(simple_kvstore or BinaryKVStore(), namespace=namespace, **kwargs)
+
+    @classmethod
+    def from_persist_path(cls, persist_path, namespace=None, fs=None):
+        return cls(BinaryKVStore.from_persist_path(persist_path), namespace)
+
+    # LlamaIndex標準のドキュメントストアの内容から変換
+    @classmethod
+    def from_simple_docstore(cls, docstore):
+        return cls(BinaryKVStore(docstore.to_dict()))
@@ -1,4 +1,12 @@
-from sqlalchemy import Column, Integer, String, Boolean, create_engine
+import json
+import re
+import sqlite3
+import threading
+import zlib
+from functools import lru_cache
+
+import pandas as pd
+from sqlalchemy import Column, Integer, String, Boolean, create_engine, event, exc
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 Base = declarative_base()
@@ -21,12 +29,727 @@ class Metadata(Base):
     doi_url = Column(String)
     ファイルリンク = Column(String)
     メモ = Column(String)
-    Read = Column(Boolean, default=False)
+    Read = Column(Boolean, default=False, server_default="0")
+    # 要約の生成元（抽出テキストのハッシュ・PDFのMD5・モデル名・プロンプトバージョン）
+    text_hash = Column(String)
+    pdf_md5 = Column(String)
+    summary_model = Column(String)
+    summary_prompt_version = Column(String)
+
+# データベースファイル（各ページで共通）
+DB_FILE = "literature_database.db"
+
+# データベースファイルごとにプロセス全体で1つのエンジン（接続プール）を共有する
+_engines = {}
+_engines_lock = threading.Lock()
+
+# 接続ごとにSQLiteの設定を行う
+# WAL: 読み込みと書き込みが互いを待たない／synchronous=NORMAL: コミットごとのfsyncを省く（WALでは電源断時も破損しない）
+def _configure_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+def get_engine(db_file=DB_FILE):
+    with _engines_lock:
+        engine = _engines.get(db_file)
+        if engine is None:
+            # Streamlitは再実行ごとに別スレッドで動くため、プールの接続をスレッド間で使い回せるようにする
+            engine = create_engine(f"sqlite:///{db_file}", connect_args={"check_same_thread": False})
+            event.listen(engine, "connect", _configure_sqlite)
+            _engines[db_file] = engine
+        return engine
+
+# データベースファイルを置き換える前（Google Driveからのダウンロードなど）にエンジンを破棄する
+def dispose_engine(db_file=DB_FILE):
+    with _engines_lock:
+        engine = _engines.pop(db_file, None)
+    if engine is not None:
+        engine.dispose()
+
+def get_session(db_file=DB_FILE):
+    return sessionmaker(bind=get_engine(db_file))()
+
+# テーブルが無ければ作成し、スキーマを最新化
+def init_db(db_file=DB_FILE):
+    Base.metadata.create_all(get_engine(db_file))
+    upgrade_schema(db_file)
+
+# 全文献をデータフレームとして読み込む
+def load_metadata_df(db_file=DB_FILE):
+    with get_engine(db_file).connect() as conn:
+        return pd.read_sql("SELECT * FROM metadata", conn)
+
+# 1件の文献の指定したカラムだけを更新
+def update_record(db_file, row_id, values):
+    with get_engine(db_file).begin() as conn:
+        _update_row(conn, row_id, values)
+        if LINKED_COLUMNS.keys() & values.keys():
+            _sync_links(conn, [row_id])
+
+# データベースの一貫したコピーを作成（WALに残っている変更も含める）
+def backup_database(db_file, target_path):
+    target = sqlite3.connect(target_path)
+    try:
+        with get_engine(db_file).connect() as conn:
+            conn.connection.driver_connection.backup(target)
+    finally:
+        target.close()
+
+# 後から追加したカラム（既存のデータベースファイルには存在しない場合がある）
+ADDED_COLUMNS = {
+    "text_hash": "VARCHAR",
+    "pdf_md5": "VARCHAR",
+    "summary_model": "VARCHAR",
+    "summary_prompt_version": "VARCHAR",
+}
+
+# 検索条件に使うカラムのインデックス {インデックス名: カラム}
+INDEXED_COLUMNS = {
+    "metadata_category": "カテゴリ",
+    "metadata_year": "年",
+    "metadata_journal": "ジャーナル",
+    "metadata_read": "Read",
+}
+
+# カンマ区切りで保存しているカラムと、名前の表・文献との対応表 {カラム: (名前の表, 対応表, 名前のIDのカラム)}
+LINKED_COLUMNS = {
+    "著者": ("authors", "metadata_authors", "author_id"),
+    "キーワード": ("keywords", "metadata_keywords", "keyword_id"),
+}
+
+# スキーマのバージョン（PRAGMA user_versionに保存。古いデータベースには、バージョンごとの移行を1回だけ行う）
+#   1: 既存の文献から著者・キーワードの対応表を作成
+#   2: 既読フラグが空のまま追加された文献を未読にする
+SCHEMA_VERSION = 2
+
+# 既存のデータベースファイルに不足しているカラム・インデックス・表を追加
+def upgrade_schema(db_file):
+    with get_engine(db_file).begin() as conn:
+        existing = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(metadata)")}
+        if not existing:
+            return
+        for name, column_type in ADDED_COLUMNS.items():
+            if name not in existing:
+                conn.exec_driver_sql(f"ALTER TABLE metadata ADD COLUMN {name} {column_type}")
+
+        for index_name, column in INDEXED_COLUMNS.items():
+            conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS {index_name} ON metadata ("{column}")')
+        _ensure_doi_index(conn)
+
+        for table, link_table, key in LINKED_COLUMNS.values():
+            conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+            conn.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS {link_table} ("
+                f" metadata_id INTEGER NOT NULL, {key} INTEGER NOT NULL, PRIMARY KEY (metadata_id, {key})) WITHOUT ROWID"
+            )
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {link_table}_{key} ON {link_table} ({key})")
+
+        _ensure_fts(conn)
+        _ensure_fulltext(conn)
+        _ensure_changelog(conn)
+
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if version < 1:
+            _sync_links(conn, [row[0] for row in conn.exec_driver_sql("SELECT id FROM metadata")])
+        if version < 2:
+            conn.exec_driver_sql('UPDATE metadata SET "Read" = 0 WHERE "Read" IS NULL')
+        if version < SCHEMA_VERSION:
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        # 絞り込み項目の集計は対応表の作成後に行う（作成中の変更を二重に数えないため）
+        _ensure_facets(conn)
+
+# DOIの一意インデックスを作成（DOIは大文字小文字を区別しないため、lower(doi)に作成する。
+# 既存のデータに重複したDOIがある場合は、一意でないインデックスで代用する）
+def _ensure_doi_index(conn):
+    row = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'metadata_doi'").first()
+    sql = row[0] if row is not None else ""
+    if sql.startswith("CREATE UNIQUE INDEX") and "lower(doi)" in sql:
+        return
+    duplicated = conn.exec_driver_sql("SELECT 1 FROM metadata GROUP BY lower(doi) HAVING COUNT(*) > 1 LIMIT 1").first()
+    if duplicated is not None and "lower(doi)" in sql:
+        return
+    conn.exec_driver_sql("DROP INDEX IF EXISTS metadata_doi")
+    if duplicated is not None:
+        conn.exec_driver_sql("CREATE INDEX metadata_doi ON metadata (lower(doi))")
+        return
+    conn.exec_driver_sql("CREATE UNIQUE INDEX metadata_doi ON metadata (lower(doi))")
+
+# カンマ区切りの文字列を名前のリストに分割（空白を除き、重複を除く）
+def split_names(value):
+    if not isinstance(value, str):
+        return []
+    return list(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+
+def _chunks(items, size=500):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# 指定した文献の著者・キーワードの対応表を作り直し、どの文献にも使われなくなった名前を削除
+def _sync_links(conn, row_ids):
+    row_ids = [int(row_id) for row_id in row_ids]
+    if not row_ids:
+        return
+    columns = list(LINKED_COLUMNS)
+    selected = ", ".join(f'"{c}"' for c in columns)
+    rows = []
+    for chunk in _chunks(row_ids):
+        rows.extend(conn.exec_driver_sql(
+            f"SELECT id, {selected} FROM metadata WHERE id IN ({', '.join('?' * len(chunk))})", tuple(chunk)
+        ).fetchall())
+
+    for position, column in enumerate(columns, start=1):
+        table, link_table, key = LINKED_COLUMNS[column]
+        for chunk in _chunks(row_ids):
+            conn.exec_driver_sql(f"DELETE FROM {link_table} WHERE metadata_id IN ({', '.join('?' * len(chunk))})", tuple(chunk))
+
+        names_by_row = {row[0]: split_names(row[position]) for row in rows}
+        names = list({name for row_names in names_by_row.values() for name in row_names})
+        if names:
+            conn.exec_driver_sql(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", [(name,) for name in names])
+            name_ids = {}
+            for chunk in _chunks(names):
+                name_ids.update(conn.exec_driver_sql(
+                    f"SELECT name, id FROM {table} WHERE name IN ({', '.join('?' * len(chunk))})", tuple(chunk)
+                ).fetchall())
+            conn.exec_driver_sql(
+                f"INSERT INTO {link_table} (metadata_id, {key}) VALUES (?, ?)",
+                [(row_id, name_ids[name]) for row_id, row_names in names_by_row.items() for name in row_names],
+            )
+        conn.exec_driver_sql(f"DELETE FROM {table} WHERE id NOT IN (SELECT {key} FROM {link_table})")
+
+# ORMで追加・更新した文献（PDFアップロード）の対応表も更新する
+def _sync_links_after_flush(mapper, connection, target):
+    _sync_links(connection, [target.id])
+
+event.listen(Metadata, "after_insert", _sync_links_after_flush)
+event.listen(Metadata, "after_update", _sync_links_after_flush)
+
+# 全文検索の対象カラムと、BM25の重み（タイトル・キーワードの一致を優先する）
+FTS_COLUMNS = ["タイトル", "著者", "要約", "キーワード", "メモ"]
+FTS_WEIGHTS = [10.0, 5.0, 1.0, 5.0, 2.0]
+# 抜粋の前後の文字数・FTS5の抜粋のトークン数（trigramでは文字数）と、一致箇所の囲み
+SNIPPET_CHARS = 20
+SNIPPET_TOKENS = 40
+SNIPPET_MARKERS = ("【", "】")
+
+# このSQLiteでFTS5のtrigramトークナイザ（SQLite 3.34以降）が使えるか
+@lru_cache(maxsize=None)
+def fts_supported():
+    try:
+        conn = sqlite3.connect(":memory:")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE t USING fts5(a, tokenize='trigram')")
+        finally:
+            conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+# 全文検索の表（文献の表を参照するexternal content）と、文献の変更を反映するトリガーを作成
+# 表を新しく作成した場合は既存の文献から索引を作る
+def _ensure_fts(conn):
+    if not fts_supported():
+        return
+    exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'metadata_fts'").first()
+    columns = ", ".join(f'"{c}"' for c in FTS_COLUMNS)
+    new_values = ", ".join(f'new."{c}"' for c in FTS_COLUMNS)
+    old_values = ", ".join(f'old."{c}"' for c in FTS_COLUMNS)
+    conn.exec_driver_sql(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS metadata_fts USING fts5("
+        f"{columns}, content='metadata', content_rowid='id', tokenize='trigram')"
+    )
+    conn.exec_driver_sql(
+        f"CREATE TRIGGER IF NOT EXISTS metadata_fts_insert AFTER INSERT ON metadata BEGIN"
+        f" INSERT INTO metadata_fts (rowid, {columns}) VALUES (new.id, {new_values}); END"
+    )
+    conn.exec_driver_sql(
+        f"CREATE TRIGGER IF NOT EXISTS metadata_fts_delete AFTER DELETE ON metadata BEGIN"
+        f" INSERT INTO metadata_fts (metadata_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END"
+    )
+    conn.exec_driver_sql(
+        f"CREATE TRIGGER IF NOT EXISTS metadata_fts_update AFTER UPDATE OF {columns} ON metadata BEGIN"
+        f" INSERT INTO metadata_fts (metadata_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+        f" INSERT INTO metadata_fts (rowid, {columns}) VALUES (new.id, {new_values}); END"
+    )
+    if exists is None:
+        conn.exec_driver_sql("INSERT INTO metadata_fts (metadata_fts) VALUES ('rebuild')")
+
+# 絞り込み項目ごとの値と件数を保持する表で集計する項目
+# 文献の表のカラム（カテゴリ・ジャーナル）と、対応表で数える項目（著者・キーワード）
+FACET_COLUMNS = {"カテゴリ": "category", "ジャーナル": "journal"}
+FACET_LINKS = ["著者", "キーワード"]
+
+def _facet_upsert(facet, value, condition):
+    return (f"INSERT INTO facets (facet, value, count) SELECT '{facet}', {value}, 1 WHERE {condition}"
+            f" ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;")
+
+def _facet_decrement(facet, value):
+    return (f"UPDATE facets SET count = count - 1 WHERE facet = '{facet}' AND value = {value};"
+            f" DELETE FROM facets WHERE facet = '{facet}' AND value = {value} AND count <= 0;")
+
+# 絞り込み項目の値ごとの件数（facets）と、データベースの版（文献を変更するたびに増える）の表を作成
+# 件数は文献の表・対応表のトリガーで差分だけ更新する。表を新しく作成した場合は既存の文献から集計する
+def _ensure_facets(conn):
+    exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'facets'").first()
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS facets ("
+        " facet TEXT NOT NULL, value TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (facet, value)) WITHOUT ROWID"
+    )
+    conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS db_state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    conn.exec_driver_sql("INSERT OR IGNORE INTO db_state (key, value) VALUES ('version', 0)")
+    if exists is None:
+        for column in FACET_COLUMNS:
+            conn.exec_driver_sql(
+                f"INSERT INTO facets (facet, value, count) SELECT '{column}', \"{column}\", COUNT(*) FROM metadata"
+                f" WHERE \"{column}\" IS NOT NULL AND \"{column}\" <> '' GROUP BY \"{column}\""
+            )
+        for column in FACET_LINKS:
+            table, link_table, key = LINKED_COLUMNS[column]
+            conn.exec_driver_sql(
+                f"INSERT INTO facets (facet, value, count) SELECT '{column}', t.name, COUNT(*)"
+                f" FROM {link_table} l JOIN {table} t ON t.id = l.{key} GROUP BY t.name"
+            )
+
+    for event_name, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS metadata_version_{event_name.lower()} AFTER {event_name} ON metadata BEGIN"
+            f" UPDATE db_state SET value = value + 1 WHERE key = 'version'; END"
+        )
+    for column, name in FACET_COLUMNS.items():
+        new_value = f'new."{column}"'
+        old_value = f'old."{column}"'
+        upsert = _facet_upsert(column, new_value, f"{new_value} IS NOT NULL AND {new_value} <> ''")
+        decrement = _facet_decrement(column, old_value)
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS facets_{name}_insert AFTER INSERT ON metadata BEGIN {upsert} END")
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS facets_{name}_delete AFTER DELETE ON metadata BEGIN {decrement} END")
+        conn.exec_driver_sql(
+            f'CREATE TRIGGER IF NOT EXISTS facets_{name}_update AFTER UPDATE OF "{column}" ON metadata BEGIN {decrement} {upsert} END'
+        )
+    for column in FACET_LINKS:
+        table, link_table, key = LINKED_COLUMNS[column]
+        upsert = _facet_upsert(column, f"(SELECT name FROM {table} WHERE id = new.{key})", "true")
+        decrement = _facet_decrement(column, f"(SELECT name FROM {table} WHERE id = old.{key})")
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {link_table}_facets_insert AFTER INSERT ON {link_table} BEGIN {upsert} END")
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {link_table}_facets_delete AFTER DELETE ON {link_table} BEGIN {decrement} END")
+
+# データベースの版（文献を追加・更新・削除するたびに増える。集計結果などのキャッシュのキーに使う）
+def get_db_version(db_file=DB_FILE):
+    with get_engine(db_file).connect() as conn:
+        return conn.exec_driver_sql("SELECT value FROM db_state WHERE key = 'version'").scalar() or 0
+
+# 絞り込み項目ごとの値と件数を件数の多い順に返す {項目: [(値, 件数)]}
+def load_facets(db_file=DB_FILE):
+    facets = {column: [] for column in list(FACET_COLUMNS) + FACET_LINKS}
+    with get_engine(db_file).connect() as conn:
+        rows = conn.exec_driver_sql("SELECT facet, value, count FROM facets ORDER BY facet, count DESC, value")
+        for facet, value, count in rows:
+            facets.setdefault(facet, []).append((value, count))
+    return facets
+
+# 出版年の最小値と最大値（文献が無い場合は(None, None)）
+def get_year_range(db_file=DB_FILE):
+    with get_engine(db_file).connect() as conn:
+        return tuple(conn.exec_driver_sql("SELECT MIN(年), MAX(年) FROM metadata").first())
+
+# 最初に一致した箇所の前後を抜粋する（trigramで索引できない2文字以下の語の検索用）
+def _snippet(texts, terms):
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        for term in terms:
+            match = re.search(re.escape(term), text, re.IGNORECASE)
+            if match:
+                start = max(match.start() - SNIPPET_CHARS, 0)
+                end = match.end() + SNIPPET_CHARS
+                before = ("…" if start > 0 else "") + text[start:match.start()]
+                after = text[match.end():end] + ("…" if end < len(text) else "")
+                return f"{before}{SNIPPET_MARKERS[0]}{match.group()}{SNIPPET_MARKERS[1]}{after}"
+    return None
+
+def _like_condition(term, prefix=""):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    condition = "(" + " OR ".join(f"{prefix}\"{c}\" LIKE ? ESCAPE '\\'" for c in FTS_COLUMNS) + ")"
+    return condition, [f"%{escaped}%"] * len(FTS_COLUMNS)
+
+# 空白区切りの語を、trigramの索引で検索できる3文字以上の語と、LIKEで絞り込む2文字以下の語に分ける
+def _split_terms(query):
+    terms = query.split()
+    return [term for term in terms if len(term) >= 3], [term for term in terms if len(term) < 3]
+
+def _match_expression(terms):
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+# 全文検索で一致した文献の (id, score) を返す副問い合わせとパラメータ（語はすべて含むものを検索する）
+def _fts_hits(query):
+    long_terms, short_terms = _split_terms(query)
+    conditions = []
+    params = []
+    if long_terms:
+        conditions.append("metadata_fts MATCH ?")
+        params.append(_match_expression(long_terms))
+    for term in short_terms:
+        condition, like_params = _like_condition(term)
+        conditions.append(condition)
+        params.extend(like_params)
+
+    if long_terms:
+        # bm25は小さいほど関連度が高いため、符号を反転する
+        weights = ", ".join(str(weight) for weight in FTS_WEIGHTS)
+        score = f"0.0 - bm25(metadata_fts, {weights})"
+    else:
+        score = "0.0"
+    return f"SELECT rowid AS id, {score} AS score FROM metadata_fts WHERE {' AND '.join(conditions)}", params
+
+# 指定した文献の一致箇所の抜粋 {id: 抜粋}（抜粋の作成は重いため、表示する文献の分だけ作る）
+def _snippets(conn, query, row_ids):
+    long_terms, short_terms = _split_terms(query)
+    row_ids = [int(row_id) for row_id in row_ids]
+    snippets = dict.fromkeys(row_ids)
+    if long_terms:
+        for chunk in _chunks(row_ids):
+            snippets.update(conn.exec_driver_sql(
+                f"SELECT rowid, snippet(metadata_fts, -1, '{SNIPPET_MARKERS[0]}', '{SNIPPET_MARKERS[1]}', '…', {SNIPPET_TOKENS})"
+                f" FROM metadata_fts WHERE metadata_fts MATCH ? AND rowid IN ({', '.join('?' * len(chunk))})",
+                (_match_expression(long_terms),) + tuple(chunk),
+            ).fetchall())
+
+    # 2文字以下の語だけで一致した文献は本文から抜粋を作る
+    missing = [row_id for row_id, snippet in snippets.items() if snippet is None]
+    if missing and short_terms:
+        columns = ", ".join(f'"{c}"' for c in FTS_COLUMNS)
+        for chunk in _chunks(missing):
+            rows = conn.exec_driver_sql(
+                f"SELECT id, {columns} FROM metadata WHERE id IN ({', '.join('?' * len(chunk))})", tuple(chunk)
+            )
+            for row in rows:
+                snippets[row[0]] = _snippet(row[1:], short_terms)
+    return snippets
+
+# タイトル・著者・要約・キーワード・メモを全文検索し、関連度順に [(id, スコア, 抜粋)] を返す
+# FTS5が使えない場合はNone
+def search_metadata(db_file, query, limit=None):
+    if not fts_supported():
+        return None
+    if not query.split():
+        return []
+    hits_sql, params = _fts_hits(query)
+    sql = f"{hits_sql} ORDER BY score DESC, id"
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    with get_engine(db_file).connect() as conn:
+        rows = conn.exec_driver_sql(sql, tuple(params)).fetchall()
+        snippets = _snippets(conn, query, [row[0] for row in rows])
+    return [(row[0], row[1], snippets[row[0]]) for row in rows]
+
+# 絞り込み条件をSQLの条件式とパラメータに変換（metadataの別名はm）
+# 指定しなかった条件（None）は絞り込まない。著者・キーワードは対応表で完全一致を検索する
+def _filter_conditions(category=None, year_from=None, year_to=None, journal=None, read=None, keyword=None, author=None):
+    conditions = []
+    params = []
+    if category is not None:
+        conditions.append("m.カテゴリ = ?")
+        params.append(category)
+    if year_from is not None:
+        conditions.append("m.年 >= ?")
+        params.append(int(year_from))
+    if year_to is not None:
+        conditions.append("m.年 <= ?")
+        params.append(int(year_to))
+    if journal is not None:
+        conditions.append("m.ジャーナル = ?")
+        params.append(journal)
+    if read is not None:
+        conditions.append("m.Read = ?")
+        params.append(1 if read else 0)
+    for column, name in (("キーワード", keyword), ("著者", author)):
+        if name is not None:
+            table, link_table, key = LINKED_COLUMNS[column]
+            conditions.append(
+                f"m.id IN (SELECT l.metadata_id FROM {link_table} l JOIN {table} t ON t.id = l.{key} WHERE t.name = ?)"
+            )
+            params.append(name.strip())
+    return conditions, params
+
+# 条件に合う文献のIDをデータベースから取得（AIチャットの検索対象の絞り込みに使う）
+def find_record_ids(db_file, **filters):
+    conditions, params = _filter_conditions(**filters)
+    query = "SELECT m.id FROM metadata m"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    with get_engine(db_file).connect() as conn:
+        return [row[0] for row in conn.exec_driver_sql(query, tuple(params))]
+
+# 一覧に表示するカラムと、先頭だけを取得する長いカラム
+LIST_COLUMNS = ["id", "タイトル", "著者", "ジャーナル", "年", "カテゴリ", "キーワード", "Read", "doi_url"]
+PREVIEW_COLUMNS = ["要約", "メモ"]
+PREVIEW_CHARS = 100
+
+# 絞り込み条件と検索語句に合う文献の一覧の1ページ分と、条件に合う全件数を返す
+# 検索語句がある場合は関連度順に並べ、一致箇所の抜粋（抜粋カラム）を付ける。それ以外はid順
+def query_metadata_page(db_file, text=None, limit=50, offset=0, **filters):
+    conditions, params = _filter_conditions(**filters)
+    columns = [f'm."{c}"' for c in LIST_COLUMNS]
+    columns += [f'substr(m."{c}", 1, {PREVIEW_CHARS}) AS "{c}"' for c in PREVIEW_COLUMNS]
+    source = "metadata m"
+    order = "m.id"
+    source_params = []
+    search = bool(text and text.split()) and fts_supported()
+    if text and text.split():
+        if search:
+            hits_sql, source_params = _fts_hits(text)
+            source = f"metadata m JOIN ({hits_sql}) h ON h.id = m.id"
+            order = "h.score DESC, m.id"
+        else:
+            for term in text.split():
+                condition, like_params = _like_condition(term, prefix="m.")
+                conditions.append(condition)
+                params.extend(like_params)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    all_params = tuple(source_params) + tuple(params)
+
+    with get_engine(db_file).connect() as conn:
+        total = conn.exec_driver_sql(f"SELECT COUNT(*) FROM {source}{where}", all_params).scalar()
+        page = _read_frame(
+            conn,
+            f"SELECT {', '.join(columns)} FROM {source}{where} ORDER BY {order} LIMIT ? OFFSET ?",
+            all_params + (int(limit), int(offset)),
+        )
+        if search:
+            page.insert(1, "抜粋", page["id"].map(_snippets(conn, text, page["id"])))
+    return page, total
+
+# 指定したidの文献をすべてのカラムで取得（一覧の編集・PDF表示用。指定したidの順に並べる）
+def load_records(db_file, row_ids):
+    row_ids = [int(row_id) for row_id in row_ids]
+    with get_engine(db_file).connect() as conn:
+        frames = [_read_frame(conn, "SELECT * FROM metadata LIMIT 0")]
+        for chunk in _chunks(row_ids):
+            frames.append(_read_frame(conn, f"SELECT * FROM metadata WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+    records = pd.concat(frames[1:], ignore_index=True) if len(frames) > 1 else frames[0]
+    order = {row_id: position for position, row_id in enumerate(row_ids)}
+    return records.sort_values("id", key=lambda ids: ids.map(order)).reset_index(drop=True)
+
+def _read_frame(conn, sql, params=()):
+    result = conn.exec_driver_sql(sql, tuple(params))
+    return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+# PDFから抽出した本文（ページごと）を文献ごとに圧縮して保存する表を作成（文献を削除すると本文も削除する）
+def _ensure_fulltext(conn):
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS fulltext ("
+        " metadata_id INTEGER PRIMARY KEY, content_hash TEXT NOT NULL, ocr INTEGER NOT NULL,"
+        " page_count INTEGER NOT NULL, data BLOB NOT NULL)"
+    )
+    conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS fulltext_delete AFTER DELETE ON metadata BEGIN"
+        " DELETE FROM fulltext WHERE metadata_id = old.id; END"
+    )
+
+# 抽出した本文を保存（content_hashは抽出元のPDFのMD5＝Google Driveのmd5Checksum）
+# pages: [(ページラベル, テキスト)], ocr: OCRで抽出したか
+def store_fulltext(db_file, record_id, content_hash, pages, ocr):
+    data = zlib.compress(json.dumps([list(page) for page in pages], ensure_ascii=False).encode("utf-8"))
+    with get_engine(db_file).begin() as conn:
+        conn.exec_driver_sql(
+            "INSERT OR REPLACE INTO fulltext (metadata_id, content_hash, ocr, page_count, data) VALUES (?, ?, ?, ?, ?)",
+            (int(record_id), content_hash, 1 if ocr else 0, len(pages), data),
+        )
+
+# 保存済みの本文を返す（無い場合、またはcontent_hashを指定して一致しない場合はNone）
+# 戻り値: {"pages": [(ページラベル, テキスト)], "ocr": bool, "content_hash": str}
+def load_fulltext(db_file, record_id, content_hash=None):
+    with get_engine(db_file).connect() as conn:
+        row = conn.exec_driver_sql(
+            "SELECT content_hash, ocr, data FROM fulltext WHERE metadata_id = ?", (int(record_id),)
+        ).first()
+    if row is None or (content_hash is not None and row[0] != content_hash):
+        return None
+    pages = [tuple(page) for page in json.loads(zlib.decompress(row[2]))]
+    return {"pages": pages, "ocr": bool(row[1]), "content_hash": row[0]}
+
+# 編集可能なカラム（idは自動採番のため除く）
+EDITABLE_COLUMNS = [column.name for column in Metadata.__table__.columns if column.name != "id"]
+
+def _update_row(conn, row_id, values):
+    columns = [c for c in values if c in EDITABLE_COLUMNS]
+    if not columns:
+        return
+    assignments = ", ".join(f'"{c}" = ?' for c in columns)
+    conn.exec_driver_sql(
+        f"UPDATE metadata SET {assignments} WHERE id = ?",
+        tuple(values[c] for c in columns) + (int(row_id),),
+    )
+
+# 表の編集内容（更新・追加・削除）だけを1つのトランザクションで反映
+# updated: {id: {カラム: 値}}, added: [{カラム: 値}], deleted: [id]
+def apply_row_changes(db_file, updated=None, added=None, deleted=None):
+    linked_ids = []
+    with get_engine(db_file).begin() as conn:
+        for row_id, values in (updated or {}).items():
+            _update_row(conn, row_id, values)
+            if LINKED_COLUMNS.keys() & values.keys():
+                linked_ids.append(row_id)
+        for values in added or []:
+            columns = [c for c in values if c in EDITABLE_COLUMNS and values[c] is not None]
+            if not columns:
+                continue
+            # ORMのdefaultはSQLで直接追加する場合に使われず、既存のデータベースの表には既定値が無いため、未指定の既読フラグは未読にする
+            if "Read" not in columns:
+                values = dict(values, Read=False)
+                columns.append("Read")
+            names = ", ".join(f'"{c}"' for c in columns)
+            placeholders = ", ".join("?" * len(columns))
+            result = conn.exec_driver_sql(
+                f"INSERT INTO metadata ({names}) VALUES ({placeholders})",
+                tuple(values[c] for c in columns),
+            )
+            linked_ids.append(result.lastrowid)
+        if deleted:
+            conn.exec_driver_sql(
+                f"DELETE FROM metadata WHERE id IN ({', '.join('?' * len(deleted))})",
+                tuple(int(row_id) for row_id in deleted),
+            )
+            linked_ids.extend(deleted)
+        _sync_links(conn, linked_ids)
+
+# 一括取り込み: 指定したDOIのうち、すでに登録されているものを1回の問い合わせで返す（大文字小文字は区別しない）
+def find_existing_dois(db_file, dois):
+    dois = list({doi.lower() for doi in dois if doi})
+    if not dois:
+        return set()
+    with get_engine(db_file).connect() as conn:
+        rows = conn.exec_driver_sql(
+            "SELECT lower(doi) FROM metadata WHERE lower(doi) IN (SELECT value FROM json_each(?))",
+            (json.dumps(dois),),
+        )
+        return {row[0] for row in rows}
+
+# 複数の文献を1つのトランザクションでまとめて追加し、指定したDOIの文献のidを返す
+# （カラムをそろえてexecutemanyで挿入し、著者・キーワードの対応表は最後にまとめて更新する。
+#   登録済みのDOIは追加しないため、事前にfind_existing_doisで除いておく）
+def insert_records(db_file, records):
+    # ORMのdefault（Read=False）はexecutemanyでは使われないため、未指定の既読フラグは明示的にFalseにする
+    records = [dict(record, Read=bool(record.get("Read"))) for record in records if record.get("doi")]
+    if not records:
+        return []
+    columns = [c for c in EDITABLE_COLUMNS if any(record.get(c) is not None for record in records)]
+    names = ", ".join(f'"{c}"' for c in columns)
+    placeholders = ", ".join("?" * len(columns))
+    with get_engine(db_file).begin() as conn:
+        conn.exec_driver_sql(
+            f"INSERT OR IGNORE INTO metadata ({names}) VALUES ({placeholders})",
+            [tuple(record.get(c) for c in columns) for record in records],
+        )
+        row_ids = [row[0] for row in conn.exec_driver_sql(
+            "SELECT id FROM metadata WHERE lower(doi) IN (SELECT value FROM json_each(?))",
+            (json.dumps([record["doi"].lower() for record in records]),),
+        )]
+        _sync_links(conn, row_ids)
+    return row_ids
+
+# Google Driveへの差分同期で送る表と主キー
+# （著者・キーワードの対応表・全文検索・絞り込み項目の件数は、文献の表からトリガーと_sync_linksで作り直せるため送らない）
+SYNCED_TABLES = {"metadata": "id", "fulltext": "metadata_id"}
+
+# 同期していない変更（変更された行の表とid）を記録する表と、同期の状態を保存する表を作成
+def _ensure_changelog(conn):
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS changelog ("
+        " seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, row_id INTEGER NOT NULL)"
+    )
+    conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    for table, key in SYNCED_TABLES.items():
+        for event_name, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            conn.exec_driver_sql(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_changelog_{event_name.lower()} AFTER {event_name} ON {table} BEGIN"
+                f" INSERT INTO changelog (table_name, row_id) VALUES ('{table}', {row}.{key}); END"
+            )
+
+def get_sync_state(db_file=DB_FILE):
+    with get_engine(db_file).connect() as conn:
+        return dict(conn.exec_driver_sql("SELECT key, value FROM sync_state").fetchall())
+
+def set_sync_state(db_file=DB_FILE, **values):
+    with get_engine(db_file).begin() as conn:
+        conn.exec_driver_sql(
+            "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+            [(key, None if value is None else str(value)) for key, value in values.items()],
+        )
+
+# 同期していない変更を返す（戻り値: 最後の変更の番号, [(表, id, 現在の行の値 または 削除済みならNone)]）
+# 同じ行を何度変更しても、現在の値1つにまとめる
+def pending_changes(db_file=DB_FILE):
+    with get_engine(db_file).connect() as conn:
+        last_seq = conn.exec_driver_sql("SELECT MAX(seq) FROM changelog").scalar()
+        if last_seq is None:
+            return 0, []
+        changes = []
+        for table, key in SYNCED_TABLES.items():
+            row_ids = [row[0] for row in conn.exec_driver_sql(
+                "SELECT DISTINCT row_id FROM changelog WHERE table_name = ? AND seq <= ? ORDER BY row_id", (table, last_seq)
+            )]
+            rows = {}
+            for chunk in _chunks(row_ids):
+                result = conn.exec_driver_sql(
+                    f"SELECT * FROM {table} WHERE {key} IN ({', '.join('?' * len(chunk))})", tuple(chunk)
+                )
+                columns = list(result.keys())
+                for row in result:
+                    values = dict(zip(columns, row))
+                    rows[values[key]] = values
+            changes.extend((table, row_id, rows.get(row_id)) for row_id in row_ids)
+    return last_seq, changes
+
+def has_pending_changes(db_file=DB_FILE):
+    with get_engine(db_file).connect() as conn:
+        return conn.exec_driver_sql("SELECT 1 FROM changelog LIMIT 1").first() is not None
 
-DATABASE_URL = "sqlite:///metadata.db"
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
-SessionLocal = sessionmaker(bind=engine)
+# 同期済みの変更（番号がlast_seq以下）を削除（Noneの場合はすべて削除）
+def clear_changes(db_file=DB_FILE, last_seq=None):
+    with get_engine(db_file).begin() as conn:
+        if last_seq is None:
+            conn.exec_driver_sql("DELETE FROM changelog")
+        else:
+            conn.exec_driver_sql("DELETE FROM changelog WHERE seq <= ?", (int(last_seq),))
 
-def get_session():
-    return SessionLocal()
+# 他の環境での変更（pending_changesの形式）を1つのトランザクションで反映し、反映しなかった行数を返す
+# この環境で同期していない変更がある行は、後からアップロードするこちらの値を優先して反映しない
+# 反映した変更は同期していない変更として記録しない
+def apply_changes(db_file, changes):
+    skipped = 0
+    with get_engine(db_file).begin() as conn:
+        before = conn.exec_driver_sql("SELECT COALESCE(MAX(seq), 0) FROM changelog").scalar()
+        pending = set(conn.exec_driver_sql("SELECT DISTINCT table_name, row_id FROM changelog").fetchall())
+        existing = {
+            table: {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")} for table in SYNCED_TABLES
+        }
+        metadata_ids = []
+        for table, row_id, values in changes:
+            key = SYNCED_TABLES[table]
+            if (table, row_id) in pending:
+                skipped += 1
+                continue
+            if values is None:
+                conn.exec_driver_sql(f"DELETE FROM {table} WHERE {key} = ?", (int(row_id),))
+            else:
+                columns = [c for c in values if c in existing[table]]
+                names = ", ".join(f'"{c}"' for c in columns)
+                placeholders = ", ".join("?" * len(columns))
+                assignments = ", ".join(f'"{c}" = excluded."{c}"' for c in columns if c != key)
+                try:
+                    conn.exec_driver_sql(
+                        f"INSERT INTO {table} ({names}) VALUES ({placeholders}) ON CONFLICT ({key}) DO UPDATE SET {assignments}",
+                        tuple(values[c] for c in columns),
+                    )
+                except exc.IntegrityError:
+                    # 別のidで同じDOIが登録済みの場合など
+                    skipped += 1
+                    continue
+            if table == "metadata":
+                metadata_ids.append(row_id)
+        _sync_links(conn, metadata_ids)
+        conn.exec_driver_sql("DELETE FROM changelog WHERE seq > ?", (before,))
+    return skipped
@@ -0,0 +1,302 @@
+import atexit
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+from database import (DB_FILE, apply_changes, backup_database, clear_changes, dispose_engine, get_sync_state,
+                      has_pending_changes, init_db, pending_changes, set_sync_state)
+
+# データベースのGoogle Driveとの同期
+# Drive上には、データベース全体（スナップショット）と、その後の変更行だけを圧縮したジャーナルを置く
+#   literature_database.db                               スナップショット
+#   literature_database.db.<スナップショットのMD5>.000001.journal  変更のジャーナル（番号順に反映する）
+# 変更はバックグラウンドのスレッドでまとめて送り、ジャーナルが増えたらスナップショットを作り直す（圧縮）
+# 以前のファイル全体のアップロードと同様に、複数の環境から同時に編集することは想定しない
+# （他の環境でスナップショットが作り直された後に同期すると、こちらのデータベース全体で上書きする）
+
+# 最後の変更からアップロードまでの待ち時間（連続した変更を1つのジャーナルにまとめる）と、最初の変更からの上限
+SYNC_DELAY = 5.0
+SYNC_MAX_DELAY = 60.0
+# アップロードに失敗した場合の再試行までの時間
+RETRY_DELAY = 60.0
+# ジャーナルの合計サイズ（スナップショットに対する割合）・数がこれを超えたらスナップショットを作り直す
+# （サイズで作り直す場合、作り直しの転送量は編集あたりに均すとジャーナルの数倍に収まる。数の上限は起動時に反映する件数を抑える）
+COMPACT_JOURNALS = 100
+COMPACT_RATIO = 0.25
+JOURNAL_FORMAT = 1
+JOURNAL_SUFFIX = ".journal"
+
+
+def journal_prefix(db_file, snapshot_md5):
+    return f"{os.path.basename(db_file)}.{snapshot_md5}."
+
+
+def journal_title(db_file, snapshot_md5, number):
+    return f"{journal_prefix(db_file, snapshot_md5)}{number:06d}{JOURNAL_SUFFIX}"
+
+
+# ジャーナルの番号（タイトルの形式が異なる場合はNone）
+def journal_number(db_file, snapshot_md5, title):
+    prefix = journal_prefix(db_file, snapshot_md5)
+    number = title[len(prefix):-len(JOURNAL_SUFFIX)]
+    if not title.startswith(prefix) or not title.endswith(JOURNAL_SUFFIX) or not number.isdigit():
+        return None
+    return int(number)
+
+
+# 変更（pending_changesの形式）をzlibで圧縮したJSONにする（BLOBはBase64で格納）
+def encode_journal(changes):
+    encoded = [
+        [table, row_id, None if values is None else {
+            column: {"$base64": base64.b64encode(value).decode("ascii")} if isinstance(value, bytes) else value
+            for column, value in values.items()
+        }]
+        for table, row_id, values in changes
+    ]
+    data = json.dumps({"format": JOURNAL_FORMAT, "changes": encoded}, ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(data.encode("utf-8"))
+
+
+def decode_journal(data):
+    payload = json.loads(zlib.decompress(data))
+    return [
+        (table, row_id, None if values is None else {
+            column: base64.b64decode(value["$base64"]) if isinstance(value, dict) else value
+            for column, value in values.items()
+        })
+        for table, row_id, values in payload["changes"]
+    ]
+
+
+class DBSync:
+    # thread_drive: 別スレッドで使うGoogleDriveを返す関数（httplib2はスレッドセーフではないため）
+    def __init__(self, db_file, drive, thread_drive=None):
+        self.db_file = db_file
+        self.drive = drive
+        self.thread_drive = thread_drive or (lambda drive: drive)
+        self.last_error = None
+        self.last_synced = None
+        self._snapshot_id = None
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._due = None
+        self._first_change = None
+        self._thread = None
+
+    # Drive上のスナップショット（存在しない場合はNone）
+    # IDを覚えておき、2回目以降はタイトルで検索せずにメタデータ（MD5・サイズ）だけを取得する
+    def _snapshot_file(self, drive):
+        if self._snapshot_id:
+            gfile = drive.CreateFile({'id': self._snapshot_id})
+            try:
+                gfile.FetchMetadata(fields="id,title,md5Checksum,fileSize,labels")
+                if not gfile['labels'].get('trashed'):
+                    return gfile
+            except Exception:
+                pass
+            self._snapshot_id = None
+        title = os.path.basename(self.db_file)
+        file_list = drive.ListFile({'q': f"title='{title}' and trashed=false"}).GetList()
+        if not file_list:
+            return None
+        self._snapshot_id = file_list[0]['id']
+        return file_list[0]
+
+    def _list_journals(self, drive, snapshot_md5):
+        prefix = journal_prefix(self.db_file, snapshot_md5)
+        file_list = drive.ListFile({'q': f"title contains '{prefix}' and trashed=false"}).GetList()
+        journals = [(journal_number(self.db_file, snapshot_md5, gfile['title']), gfile) for gfile in file_list]
+        return sorted((item for item in journals if item[0] is not None), key=lambda item: item[0])
+
+    def _download(self, gfile):
+        fd, temp_path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            gfile.GetContentFile(temp_path)
+            with open(temp_path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(temp_path)
+
+    # 起動時: スナップショットを取得し（ローカルに無い、または同期していない変更が無く古い場合）、未反映のジャーナルを反映する
+    # 戻り値: {"downloaded": スナップショットを取得したか, "journals": 反映したジャーナル数}（Drive上に無い場合はNone）
+    def pull(self):
+        with self._lock:
+            gfile = self._snapshot_file(self.drive)
+            if gfile is None:
+                return None
+            md5 = gfile['md5Checksum']
+
+            downloaded = False
+            if os.path.exists(self.db_file):
+                init_db(self.db_file)
+                state = get_sync_state(self.db_file)
+                stale = state.get("snapshot") != md5 and not has_pending_changes(self.db_file)
+            if not os.path.exists(self.db_file) or stale:
+                data = self._download(gfile)
+                dispose_engine(self.db_file)
+                for path in (self.db_file + "-wal", self.db_file + "-shm"):
+                    if os.path.exists(path):
+                        os.remove(path)
+                with open(self.db_file + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(self.db_file + ".tmp", self.db_file)
+                init_db(self.db_file)
+                # スナップショットに含まれるアップロード元の同期状態は使わない
+                clear_changes(self.db_file)
+                set_sync_state(self.db_file, snapshot=md5, journal=0, journal_bytes=0)
+                downloaded = True
+                state = get_sync_state(self.db_file)
+
+            applied = self._apply_journals(self.drive, md5) if state.get("snapshot") == md5 else 0
+
+        if has_pending_changes(self.db_file):
+            self.schedule()
+        return {"downloaded": downloaded, "journals": applied}
+
+    # スナップショットに続くジャーナルのうち未反映のもの（他の環境での変更）を番号順に反映し、反映した数を返す
+    def _apply_journals(self, drive, snapshot_md5):
+        state = get_sync_state(self.db_file)
+        journal = int(state.get("journal") or 0)
+        journal_bytes = int(state.get("journal_bytes") or 0)
+        applied = 0
+        for number, journal_file in self._list_journals(drive, snapshot_md5):
+            if number <= journal:
+                continue
+            data = self._download(journal_file)
+            apply_changes(self.db_file, decode_journal(data))
+            journal, journal_bytes = number, journal_bytes + len(data)
+            set_sync_state(self.db_file, journal=journal, journal_bytes=journal_bytes)
+            applied += 1
+        return applied
+
+    # 同期を予約する（SYNC_DELAY秒変更が無ければ、最初の予約からSYNC_MAX_DELAY秒で必ず実行）
+    def schedule(self, drive=None, delay=SYNC_DELAY):
+        with self._condition:
+            if drive is not None:
+                self.drive = drive
+            now = time.monotonic()
+            self._first_change = self._first_change or now
+            self._due = min(now + delay, self._first_change + SYNC_MAX_DELAY)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f"db-sync-{self.db_file}", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._due is None or self._due > time.monotonic():
+                    self._condition.wait(None if self._due is None else max(self._due - time.monotonic(), 0))
+                self._due = None
+                self._first_change = None
+            try:
+                self.sync()
+            except Exception as e:
+                self.last_error = e
+                self.schedule(delay=RETRY_DELAY)
+
+    # 予約中の同期をすぐに実行する（終了時など）
+    def flush(self):
+        with self._condition:
+            self._due = None
+            self._first_change = None
+        self.sync()
+
+    def pending(self):
+        return self._due is not None or has_pending_changes(self.db_file)
+
+    # 同期していない変更をジャーナルとしてアップロードする
+    # 先に他の環境のジャーナルを反映し、その次の番号を使う（番号が重なると他の環境で反映されないため）
+    # Drive上のスナップショットが同期元と異なる場合（初回・他の環境で作り直された場合）は、スナップショットを作り直す
+    def sync(self):
+        with self._lock:
+            drive = self.thread_drive(self.drive)
+            gfile = self._snapshot_file(drive)
+            state = get_sync_state(self.db_file)
+            if gfile is None or gfile['md5Checksum'] != state.get("snapshot"):
+                self._compact(drive, gfile, state.get("snapshot"))
+                return
+            if not has_pending_changes(self.db_file):
+                return
+
+            self._apply_journals(drive, state["snapshot"])
+            state = get_sync_state(self.db_file)
+            last_seq, changes = pending_changes(self.db_file)
+            data = encode_journal(changes)
+            number = int(state.get("journal") or 0) + 1
+            self._upload(drive.CreateFile({'title': journal_title(self.db_file, state["snapshot"], number)}), data)
+            journal_bytes = int(state.get("journal_bytes") or 0) + len(data)
+            clear_changes(self.db_file, last_seq)
+            set_sync_state(self.db_file, journal=number, journal_bytes=journal_bytes)
+            self.last_synced = time.time()
+            self.last_error = None
+
+            if number >= COMPACT_JOURNALS or journal_bytes > COMPACT_RATIO * int(gfile.get('fileSize') or 0):
+                self._compact(drive, gfile, state["snapshot"])
+
+    def _upload(self, gfile, data):
+        fd, temp_path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            gfile.SetContentFile(temp_path)
+            gfile.Upload()
+        finally:
+            os.remove(temp_path)
+
+    # データベース全体をスナップショットとしてアップロードし、古いスナップショットのジャーナルを削除する
+    def _compact(self, drive, gfile, previous_md5):
+        stale_md5s = {previous_md5, gfile['md5Checksum'] if gfile is not None else None} - {None}
+        last_seq = pending_changes(self.db_file)[0]
+        fd, temp_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            os.remove(temp_path)
+            backup_database(self.db_file, temp_path)  # WALに残っている変更も含める
+            if gfile is None:
+                gfile = drive.CreateFile({'title': os.path.basename(self.db_file)})
+            gfile.SetContentFile(temp_path)
+            gfile.Upload()
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._snapshot_id = gfile['id']
+        clear_changes(self.db_file, last_seq)
+        set_sync_state(self.db_file, snapshot=gfile['md5Checksum'], journal=0, journal_bytes=0)
+        self.last_synced = time.time()
+        self.last_error = None
+
+        for md5 in stale_md5s:
+            for _, journal_file in self._list_journals(drive, md5):
+                journal_file.Delete()
+
+
+# データベースファイルごとにプロセス全体で1つの同期処理を共有する
+_syncs = {}
+_syncs_lock = threading.Lock()
+
+
+def get_db_sync(db_file=DB_FILE, drive=None, thread_drive=None):
+    with _syncs_lock:
+        sync = _syncs.get(db_file)
+        if sync is None:
+            sync = _syncs[db_file] = DBSync(db_file, drive, thread_drive)
+        elif drive is not None:
+            sync.drive = drive
+        return sync
+
+
+# 終了時に、予約中の同期を実行する
+@atexit.register
+def _flush_all():
+    for sync in list(_syncs.values()):
+        try:
+            if sync.pending():
+                sync.flush()
+        except Exception:
+            pass
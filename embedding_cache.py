@@ -0,0 +1,141 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+# チャンクの埋め込みを (埋め込みモデル, テキストのハッシュ) をキーとしてSQLiteに保存するキャッシュ
+# 同じテキストのチャンクは、再インデックス化やチャンク設定の変更後も埋め込みAPIを呼び出さない
+EMBEDDING_CACHE_FILE = "embedding_cache.db"
+# SQLiteのIN句に渡すキーの最大数
+LOOKUP_BATCH = 500
+# 質問の埋め込みのキーに付ける接頭辞（チャンクの埋め込みと区別する）
+QUERY_KEY_PREFIX = "query:"
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path=EMBEDDING_CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.commit()
+
+    # キャッシュ済みの埋め込みを {ハッシュ: ベクトル} で返す
+    def get_many(self, model, hashes):
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for start in range(0, len(unique), LOOKUP_BATCH):
+                batch = unique[start:start + LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model, key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items],
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbedding(BaseEmbedding):
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+    _stats_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, inner, cache, **kwargs):
+        # バッチ分割は内側のモデルに任せる（キャッシュの照会はまとめて行う）
+        kwargs.setdefault("embed_batch_size", 2048)
+        super().__init__(model_name=inner.model_name, **kwargs)
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls):
+        return "CachedEmbedding"
+
+    # ヒット率などの集計値
+    def stats(self):
+        total = self._hits + self._misses
+        return {"hits": self._hits, "misses": self._misses, "hit_rate": self._hits / total if total else 0.0}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._hits = 0
+            self._misses = 0
+
+    # 質問の埋め込みもキャッシュする（同じ質問の繰り返しでは埋め込みAPIを呼び出さない）
+    def _get_query_embedding(self, query):
+        key = text_hash(QUERY_KEY_PREFIX + query)
+        cached = self._cache.get_many(self.model_name, [key])
+        if key in cached:
+            return cached[key]
+        embedding = self._inner.get_query_embedding(query)
+        self._cache.put_many(self.model_name, [(key, embedding)])
+        return embedding
+
+    # 非同期の検索でも同じキャッシュを使う（SQLiteの照会・保存は短いため同期的に行う）
+    async def _aget_query_embedding(self, query):
+        key = text_hash(QUERY_KEY_PREFIX + query)
+        cached = self._cache.get_many(self.model_name, [key])
+        if key in cached:
+            return cached[key]
+        embedding = await self._inner.aget_query_embedding(query)
+        self._cache.put_many(self.model_name, [(key, embedding)])
+        return embedding
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    # キャッシュに無いテキストだけを埋め込みAPIに渡す
+    def _get_text_embeddings(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        cached = self._cache.get_many(self.model_name, hashes)
+
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self._inner.get_text_embedding_batch(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._cache.put_many(self.model_name, new_items)
+            cached.update(new_items)
+
+        with self._stats_lock:
+            self._misses += len(missing)
+            self._hits += len(texts) - len(missing)
+        return [cached[key] for key in hashes]
+
+
+# 保存先ディレクトリを作成してキャッシュを開く
+def open_embedding_cache(path=EMBEDDING_CACHE_FILE):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return EmbeddingCache(path)
@@ -0,0 +1,137 @@
+import re
+import math
+import zlib
+from collections import Counter
+
+import numpy as np
+
+# 長文の論文をLLMに渡す前に、重要な文だけを抽出して圧縮する（TextRank）
+# 日本語は文字bigram、英語は単語を特徴量としたTF-IDFベクトルで文間の類似度を計算する
+# （語彙は固定次元にハッシュし、文数×語彙数の行列を作らない）
+
+# 文分割のパターン（日本語の句点と英語の文末記号）
+sentence_pattern = re.compile(r'(?<=[。．！？])|(?<=[.!?])\s+(?=[A-Z0-9"(\u3000-\u9FFF])')
+# 英単語とCJK文字列の抽出パターン
+word_pattern = re.compile(r'[A-Za-z][A-Za-z0-9\-]+|[0-9]+(?:\.[0-9]+)?')
+cjk_pattern = re.compile(r'[\u3040-\u30FF\u3400-\u9FFF]+')
+# 短すぎる文（ページ番号や見出しの断片）は候補から除外
+MIN_SENTENCE_CHARS = 10
+# 類似度行列のサイズを抑えるため、これを超える文数は区間ごとにランキングする
+MAX_GRAPH_SENTENCES = 2000
+# 特徴量の次元数（語彙をこの次元にハッシュする。区間あたりの行列は MAX_GRAPH_SENTENCES×HASH_FEATURES の float32 で約32MB）
+HASH_FEATURES = 4096
+
+
+# テキストを文に分割
+def split_sentences(text):
+    sentences = [s.strip() for s in sentence_pattern.split(text)]
+    return [s for s in sentences if len(s) >= MIN_SENTENCE_CHARS]
+
+
+# 文をトークン列に変換（英語は小文字化した単語、日本語は文字bigram）
+def tokenize_sentence(sentence):
+    tokens = [w.lower() for w in word_pattern.findall(sentence)]
+    for run in cjk_pattern.findall(sentence):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+# 文ごとのTF-IDFベクトル（トークンをHASH_FEATURES次元にハッシュ、L2正規化済み）を作成
+def tfidf_matrix(sentences):
+    rows, columns, values = [], [], []
+    for row, sentence in enumerate(sentences):
+        for token, tf in Counter(tokenize_sentence(sentence)).items():
+            rows.append(row)
+            columns.append(zlib.crc32(token.encode("utf-8")) % HASH_FEATURES)
+            values.append(1.0 + math.log(tf))
+
+    # 同じ次元に衝突したトークンは重みを加算する
+    matrix = np.zeros((len(sentences), HASH_FEATURES), dtype=np.float32)
+    np.add.at(matrix, (np.array(rows, dtype=np.intp), np.array(columns, dtype=np.intp)), np.array(values, dtype=np.float32))
+
+    document_frequency = np.count_nonzero(matrix, axis=0)
+    idf = np.log((1 + len(sentences)) / (1 + document_frequency)) + 1.0
+    matrix *= idf.astype(np.float32)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# 類似度グラフ上のPageRankで各文の中心性スコアを計算
+def textrank_scores(matrix, damping=0.85, max_iter=100, tol=1e-6):
+    n = matrix.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    similarity = matrix @ matrix.T
+    np.fill_diagonal(similarity, 0.0)
+    np.clip(similarity, 0.0, None, out=similarity)
+
+    # 行ごとに正規化して遷移確率にする（孤立した文は一様に遷移）
+    row_sums = similarity.sum(axis=1, keepdims=True)
+    transition = np.where(row_sums > 0, similarity / np.where(row_sums > 0, row_sums, 1.0), 1.0 / n)
+
+    scores = np.full(n, 1.0 / n, dtype=np.float32)
+    for _ in range(max_iter):
+        updated = (1 - damping) / n + damping * (transition.T @ scores)
+        if np.abs(updated - scores).sum() < tol:
+            scores = updated
+            break
+        scores = updated
+    return scores
+
+
+# 中心性の高い文をトークン予算内で選び、元の順序で連結して返す
+def extract_central_sentences(text, token_budget, count_tokens):
+    sentences = split_sentences(text)
+    if not sentences:
+        return text
+
+    # 文数が多い場合は連続した区間に分け、文数に比例した予算で区間ごとに選択
+    segment_count = math.ceil(len(sentences) / MAX_GRAPH_SENTENCES)
+    segment_size = math.ceil(len(sentences) / segment_count)
+    selected = []
+    for start in range(0, len(sentences), segment_size):
+        segment = sentences[start:start + segment_size]
+        segment_budget = token_budget * len(segment) / len(sentences)
+        scores = textrank_scores(tfidf_matrix(segment))
+        used_tokens = 0
+        for index in np.argsort(-scores, kind="stable"):
+            sentence_tokens = count_tokens(segment[index])
+            if used_tokens + sentence_tokens > segment_budget:
+                continue
+            selected.append(start + index)
+            used_tokens += sentence_tokens
+
+    # どの文も予算を超える場合は、先頭から予算内に切り詰める
+    if not selected:
+        return truncate_to_budget(text, token_budget, count_tokens)
+    return " ".join(sentences[i] for i in sorted(selected))
+
+
+# テキストを先頭からトークン予算内に切り詰める（トークン数は文字数に対してほぼ単調なので、二分探索で長さを決める）
+def truncate_to_budget(text, token_budget, count_tokens):
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= token_budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+# 文書長の段階設定に従って、必要な場合のみ抽出による圧縮を行う
+# tiers: (この段階の最大トークン数, LLMに渡すトークン予算 or None) のリスト（昇順）
+def compress_for_summary(text, tiers, count_tokens):
+    total_tokens = count_tokens(text)
+    for max_tokens, token_budget in tiers:
+        if total_tokens <= max_tokens:
+            if token_budget is None or total_tokens <= token_budget:
+                return text
+            return extract_central_sentences(text, token_budget, count_tokens)
+    return text
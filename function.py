@@ -14,10 +14,11 @@ import time
 import requests
 from langdetect import detect
 from bs4 import BeautifulSoup
-from sqlalchemy import Column, Integer, String, Boolean, create_engine
+from sqlalchemy import Column, Integer, String, Boolean, create_engine, func
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-from database import get_session, Metadata
+from database import get_session, Metadata, get_db_version, load_fulltext, load_metadata_df, store_fulltext
+from db_sync import get_db_sync
 
 from openai import OpenAI
 from llama_index.core import download_loader, VectorStoreIndex, Settings, SimpleDirectoryReader,Document
@@ -30,6 +31,23 @@ import uuid
 import hashlib
 from difflib import SequenceMatcher
 
+from extractive import compress_for_summary
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import threading
+
+# 要約設定（モデルやプロンプト・前処理を変更した場合はバージョンを上げる）
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_PROMPT_VERSION = "2"
+SUMMARY_FAILED = "要約に失敗しました。"
+# 文書長ごとの抽出圧縮の設定: (この段階の最大トークン数, LLMに渡すトークン予算)
+# 予算がNoneの段階は全文をそのまま要約する（~10ページ程度の論文）
+SUMMARY_LENGTH_TIERS = [
+    (12000, None),
+    (40000, 10000),
+    (float("inf"), 12000),
+]
+
 # PDFからの１~２ページのテキスト抽出（llama_index使用）
 def extract_text_from_pdf_pages(pdf_path):
     #PDFファイル読込
@@ -52,6 +70,10 @@ def pdf_to_text_with_ocr_per_page_multi_lang(pdf_path):
 
 # PDFからテキストを抽出し、Documentオブジェクトを生成
 def extract_text_from_pdf(pdf_path):
+    return extract_pdf_text(pdf_path)[0]
+
+# PDFからテキストを抽出し、(Documentのリスト, OCRで抽出したか) を返す
+def extract_pdf_text(pdf_path):
     # SimpleDirectoryReaderで既存のドキュメントを読み込む
     reader = SimpleDirectoryReader(input_files=[pdf_path])
     documents = reader.load_data()
@@ -85,7 +107,41 @@ def extract_text_from_pdf(pdf_path):
         # 新しいOCR結果をdocumentsに追加
         documents.extend(new_documents)
 
-    return documents
+    return documents, perform_ocr
+
+# Documentのリストを保存用の [(ページラベル, テキスト)] に変換
+def documents_to_pages(documents):
+    return [(doc.metadata.get("page_label", str(i)), doc.text) for i, doc in enumerate(documents, start=1)]
+
+# 保存した [(ページラベル, テキスト)] からDocumentのリストを復元
+# （ファイル名は抽出時と同じく埋め込み・LLMに渡すメタデータから除外する）
+def pages_to_documents(pages, file_name=""):
+    return [
+        Document(
+            text=text,
+            metadata={"page_label": label, "file_name": file_name},
+            excluded_embed_metadata_keys=["file_name"],
+            excluded_llm_metadata_keys=["file_name"],
+        )
+        for label, text in pages
+    ]
+
+# 文献の抽出テキストをデータベースから読み込み、未保存またはPDFが更新されている場合だけ
+# Google DriveからPDFをダウンロードして抽出し、保存する。戻り値: (Documentのリスト, PDFのMD5)
+def load_or_extract_text(drive, db_file, record_id, file_id, drive_md5=None):
+    drive_md5 = drive_md5 or get_drive_md5(drive, file_id)
+    stored = load_fulltext(db_file, record_id, drive_md5) if drive_md5 else None
+    if stored is not None:
+        return pages_to_documents(stored["pages"]), drive_md5
+
+    pdf_file_path = download_file(drive, file_id)
+    try:
+        documents, ocr = extract_pdf_text(pdf_file_path)
+        pdf_md5 = compute_file_md5(pdf_file_path)
+    finally:
+        os.remove(pdf_file_path)
+    store_fulltext(db_file, record_id, pdf_md5, documents_to_pages(documents), ocr)
+    return documents, pdf_md5
 
 #　抽出したテキストからDOI抽出
 # DOIの正規表現パターン
@@ -104,8 +160,8 @@ def process_pdf(pdf_path):
     first_doi = extract_doi(combined_text)
     return first_doi,first_text
 
-# DOIから情報を抽出
-def get_metadata_from_doi(doi):
+# DOIから情報を抽出（warn: APIのエラーを表示する関数。別スレッドから呼ぶ場合は表示以外の関数を渡す）
+def get_metadata_from_doi(doi, warn=st.warning):
     result = {}
 
     # DOIを格納
@@ -130,7 +186,7 @@ def get_metadata_from_doi(doi):
             result['開始ページ'] = crossref_meta.get('page', 'Not found').split('-')[0] if 'page' in crossref_meta else 'Not found'
             result['終了ページ'] = crossref_meta.get('page', 'Not found').split('-')[-1] if 'page' in crossref_meta else 'Not found'
     except requests.RequestException as e:
-        st.warning(f"Crossref API error: {e}")
+        warn(f"Crossref API error: {e}")
 
     # JALC REST APIを利用
     jalc_url = f"https://api.japanlinkcenter.org/dois/{doi}"
@@ -169,7 +225,7 @@ def get_metadata_from_doi(doi):
             result['終了ページ'] = data.get('last_page', 'Not found')
 
     except requests.RequestException as e:
-        st.warning(f"JALC API error: {e}")
+        warn(f"JALC API error: {e}")
 
     # メタデータが見つからなかった場合のメッセージ
     if not result:
@@ -177,40 +233,27 @@ def get_metadata_from_doi(doi):
 
     return result
 
-# Google DriveにSQLiteデータベースをアップロード
-def upload_db_to_google_drive(DB_FILE,drive):
-    # Google Drive上のファイルを検索
-    file_list = drive.ListFile({'q': f"title='{DB_FILE}' and trashed=false"}).GetList()
-    if file_list:
-        gfile = file_list[0]  # 最初のファイルを取得
-    else:
-        gfile = drive.CreateFile({"title": DB_FILE})
+# 全文献のデータフレーム（必要なページで初めて読み込み、セッション状態に保持する。データベースの版が変わったときだけ読み直す）
+def get_metadata_df(DB_FILE):
+    version = get_db_version(DB_FILE)
+    if "df" not in st.session_state or st.session_state.get("df_version") != version:
+        st.session_state["df"] = load_metadata_df(DB_FILE)
+        st.session_state["df_version"] = version
+    return st.session_state["df"]
 
-    temp_db_path = f"/tmp/{DB_FILE}"
-    shutil.copy(DB_FILE, temp_db_path)  # 一時ファイルにコピー
-
-    gfile.SetContentFile(temp_db_path)
-    try:
-        gfile.Upload()
-        st.success(f"{DB_FILE} をGoogle Driveにアップロードしました。")
-    except Exception as e:
-        st.error(f"データベースアップロードに失敗しました: {e}")
-        return None
-
-    os.remove(temp_db_path)  # 一時ファイルを削除
-
-    return f"https://drive.google.com/uc?id={gfile['id']}"
+# データベースの変更をGoogle Driveに同期する
+# ファイル全体ではなく変更した行だけを、バックグラウンドで数秒分まとめてアップロードする（db_sync.py）
+def upload_db_to_google_drive(DB_FILE,drive):
+    get_db_sync(DB_FILE, drive, thread_local_drive).schedule()
+    st.toast("変更をGoogle Driveに同期します。")
 
 def sanitize_filename(filename):
     """ファイル名から不適切な文字を削除"""
     return re.sub(r'[\/:*?"<>|]', '', filename)
 
 def store_metadata_in_db(DB_FILE, metadata, file_path, uploaded_file, drive):
-    # セッションを作成
-    DATABASE_URL = f"sqlite:///{DB_FILE}"
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(bind=engine)
-    session = SessionLocal()
+    # セッションを作成（プロセス全体で共有するエンジンを使う）
+    session = get_session(DB_FILE)
 
     # カテゴリ，キーワード読み込み
     categories_all = st.session_state["categories_all"]
@@ -218,7 +261,7 @@ def store_metadata_in_db(DB_FILE, metadata, file_path, uploaded_file, drive):
 
     try:
         # DOIがすでに存在するか確認
-        existing_record = session.query(Metadata).filter_by(doi=metadata['doi']).first()
+        existing_record = session.query(Metadata).filter(func.lower(Metadata.doi) == metadata['doi'].lower()).first()
 
         if existing_record:
             st.warning("This DOI is already in the database.")
@@ -297,23 +340,22 @@ def store_metadata_in_db(DB_FILE, metadata, file_path, uploaded_file, drive):
 
 
 def store_metadata_in_db_ai(DB_FILE, metadata, file_path, uploaded_file, drive):
-    # セッションを作成
-    DATABASE_URL = f"sqlite:///{DB_FILE}"
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(bind=engine)
-    session = SessionLocal()
+    # セッションを作成（プロセス全体で共有するエンジンを使う）
+    session = get_session(DB_FILE)
 
     # カテゴリ，キーワード読み込み
     categories_all = st.session_state["categories_all"]
     keywords_all = st.session_state["keywords_all"]
 
+    upload_future = None
+    record_added = False
     try:
         if not metadata or 'doi' not in metadata:
             st.warning("メタデータが取得できていません。リトライしてください。")
             return  # 早期リターン
 
         # DOIがすでに存在するか確認
-        existing_record = session.query(Metadata).filter_by(doi=metadata['doi']).first()
+        existing_record = session.query(Metadata).filter(func.lower(Metadata.doi) == metadata['doi'].lower()).first()
         if existing_record:
             st.warning("This DOI is already in the database.")
             return
@@ -323,12 +365,17 @@ def store_metadata_in_db_ai(DB_FILE, metadata, file_path, uploaded_file, drive):
         sanitized_title = sanitize_filename(title)
         new_filename = f"{sanitized_title}.pdf"
 
+        # Google DriveへのPDFアップロードは要約と並行してバックグラウンドで実行
+        upload_executor = ThreadPoolExecutor(max_workers=1)
+        upload_future = upload_executor.submit(run_with_script_ctx(upload_to_google_drive), drive, file_path, new_filename)
+        upload_executor.shutdown(wait=False)
+
         # PDFファイルからすべてのテキストを抽出
-        content = extract_text_from_pdf(file_path)
+        content, ocr = extract_pdf_text(file_path)
+        pdf_md5 = compute_file_md5(file_path)
 
-        # 抽出したテキストから，要約とキーワードとカテゴリを取得
-        summary, keyword_res, category_res = translate_and_summarize(content)
-        st.write(summary)
+        # 抽出したテキストから，要約とキーワードとカテゴリを取得（要約は逐次表示）
+        summary, keyword_res, category_res = translate_and_summarize(content, stream_container=st.container())
 
         # キーワードを文字列に変換
         keywords_str = ','.join(keyword_res)
@@ -336,8 +383,8 @@ def store_metadata_in_db_ai(DB_FILE, metadata, file_path, uploaded_file, drive):
         # DOI URLを生成
         doi_url = f"https://doi.org/{metadata['doi']}"
 
-        # Google DriveにPDFをアップロード
-        file_link = upload_to_google_drive(drive, file_path, new_filename)
+        # PDFアップロードの完了を待つ
+        file_link = upload_future.result()
         if not file_link:
             st.error("Google Driveへのアップロードに失敗しました。")
             return
@@ -358,12 +405,19 @@ def store_metadata_in_db_ai(DB_FILE, metadata, file_path, uploaded_file, drive):
             ファイルリンク=file_link,
             キーワード=keywords_str,
             カテゴリ=category_res,
-            Read=False
+            Read=False,
+            text_hash=compute_text_hash(content),
+            pdf_md5=pdf_md5,
+            summary_model=SUMMARY_MODEL if summary != SUMMARY_FAILED else None,
+            summary_prompt_version=SUMMARY_PROMPT_VERSION if summary != SUMMARY_FAILED else None
         )
 
         # データベースに追加
         session.add(new_record)
         session.commit()
+        record_added = True
+        # 抽出テキストを保存（要約の再作成やインデックス化でPDFを再ダウンロード・再抽出しないため）
+        store_fulltext(DB_FILE, new_record.id, pdf_md5, documents_to_pages(content), ocr)
         st.success("New record added to the database.")
 
         # データベースをGoogle Driveにアップロード
@@ -375,9 +429,26 @@ def store_metadata_in_db_ai(DB_FILE, metadata, file_path, uploaded_file, drive):
         st.warning(f"An error occurred: {e}")
         session.rollback()
     finally:
+        # 途中で失敗した場合も、PDFのアップロードの終了を待ってから戻る（呼び出し元が一時ファイルを削除するため）
+        if upload_future is not None and not record_added:
+            discard_uploaded_pdf(session, drive, upload_future)
         session.close()
 
 
+# 文献を追加できなかった場合に、アップロードしたPDFをGoogle Driveのゴミ箱に移動する
+# （同名のファイルを上書きしていて、他の文献が参照している場合は残す）
+def discard_uploaded_pdf(session, drive, upload_future):
+    if upload_future.cancel():
+        return
+    try:
+        file_link = upload_future.result()
+        if not file_link or session.query(Metadata).filter(Metadata.ファイルリンク == file_link).first() is not None:
+            return
+        drive.CreateFile({'id': file_link.split("id=")[-1]}).Trash()
+    except Exception as e:
+        st.warning(f"アップロードしたPDFの削除中にエラーが発生しました: {e}")
+
+
 
 ## doiから情報を抽出する関数
 def display_metadata(doi):
@@ -525,7 +596,73 @@ def get_abstract_from_url(url):
         return None
     
 
-def translate_and_summarize(text):
+# 抽出したテキスト全体のハッシュ値（SHA-256）を計算
+def compute_text_hash(documents):
+    text = "\n".join(doc.text for doc in documents)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# ファイルのMD5を計算（Google Driveのmd5Checksumと同じ値になる）
+def compute_file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+# Google Drive上のファイルのMD5をダウンロードせずに取得
+def get_drive_md5(drive, file_id):
+    gfile = drive.CreateFile({'id': file_id})
+    gfile.FetchMetadata(fields='md5Checksum')
+    return gfile.get('md5Checksum')
+
+# 既存の要約が現在のモデル・プロンプト設定で作成されたものか判定
+def is_summary_current(row):
+    summary = row.get("要約")
+    if not isinstance(summary, str) or not summary or summary == SUMMARY_FAILED:
+        return False
+    return row.get("summary_model") == SUMMARY_MODEL and row.get("summary_prompt_version") == SUMMARY_PROMPT_VERSION
+
+# チャット補完を1回実行してテキストを返す
+def complete_chat(client, model_name, prompt):
+    response = client.chat.completions.create(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return response.choices[0].message.content.strip()
+
+# チャット補完をストリーミングで実行し、プレースホルダーに逐次表示してテキストを返す
+def stream_chat_completion(client, model_name, prompt, placeholder=None, metrics=None):
+    stream = client.chat.completions.create(
+        model=model_name,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+    text = ""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if not delta:
+            continue
+        # 最初のトークンが届いた時刻を記録
+        if metrics is not None and "first_output" not in metrics:
+            metrics["first_output"] = time.perf_counter() - metrics["start"]
+        text += delta
+        if placeholder is not None:
+            placeholder.markdown(text + "▌")
+    if placeholder is not None:
+        placeholder.markdown(text)
+    return text.strip()
+
+# 要約処理の計測値（最初の出力までの時間・全体時間）をセッションに記録
+def record_summary_metrics(metrics):
+    history = st.session_state.setdefault("summary_metrics", [])
+    history.append(metrics)
+    first_output = metrics.get("first_output")
+    if first_output is not None:
+        st.caption(f"最初の出力まで {first_output:.1f} 秒 / 要約完了まで {metrics['summary']:.1f} 秒 / 全体 {metrics['total']:.1f} 秒")
+
+def translate_and_summarize(text, stream_container=None):
     # カテゴリとキーワードをセッションから取得
     categories_all = st.session_state["categories_all"]
     keywords_all = st.session_state["keywords_all"]
@@ -535,17 +672,25 @@ def translate_and_summarize(text):
     client = OpenAI(api_key=openai_api_key)
 
     # トークン制限設定
-    model_name = "gpt-4o-mini"
+    model_name = SUMMARY_MODEL
     token_limit = 4000  # モデルの最大トークン数
     encoding = tiktoken.encoding_for_model(model_name)
 
-    # テキストの前処理
-    if not isinstance(text, str):
+    # 計測開始
+    metrics = {"start": time.perf_counter()}
+
+    # テキストの前処理（Documentのリストの場合は本文のみを連結）
+    if isinstance(text, list):
+        text = "\n".join(getattr(doc, "text", str(doc)) for doc in text)
+    elif not isinstance(text, str):
         text = str(text)
 
     text = re.sub(r'[\r\n\t]+', ' ', text)  # 改行・タブをスペースに置換
     text = re.sub(r'[^\x20-\x7E\u3000-\u9FFF]+', '', text)  # 特殊文字を除去
 
+    # 長文はローカルで中心的な文を抽出し、文書長によらずLLMへの入力量を抑える
+    text = compress_for_summary(text, SUMMARY_LENGTH_TIERS, lambda s: len(encoding.encode(s)))
+
     # テキスト分割関数
     def split_text(text, max_tokens):
         tokens = encoding.encode(text)
@@ -563,64 +708,71 @@ def translate_and_summarize(text):
         text_chunks = [text]
         multi_chunk = False
 
+    # 表示先の準備（stream_containerが指定された場合のみ逐次表示）
+    chunk_area = None
+    summary_placeholder = None
+    if stream_container is not None:
+        if multi_chunk:
+            chunk_area = stream_container.expander(f"部分要約 ({len(text_chunks)}チャンク)", expanded=True)
+        stream_container.markdown("##### 要約")
+        summary_placeholder = stream_container.empty()
+
     # 要約処理
     summaries = []
     try:
-        for chunk in text_chunks:
+        for i, chunk in enumerate(text_chunks, start=1):
             prompt = f"次の文章を日本語で簡潔に要約してください:\n\n{chunk}"
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            summaries.append(response.choices[0].message.content.strip())
+            if chunk_area is not None:
+                chunk_area.markdown(f"**チャンク {i}/{len(text_chunks)}**")
+                placeholder = chunk_area.empty()
+            else:
+                placeholder = summary_placeholder
+            summaries.append(stream_chat_completion(client, model_name, prompt, placeholder, metrics))
 
         # 段階要約処理
         if multi_chunk:
             final_prompt = "以下の複数の要約をもとに、全体を通した簡潔な要約を作成してください:\n\n" + " ".join(summaries)
-            final_response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": final_prompt}]
-            )
-            summary = final_response.choices[0].message.content.strip()
+            summary = stream_chat_completion(client, model_name, final_prompt, summary_placeholder, metrics)
         else:
             summary = summaries[0]
 
     except Exception as e:
         st.error(f"要約中にエラーが発生しました: {e}")
-        summary = "要約に失敗しました。"
+        summary = SUMMARY_FAILED
+    metrics["summary"] = time.perf_counter() - metrics["start"]
+
+    # キーワード抽出とカテゴリ選択は互いに独立しているため並行して実行
+    keyword_prompt = (
+        f"次の要約に関連するキーワードを、以下のキーワードリストを参考にしてカンマ区切りで出力してください:\n"
+        f"要約: {summary}\n\n"
+        f"キーワードリスト: {', '.join(keywords_all)}"
+    )
+    category_prompt = (
+        f"以下のカテゴリリストから、この要約に最も関連する語句を一つ選んで出力してください:\n"
+        f"要約: {summary}\n\n"
+        f"カテゴリ: {', '.join(categories_all)}"
+    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        keyword_future = executor.submit(complete_chat, client, model_name, keyword_prompt)
+        category_future = executor.submit(complete_chat, client, model_name, category_prompt)
 
     # キーワード抽出
     try:
-        keyword_prompt = (
-            f"次の要約に関連するキーワードを、以下のキーワードリストを参考にしてカンマ区切りで出力してください:\n"
-            f"要約: {summary}\n\n"
-            f"キーワードリスト: {', '.join(keywords_all)}"
-        )
-        keyword_response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": keyword_prompt}]
-        )
-        keyword_res = [kw.strip() for kw in keyword_response.choices[0].message.content.strip().split("、")]
+        keyword_res = [kw.strip() for kw in keyword_future.result().split("、")]
     except Exception as e:
         st.error(f"キーワード抽出中にエラーが発生しました: {e}")
         keyword_res = []
 
     # カテゴリ選択
     try:
-        category_prompt = (
-            f"以下のカテゴリリストから、この要約に最も関連する語句を一つ選んで出力してください:\n"
-            f"要約: {summary}\n\n"
-            f"カテゴリ: {', '.join(categories_all)}"
-        )
-        category_response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": category_prompt}]
-        )
-        category_res = category_response.choices[0].message.content.strip()
+        category_res = category_future.result()
     except Exception as e:
         st.error(f"カテゴリ選択中にエラーが発生しました: {e}")
         category_res = "カテゴリ選択に失敗しました。"
 
+    metrics["total"] = time.perf_counter() - metrics["start"]
+    record_summary_metrics(metrics)
+
     return summary, keyword_res, category_res
 
 def upload_to_google_drive(drive, file_path, filename):
@@ -647,6 +799,14 @@ def upload_to_google_drive(drive, file_path, filename):
         st.error(f"アップロード失敗: {e}")
         return None
 
+# 別スレッドからもStreamlitの表示関数を呼べるよう、実行中スクリプトのコンテキストを引き継ぐ
+def run_with_script_ctx(func):
+    ctx = get_script_run_ctx()
+    def wrapper(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args, **kwargs)
+    return wrapper
+
 # PDFアップロード処理を共通化
 def handle_pdf_upload(uploaded_file, auto_doi=False, manual_doi=None):
     try:
@@ -700,6 +860,16 @@ def create_temp_file(uploaded_file):
         st.error(f"一時ファイル作成エラー: {e}")
         return None, None
     
+# スレッドごとに認証済みのGoogleDriveを作成（httplib2はスレッドセーフではないため）
+_thread_drives = threading.local()
+def thread_local_drive(drive):
+    if getattr(_thread_drives, "drive", None) is None:
+        gauth = GoogleAuth()
+        gauth.credentials = drive.auth.credentials
+        gauth.Authorize()
+        _thread_drives.drive = GoogleDrive(gauth)
+    return _thread_drives.drive
+
 # PDFファイルをダウンロードする関数
 def download_file(drive, file_id):
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")  # 一時ファイルを作成
@@ -0,0 +1,107 @@
+import numpy as np
+
+# 近似最近傍探索用の転置ファイルインデックス（IVF）
+# 正規化済みベクトルを球面k-meansでクラスタに分け、検索時はクエリに近いnprobe個のクラスタだけを走査する
+# nprobeを大きくすると再現率が上がり、小さくすると高速になる
+
+# k-meansの学習に使う最大サンプル数と反復回数
+TRAIN_SAMPLE_ROWS = 50000
+TRAIN_ITERATIONS = 10
+# 学習時の件数からこの倍数まで増えたら、次回保存時にクラスタを学習し直す
+RETRAIN_GROWTH = 4.0
+# 計算量を抑えるため、この行数ごとに最近傍クラスタを求める
+ASSIGN_BLOCK_ROWS = 65536
+
+
+# 件数に応じたクラスタ数（おおよそ 4*sqrt(N)）
+def default_list_count(rows):
+    return int(max(1, min(rows // 39, 4 * np.sqrt(rows))))
+
+
+class IVFIndex:
+    def __init__(self, centroids, assignments, trained_rows):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.trained_rows = trained_rows
+
+    # 行列の行を球面k-meansでクラスタリングしてインデックスを作成
+    @classmethod
+    def train(cls, matrix, rows, n_lists=None, seed=0):
+        rows = np.asarray(rows)
+        rng = np.random.default_rng(seed)
+        sample_rows = rows if len(rows) <= TRAIN_SAMPLE_ROWS else rng.choice(rows, TRAIN_SAMPLE_ROWS, replace=False)
+        sample = np.asarray(matrix[np.sort(sample_rows)], dtype=np.float32)
+        n_lists = min(n_lists or default_list_count(len(rows)), len(sample))
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(TRAIN_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            # 空のクラスタはランダムなサンプルで置き換える
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+
+        index = cls(centroids, np.full(matrix.shape[0], -1, dtype=np.int32), len(rows))
+        index.add(matrix, rows)
+        return index
+
+    # 行を最も近いクラスタに割り当てる（学習後に追加された行も同様）
+    def add(self, matrix, rows):
+        rows = np.asarray(rows)
+        if len(rows) == 0:
+            return
+        required = int(rows.max()) + 1
+        if required > len(self.assignments):
+            grown = np.full(max(required, len(self.assignments) * 2), -1, dtype=np.int32)
+            grown[:len(self.assignments)] = self.assignments
+            self.assignments = grown
+        for start in range(0, len(rows), ASSIGN_BLOCK_ROWS):
+            block_rows = rows[start:start + ASSIGN_BLOCK_ROWS]
+            vectors = np.asarray(matrix[block_rows], dtype=np.float32)
+            self.assignments[block_rows] = np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def remove(self, rows):
+        self.assignments[np.asarray(rows)] = -1
+
+    # 学習し直すべき件数まで増えたか
+    def needs_retrain(self, rows):
+        return rows > self.trained_rows * RETRAIN_GROWTH
+
+    # クエリに近いnprobe個のクラスタに属する行を返す
+    def candidates(self, query_vector, nprobe, size):
+        nprobe = min(nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query_vector
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.flatnonzero(np.isin(self.assignments[:size], probes))
+
+    # 削除済みの行を詰めた後の行番号に合わせて保存
+    def save(self, path, rows):
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments[rows], trained_rows=self.trained_rows)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["assignments"].copy(), int(data["trained_rows"]))
+
+
+# 厳密検索（全件の内積 + argpartition）
+def exact_top_k(matrix, query_vector, top_k):
+    scores = np.asarray(matrix, dtype=np.float32) @ query_vector
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    return top[np.argsort(-scores[top])]
+
+
+# IVFによる近似検索（候補行のみの内積 + argpartition）
+def ivf_top_k(index, matrix, query_vector, top_k, nprobe):
+    rows = index.candidates(query_vector, nprobe, matrix.shape[0])
+    if len(rows) <= top_k:
+        return rows
+    scores = np.asarray(matrix[rows], dtype=np.float32) @ query_vector
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    return rows[top[np.argsort(-scores[top])]]
@@ -0,0 +1,129 @@
+import math
+from collections import Counter
+
+import numpy as np
+
+from extractive import tokenize_sentence
+
+# チャンクのキーワード検索用の転置インデックス（BM25）
+# 日本語は文字bigram、英語は単語で索引化するため、形態素解析器なしで化合物名や著者名を検索できる
+# 検索は埋め込みAPIもLLMも呼び出さない
+
+# 文献に紐付いていないチャンクのレコードID
+NO_RECORD_ID = -1
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal Rank Fusionの定数（順位の影響を緩やかにする）
+RRF_K = 60
+
+
+class BM25Index:
+    def __init__(self, node_ids, record_ids, vocabulary, offsets, rows, term_frequencies, doc_lengths):
+        self.node_ids = node_ids
+        self.record_ids = record_ids
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.rows = rows
+        self.term_frequencies = term_frequencies
+        self.doc_lengths = doc_lengths
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    # (ノードID, テキスト, レコードID) の列から転置インデックスを作成
+    @classmethod
+    def build(cls, items):
+        node_ids = []
+        record_ids = []
+        doc_lengths = []
+        postings = {}
+        for row, (node_id, text, record_id) in enumerate(items):
+            counts = Counter(tokenize_sentence(text))
+            node_ids.append(node_id)
+            record_ids.append(NO_RECORD_ID if record_id is None else record_id)
+            doc_lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                postings.setdefault(token, ([], []))
+                postings[token][0].append(row)
+                postings[token][1].append(tf)
+
+        vocabulary = {}
+        offsets = [0]
+        rows = []
+        term_frequencies = []
+        for token, (token_rows, token_tfs) in postings.items():
+            vocabulary[token] = len(vocabulary)
+            rows.extend(token_rows)
+            term_frequencies.extend(token_tfs)
+            offsets.append(len(rows))
+        return cls(
+            node_ids,
+            np.asarray(record_ids, dtype=np.int64),
+            vocabulary,
+            np.asarray(offsets, dtype=np.int64),
+            np.asarray(rows, dtype=np.int32),
+            np.asarray(term_frequencies, dtype=np.float32),
+            np.asarray(doc_lengths, dtype=np.float32),
+        )
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    # クエリのBM25スコア上位を [(ノードID, スコア)] で返す（record_idsで対象の文献を絞り込める）
+    def search(self, query, top_k, record_ids=None):
+        if not self.node_ids:
+            return []
+        scores = np.zeros(len(self.node_ids), dtype=np.float32)
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(self.average_length, 1e-9))
+        for token in set(tokenize_sentence(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.offsets[term], self.offsets[term + 1]
+            rows = self.rows[start:end]
+            tfs = self.term_frequencies[start:end]
+            idf = math.log(1 + (len(self.node_ids) - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + length_norm[rows])
+
+        if record_ids is not None:
+            scores[~np.isin(self.record_ids, np.asarray(list(record_ids), dtype=np.int64))] = 0.0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self.node_ids[row], float(scores[row])) for row in candidates]
+
+    def save(self, path):
+        tokens = sorted(self.vocabulary, key=self.vocabulary.get)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                node_ids=np.asarray(self.node_ids, dtype=str),
+                record_ids=self.record_ids,
+                tokens=np.asarray(tokens, dtype=str),
+                offsets=self.offsets,
+                rows=self.rows,
+                term_frequencies=self.term_frequencies,
+                doc_lengths=self.doc_lengths,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data["node_ids"].tolist(),
+                data["record_ids"],
+                {token: i for i, token in enumerate(data["tokens"].tolist())},
+                data["offsets"],
+                data["rows"],
+                data["term_frequencies"],
+                data["doc_lengths"],
+            )
+
+
+# 複数の順位付きリストをReciprocal Rank Fusionで統合し、[(ID, スコア)] を返す
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K):
+    fused = {}
+    for ranked in ranked_lists:
+        for rank, item_id in enumerate(ranked):
+            fused[item_id] = fused.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,341 @@
+import json
+import os
+
+import numpy as np
+from pydantic import Field, PrivateAttr
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    VectorStoreQueryResult,
+)
+
+from ivf_index import IVFIndex
+
+# 埋め込みベクトルを連続したNumPy配列（.npy）に保持するベクトルストア
+# 保存時は「ID→ノード表（JSON）」と「ベクトル配列（.npy）」の2ファイルに分け、読込時は.npyをメモリマップする
+VECTOR_STORE_FORMAT = "numpy-v1"
+# メタデータフィルタに使うため、ID表に保持するメタデータのキー
+DEFAULT_METADATA_KEYS = ["drive_file_id", "record_id"]
+# float16の行列をまとめてfloat32に変換しないよう、この行数ごとに類似度を計算する
+SCORE_BLOCK_ROWS = 65536
+# 検索対象がこの件数以上のとき、近似最近傍インデックス（IVF）を作成・使用する
+ANN_MIN_ROWS = 50000
+# IVFで走査するクラスタ数の既定値（大きいほど再現率が高く、遅くなる）
+ANN_NPROBE = 16
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    stores_text: bool = False
+    dtype: str = "float16"
+    metadata_keys: list = Field(default_factory=lambda: list(DEFAULT_METADATA_KEYS))
+    ann_min_rows: int = ANN_MIN_ROWS
+    ann_nprobe: int = ANN_NPROBE
+
+    _matrix: np.ndarray = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0)
+    _alive: np.ndarray = PrivateAttr(default=None)
+    _node_ids: list = PrivateAttr(default_factory=list)
+    _ref_doc_ids: list = PrivateAttr(default_factory=list)
+    _metadata: dict = PrivateAttr(default_factory=dict)
+    # 文献ID（record_id）をベクトルと同じ行順で持つ配列（未設定は-1。フィルタをnp.isinで計算する）
+    _record_ids: np.ndarray = PrivateAttr(default=None)
+    _node_rows: dict = PrivateAttr(default_factory=dict)
+    _ref_doc_rows: dict = PrivateAttr(default_factory=dict)
+    _ivf: IVFIndex = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls):
+        return "NumpyVectorStore"
+
+    @property
+    def client(self):
+        return None
+
+    # 登録済み（削除されていない）ベクトルの件数
+    def count(self):
+        return len(self._node_rows)
+
+    # ---- 行の追加・削除 ----
+
+    # 追加に備えて配列の容量を確保（メモリマップされた配列はここでメモリ上にコピーされる）
+    def _reserve(self, rows, dim):
+        if self._matrix is None:
+            capacity = max(rows, 1024)
+            self._matrix = np.zeros((capacity, dim), dtype=self.dtype)
+            self._alive = np.zeros(capacity, dtype=bool)
+            self._record_ids = np.full(capacity, -1, dtype=np.int64)
+            return
+        if self._matrix.shape[1] != dim:
+            raise ValueError(f"埋め込みの次元が一致しません: {self._matrix.shape[1]} != {dim}")
+        required = self._size + rows
+        if isinstance(self._matrix, np.memmap) or required > self._matrix.shape[0]:
+            capacity = max(required, self._matrix.shape[0] * 2 if required > self._matrix.shape[0] else self._matrix.shape[0])
+            matrix = np.zeros((capacity, dim), dtype=self.dtype)
+            matrix[:self._size] = self._matrix[:self._size]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:self._size] = self._alive[:self._size]
+            record_ids = np.full(capacity, -1, dtype=np.int64)
+            record_ids[:self._size] = self._record_ids[:self._size]
+            self._matrix, self._alive, self._record_ids = matrix, alive, record_ids
+
+    def _append(self, node_id, ref_doc_id, embedding, metadata):
+        if node_id in self._node_rows:
+            self._delete_row(self._node_rows[node_id])
+        row = self._size
+        self._matrix[row] = embedding
+        self._alive[row] = True
+        record_id = metadata.get("record_id")
+        self._record_ids[row] = -1 if record_id is None else record_id
+        self._size += 1
+        self._node_ids.append(node_id)
+        self._ref_doc_ids.append(ref_doc_id)
+        for key in self.metadata_keys:
+            self._metadata.setdefault(key, [None] * row).append(metadata.get(key))
+        self._node_rows[node_id] = row
+        self._ref_doc_rows.setdefault(ref_doc_id, []).append(row)
+
+    def _delete_row(self, row):
+        self._alive[row] = False
+        if self._ivf is not None:
+            self._ivf.remove([row])
+        self._node_rows.pop(self._node_ids[row], None)
+        rows = self._ref_doc_rows.get(self._ref_doc_ids[row], [])
+        if row in rows:
+            rows.remove(row)
+
+    # 埋め込みベクトルを正規化して追加（コサイン類似度を内積で計算できるようにする）
+    def add(self, nodes, **add_kwargs):
+        nodes = [node for node in nodes]
+        if not nodes:
+            return []
+        embeddings = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings /= norms
+
+        self._reserve(len(nodes), embeddings.shape[1])
+        first_row = self._size
+        for node, embedding in zip(nodes, embeddings):
+            self._append(node.node_id, node.ref_doc_id, embedding, node.metadata)
+        # 近似最近傍インデックスがあれば、追加した行を最も近いクラスタに割り当てる
+        if self._ivf is not None:
+            self._ivf.add(self._matrix, np.arange(first_row, self._size))
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        for row in list(self._ref_doc_rows.pop(ref_doc_id, [])):
+            self._delete_row(row)
+
+    def get(self, node_id):
+        return self._matrix[self._node_rows[node_id]].astype(np.float32).tolist()
+
+    # ---- 検索 ----
+
+    # フィルタ条件に一致する行のマスクを作成
+    def _filter_mask(self, query):
+        mask = self._alive[:self._size].copy()
+        if query.node_ids:
+            allowed = np.zeros(self._size, dtype=bool)
+            allowed[[self._node_rows[i] for i in query.node_ids if i in self._node_rows]] = True
+            mask &= allowed
+        if query.doc_ids:
+            allowed = np.zeros(self._size, dtype=bool)
+            for doc_id in query.doc_ids:
+                allowed[self._ref_doc_rows.get(doc_id, [])] = True
+            mask &= allowed
+        if query.filters is not None and query.filters.filters:
+            mask &= self._metadata_mask(query.filters)
+        return mask
+
+    def _metadata_mask(self, filters):
+        masks = []
+        for metadata_filter in filters.filters:
+            values = self._metadata.get(metadata_filter.key)
+            if values is None:
+                raise ValueError(f"メタデータ {metadata_filter.key} はフィルタに使用できません。")
+            if metadata_filter.operator == FilterOperator.EQ:
+                allowed = {metadata_filter.value}
+            elif metadata_filter.operator == FilterOperator.IN:
+                allowed = set(metadata_filter.value)
+            else:
+                raise ValueError(f"未対応のフィルタ演算子です: {metadata_filter.operator}")
+            if metadata_filter.key == "record_id":
+                allowed = np.fromiter((v for v in allowed if v is not None), dtype=np.int64)
+                masks.append(np.isin(self._record_ids[:self._size], allowed))
+            else:
+                masks.append(np.fromiter((v in allowed for v in values), dtype=bool, count=self._size))
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    # 行列とクエリベクトルの積で指定行の類似度を計算（float16はブロックごとに変換）
+    def _scores(self, query_vector, rows):
+        scores = np.empty(len(rows), dtype=np.float32)
+        full_scan = len(rows) == self._size
+        for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, len(rows))
+            block = self._matrix[start:end] if full_scan else self._matrix[rows[start:end]]
+            scores[start:end] = block.astype(np.float32, copy=False) @ query_vector
+        return scores
+
+    # 検索対象の行を決める（対象が多い場合はIVFで候補を絞り込む）
+    def _search_rows(self, query_vector, mask, top_k):
+        if self._ivf is not None and self.ann_nprobe and np.count_nonzero(mask) >= self.ann_min_rows:
+            candidates = self._ivf.candidates(query_vector, self.ann_nprobe, self._size)
+            candidates = candidates[mask[candidates]]
+            if len(candidates) >= top_k:
+                return candidates
+        return np.flatnonzero(mask)
+
+    def query(self, query, **kwargs):
+        if self._size == 0 or query.query_embedding is None:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+
+        query_vector = np.asarray(query.query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm > 0:
+            query_vector /= norm
+
+        rows = self._search_rows(query_vector, self._filter_mask(query), query.similarity_top_k)
+        return self._top_k(rows, self._scores(query_vector, rows), query.similarity_top_k)
+
+    # argpartitionで上位k件を取り出し、その中だけをソートする
+    def _top_k(self, rows, scores, top_k):
+        top_k = min(top_k, len(rows))
+        if top_k == 0:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        top = np.argpartition(-scores, top_k - 1)[:top_k] if top_k < len(rows) else np.arange(len(rows))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=scores[top].astype(float).tolist(),
+            ids=[self._node_ids[row] for row in rows[top]],
+        )
+
+    # 件数が十分に多ければ近似最近傍インデックスを作成（大きく増えた場合は学習し直す）
+    def build_ann_index(self, force=False):
+        alive_rows = np.flatnonzero(self._alive[:self._size]) if self._size else np.zeros(0, dtype=int)
+        if not force and len(alive_rows) < self.ann_min_rows:
+            return False
+        if force or self._ivf is None or self._ivf.needs_retrain(len(alive_rows)):
+            self._ivf = IVFIndex.train(self._matrix, alive_rows)
+            return True
+        return False
+
+    # ---- 保存・読込 ----
+
+    # persist_path（*.json）にID表、同名の.npyにベクトル配列を保存（削除済みの行は詰める）
+    def persist(self, persist_path, fs=None):
+        os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+        rows = np.flatnonzero(self._alive[:self._size]) if self._size else np.zeros(0, dtype=int)
+        dim = self._matrix.shape[1] if self._matrix is not None else 0
+        matrix = self._matrix[rows] if self._matrix is not None else np.zeros((0, dim), dtype=self.dtype)
+        # メモリマップ中のファイルを上書きしないよう、一時ファイルに書き込んでから置き換える
+        vector_path = vector_file_path(persist_path)
+        with open(vector_path + ".tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(matrix, dtype=self.dtype))
+        os.replace(vector_path + ".tmp", vector_path)
+
+        # 近似最近傍インデックスは同名の.ivf.npzに保存
+        self.build_ann_index()
+        if self._ivf is not None:
+            self._ivf.save(ann_file_path(persist_path), rows)
+
+        table = {
+            "format": VECTOR_STORE_FORMAT,
+            "dtype": self.dtype,
+            "dim": dim,
+            "node_ids": [self._node_ids[r] for r in rows],
+            "ref_doc_ids": [self._ref_doc_ids[r] for r in rows],
+            "metadata": {key: [values[r] for r in rows] for key, values in self._metadata.items()},
+        }
+        with open(persist_path, "w", encoding="utf-8") as f:
+            json.dump(table, f, ensure_ascii=False)
+
+    @classmethod
+    def from_persist_path(cls, persist_path, mmap=True):
+        with open(persist_path, encoding="utf-8") as f:
+            table = json.load(f)
+        store = cls(dtype=table["dtype"], metadata_keys=list(table["metadata"]) or DEFAULT_METADATA_KEYS)
+        matrix = np.load(vector_file_path(persist_path), mmap_mode="r" if mmap else None)
+        size = len(table["node_ids"])
+        store._matrix = matrix
+        store._size = size
+        store._alive = np.ones(size, dtype=bool)
+        store._node_ids = table["node_ids"]
+        store._ref_doc_ids = table["ref_doc_ids"]
+        store._metadata = table["metadata"]
+        store._record_ids = record_id_array(table["metadata"].get("record_id"), size)
+        store._node_rows = {node_id: row for row, node_id in enumerate(store._node_ids)}
+        for row, ref_doc_id in enumerate(store._ref_doc_ids):
+            store._ref_doc_rows.setdefault(ref_doc_id, []).append(row)
+        if os.path.exists(ann_file_path(persist_path)):
+            store._ivf = IVFIndex.load(ann_file_path(persist_path))
+        return store
+
+    # LlamaIndex標準のSimpleVectorStoreの内容から変換（埋め込みAPIは呼び出さない）
+    @classmethod
+    def from_simple_vector_store(cls, simple_store, dtype="float16"):
+        data = simple_store.data
+        return cls.from_simple_vector_store_dict(
+            {
+                "embedding_dict": data.embedding_dict,
+                "text_id_to_ref_doc_id": data.text_id_to_ref_doc_id,
+                "metadata_dict": data.metadata_dict,
+            },
+            dtype=dtype,
+        )
+
+    # SimpleVectorStoreの保存ファイル（JSON）から直接変換
+    # SimpleVectorStore.from_persist_pathは埋め込みの数値を1つずつ型変換するため、大きなインデックスでは非常に遅い
+    @classmethod
+    def from_simple_vector_store_file(cls, persist_path, dtype="float16"):
+        with open(persist_path, encoding="utf-8") as f:
+            return cls.from_simple_vector_store_dict(json.load(f), dtype=dtype)
+
+    @classmethod
+    def from_simple_vector_store_dict(cls, data, dtype="float16"):
+        store = cls(dtype=dtype)
+        embedding_dict = data.get("embedding_dict") or {}
+        node_ids = list(embedding_dict)
+        if not node_ids:
+            return store
+        embeddings = np.asarray([embedding_dict[i] for i in node_ids], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings /= norms
+        text_id_to_ref_doc_id = data.get("text_id_to_ref_doc_id") or {}
+        metadata_dict = data.get("metadata_dict") or {}
+        store._reserve(len(node_ids), embeddings.shape[1])
+        for node_id, embedding in zip(node_ids, embeddings):
+            store._append(node_id, text_id_to_ref_doc_id.get(node_id), embedding, metadata_dict.get(node_id) or {})
+        return store
+
+
+# メタデータのrecord_idの列をint64の配列に変換（未設定は-1）
+def record_id_array(values, size):
+    if values is None:
+        return np.full(size, -1, dtype=np.int64)
+    return np.fromiter((-1 if v is None else v for v in values), dtype=np.int64, count=size)
+
+
+# ID表（*.json）に対応するベクトル配列のパス
+def vector_file_path(persist_path):
+    base, _ = os.path.splitext(persist_path)
+    return base + ".npy"
+
+
+# ID表（*.json）に対応する近似最近傍インデックスのパス
+def ann_file_path(persist_path):
+    base, _ = os.path.splitext(persist_path)
+    return base + ".ivf.npz"
+
+
+# 保存ディレクトリ内のベクトルストアがNumPy形式か判定
+def is_numpy_vector_store(persist_path):
+    if not os.path.exists(persist_path) or not os.path.exists(vector_file_path(persist_path)):
+        return False
+    with open(persist_path, encoding="utf-8") as f:
+        head = f.read(64)
+    return f'"format": "{VECTOR_STORE_FORMAT}"' in head
@@ -1,10 +1,15 @@
 import streamlit as st
 from pydrive.drive import GoogleDrive
-import tempfile
-import shutil
 import os
-from llama_index.core import StorageContext, load_index_from_storage
+import hashlib
 import openai
+from rag import (
+    ANSWER_CACHE_PATH, LEGACY_INDEX_SUFFIX, SEARCH_HYBRID, SEARCH_LEXICAL, SEARCH_VECTOR, embed_query, index_version,
+    load_index_dir, load_lexical_index, resolve_library_index_dir, retrieve_library, stream_answer,
+)
+from answer_cache import open_answer_cache
+from database import find_record_ids, get_year_range, load_facets
+from numpy_vector_store import ANN_NPROBE
 
 # ページ設定
 st.set_page_config(layout="wide")
@@ -12,97 +17,140 @@ st.set_page_config(layout="wide")
 # Google Drive接続
 drive = st.session_state.get("drive")
 
+# データベースファイル
+DB_FILE = "literature_database.db"
+
 # OpenAI APIキーの設定
 openai.api_key = st.secrets["openai_api_key"]
 
-# キャッシュ変数を初期化
-if "loaded_indices" not in st.session_state:
-    st.session_state["loaded_indices"] = []
+# キャッシュ変数を初期化（インデックスの展開先。最初の質問時に解決する）
+if "library_index_dir" not in st.session_state:
+    st.session_state["library_index_dir"] = None
 
-def load_indices_from_drive():
-    """Google Driveからインデックスを読み込み、キャッシュする"""
-    file_list = drive.ListFile({'q': "title contains '_index.zip' and trashed=false"}).GetList()
-    if not file_list:
-        st.error("インデックスファイルがGoogle Drive上に見つかりませんでした。")
-        return []
+@st.cache_resource(max_entries=2, show_spinner=False)
+def load_cached_index(index_dir):
+    """展開済みのインデックスを読み込む（展開先はmd5ごとに異なるため、更新されると別のキャッシュになる）"""
+    return load_index_dir(index_dir)
 
-    indices = []
-    for index_file in file_list:
-        try:
-            zip_file_path = os.path.join(tempfile.gettempdir(), index_file['title'])
-            index_file.GetContentFile(zip_file_path)
-            extract_dir = tempfile.mkdtemp()
-            shutil.unpack_archive(zip_file_path, extract_dir)
-
-            # インデックスを読み込む
-            storage_context = StorageContext.from_defaults(persist_dir=extract_dir)
-            index = load_index_from_storage(storage_context)
-
-            # 読み込んだインデックスをキャッシュに追加
-            indices.append({"name": index_file["title"].replace("_index.zip", ""), "index": index})
-            os.remove(zip_file_path)
-        except Exception as e:
-            st.error(f"インデックスファイル {index_file['title']} の読み込みに失敗しました: {str(e)}")
+@st.cache_resource(max_entries=2, show_spinner=False)
+def load_cached_lexical_index(index_dir):
+    """キーワード検索用の転置インデックスを読み込む（インデックスと同じ展開先をキーにする）"""
+    return load_lexical_index(index_dir, load_cached_index(index_dir))
 
-    return indices
+@st.cache_resource(show_spinner=False)
+def get_answer_cache():
+    """回答キャッシュ（全セッションで共有）"""
+    return open_answer_cache(ANSWER_CACHE_PATH)
 
-def query_all_indices(prompt, indices):
-    """全インデックスを統合して検索"""
-    combined_results = []
-    for item in indices:
-        try:
-            query_engine = item["index"].as_query_engine()
-            result = query_engine.query(prompt)
-            combined_results.append({
-                "source": item["name"],
-                "content": result.response,
-                "metadata": result.metadata,
-            })
-        except Exception as e:
-            st.error(f"{item['name']} でのクエリ実行に失敗しました: {str(e)}")
-    return combined_results
+# 検索方式の表示名
+SEARCH_MODES = {
+    "ハイブリッド（ベクトル + キーワード）": SEARCH_HYBRID,
+    "ベクトル検索": SEARCH_VECTOR,
+    "キーワード検索のみ（API呼び出しなし）": SEARCH_LEXICAL,
+}
+
+def load_index_from_drive():
+    """Google Drive上の全体インデックスをローカルキャッシュと照合し、変更があった場合のみ取得して読み込む"""
+    try:
+        index_dir = st.session_state["library_index_dir"] or resolve_library_index_dir(drive)
+        index = load_cached_index(index_dir) if index_dir else None
+    except Exception as e:
+        st.error(f"全体インデックスの読み込みに失敗しました: {str(e)}")
+        return None
 
-def format_results(results):
-    """結果を整形して表示"""
-    # 関連性の高い順にソート
-    sorted_results = sorted(results, key=lambda x: len(x["content"]), reverse=True)
+    if index is None:
+        legacy_files = drive.ListFile({'q': f"title contains '{LEGACY_INDEX_SUFFIX}' and trashed=false"}).GetList()
+        if legacy_files:
+            st.error("旧形式（PDFごと）のインデックスのみ見つかりました。RAG Settingで全体インデックスに統合してください。")
+        else:
+            st.error("インデックスファイルがGoogle Drive上に見つかりませんでした。")
+    else:
+        st.session_state["library_index_dir"] = index_dir
+    return index
 
-    for res in sorted_results:
+def select_filters():
+    """検索対象の文献を絞り込む条件をサイドバーで選択（未指定の条件はNone）"""
+    facets = load_facets(DB_FILE)
+    year_min, year_max = get_year_range(DB_FILE)
+    filters = {}
+    with st.sidebar.expander("検索対象の絞り込み"):
+        categories = sorted(value for value, _ in facets["カテゴリ"])
+        journals = sorted(value for value, _ in facets["ジャーナル"])
+        keywords = sorted(value for value, _ in facets["キーワード"])
+        filters["category"] = st.selectbox("カテゴリ", options=[None] + categories, format_func=lambda x: "すべて" if x is None else x)
+        filters["journal"] = st.selectbox("ジャーナル", options=[None] + journals, format_func=lambda x: "すべて" if x is None else x)
+        filters["keyword"] = st.selectbox("キーワード", options=[None] + keywords, format_func=lambda x: "すべて" if x is None else x)
+        status = st.selectbox("ステータス", options=["すべて", "既読", "未読"])
+        filters["read"] = None if status == "すべて" else status == "既読"
+        if year_min is not None and year_min < year_max and st.checkbox("出版年で絞り込む"):
+            filters["year_from"], filters["year_to"] = st.slider(
+                "出版年", min_value=int(year_min), max_value=int(year_max),
+                value=(int(year_min), int(year_max))
+            )
+    return {key: value for key, value in filters.items() if value is not None}
+
+def resolve_record_ids(filters):
+    """絞り込み条件に合う文献IDをデータベースから取得（条件が無い場合はNone）"""
+    if not filters:
+        return None
+    return find_record_ids(DB_FILE, **filters)
+
+def search_index(question, index, mode, lexical, query_embedding=None, record_ids=None):
+    """全体インデックスから上位の文献チャンクを検索（回答は生成しない）"""
+    try:
+        nodes = retrieve_library(
+            index, question, mode=mode, lexical=lexical, query_embedding=query_embedding, record_ids=record_ids
+        )
+    except Exception as e:
+        st.error(f"クエリ実行に失敗しました: {str(e)}")
+        return None
+
+    sources = []
+    for source in nodes:
+        metadata = source.node.metadata
+        sources.append({
+            "source": metadata.get("タイトル") or metadata.get("file_name", ""),
+            "page": metadata.get("page_label", ""),
+            "score": source.score,
+            "content": source.node.get_content(),
+            "metadata": metadata,
+        })
+    return {"nodes": nodes, "sources": sources}
+
+def format_sources(sources):
+    """検索された文献の該当箇所を表示"""
+    for i, res in enumerate(sources):
         with st.container():
             # カード風の見た目を作成
             st.markdown("---")  # 区切り線
-            st.markdown(f"### 📘 文献名: {res['source']}")
-            st.markdown(res["content"])
+            score = f" (score: {res['score']:.3f})" if res["score"] is not None else ""
+            page = f" p.{res['page']}" if res["page"] else ""
+            st.markdown(f"### [{i + 1}] 📘 文献名: {res['source']}{page}{score}")
+            with st.expander("該当箇所"):
+                st.markdown(res["content"])
 
             # PDFファイルへのリンクを追加
-            if "metadata" in res and "file_name" in res["metadata"]:
-                file_name = res["metadata"]["file_name"]
+            file_id = res["metadata"].get("drive_file_id")
+            if file_id:
                 # Google Drive のリンク生成
-                pdf_link = f"https://drive.google.com/file/d/{file_name}/view"
+                pdf_link = f"https://drive.google.com/file/d/{file_id}/view"
                 st.markdown(f"[📄 文献を開く]({pdf_link})")
 
-                # PDFのプレビュー機能
-                if st.button(f"📖 プレビュー ({file_name})", key=file_name):
-                    pdf_file_path = f"/path/to/local/pdf/{file_name}"  # 実際のパスに置き換えてください
-                    pdf_viewer(pdf_file_path)
-
-    if len(results) > 5:
-        with st.expander("📚 他の関連文献を見る"):
-            for res in results[5:]:
-                with st.container():
-                    st.markdown("---")
-                    st.markdown(f"### 📘 文献名: {res['source']}")
-                    st.markdown(res["content"])
+def summarize_sources(sources):
+    """会話履歴に残す検索結果の一覧"""
+    lines = []
+    for i, res in enumerate(sources):
+        page = f" p.{res['page']}" if res["page"] else ""
+        lines.append(f"[{i + 1}] {res['source']}{page}")
+    return "\n".join(lines) if lines else "該当する文献が見つかりませんでした。"
 
-                    # PDFファイルへのリンクを追加
-                    if "metadata" in res and "file_name" in res["metadata"]:
-                        file_name = res["metadata"]["file_name"]
-                        pdf_link = f"https://drive.google.com/file/d/{file_name}/view"
-                        st.markdown(f"[📄 文献を開く]({pdf_link})")
-
-                        if st.button(f"📖 プレビュー ({file_name})", key=f"exp_{file_name}"):
-                            pdf_file_path = f"/path/to/local/pdf/{file_name}"
-                            pdf_viewer(pdf_file_path)
+def stream_synthesis(question, nodes):
+    """検索結果に基づく回答をストリーミング表示し、全文を返す"""
+    try:
+        return st.write_stream(stream_answer(question, nodes))
+    except Exception as e:
+        st.error(f"回答の生成に失敗しました: {str(e)}")
+        return None
 
 
 def pdf_viewer(pdf_file_path):
@@ -125,15 +173,23 @@ def main():
     st.title(":robot_face: AI Chat")
     st.markdown("### 文献PDF情報から検索")
 
-    if not st.session_state["loaded_indices"]:
-        with st.spinner("インデックスを読み込んでいます..."):
-            st.session_state["loaded_indices"] = load_indices_from_drive()
-
-    if not st.session_state["loaded_indices"]:
-        st.error("有効なインデックスが見つかりませんでした。")
-        return
-
-    indices = st.session_state["loaded_indices"]
+    mode = SEARCH_MODES[st.sidebar.radio("検索方式", list(SEARCH_MODES))]
+    # 検索結果だけで十分な場合はLLMを呼び出さない（キーワード検索のみの場合は常に生成しない）
+    synthesize = st.sidebar.checkbox(
+        "回答を生成する", value=True, disabled=mode == SEARCH_LEXICAL,
+        help="検索結果を表示した後、抜粋に基づく回答をストリーミングで表示します。"
+    ) and mode != SEARCH_LEXICAL
+    # 近似最近傍検索で走査するクラスタ数（大きいほど正確で、小さいほど高速）
+    nprobe = st.sidebar.slider(
+        "検索精度 (nprobe)", min_value=1, max_value=64, value=ANN_NPROBE,
+        help="チャンク数が多いライブラリで使われる近似検索の精度です。"
+    )
+    filters = select_filters()
+    # 類似した質問の回答を再利用する（インデックスが更新されると無効になる）
+    use_answer_cache = st.sidebar.checkbox("以前の回答を再利用する", value=True, disabled=mode == SEARCH_LEXICAL)
+    # RAG Settingでインデックスを更新した後は、Drive上の最新版と照合し直す
+    if st.sidebar.button("インデックスを再確認"):
+        st.session_state["library_index_dir"] = None
 
     if st.button("リセット", use_container_width=True):
         st.session_state.messages = [{"role": "assistant", "content": "質問をどうぞ"}]
@@ -146,17 +202,76 @@ def main():
         with st.chat_message(msg["role"]):
             st.write(msg["content"])
 
-    if prompt_input := st.chat_input():
-        prompt = prompt_input + "\nこの質問を日本語と英語の両方で検索し、最も関連性の高い結果を日本語で回答してください。"
-        responses = query_all_indices(prompt, indices)
-
-        st.session_state.messages.append({"role": "user", "content": prompt})
+    if question := st.chat_input():
+        st.session_state.messages.append({"role": "user", "content": question})
         with st.chat_message("user"):
-            st.write(prompt)
+            st.write(question)
+
+        # インデックスは最初の質問時に読み込む（ページを開くだけではDriveにアクセスしない）
+        with st.spinner("インデックスを読み込んでいます..."):
+            index = load_index_from_drive()
+        if index is None:
+            st.error("有効なインデックスが見つかりませんでした。")
+            return
+        index.vector_store.ann_nprobe = nprobe
+        lexical = None
+        if mode != SEARCH_VECTOR:
+            lexical = load_cached_lexical_index(st.session_state["library_index_dir"])
+
+        try:
+            record_ids = resolve_record_ids(filters)
+        except Exception as e:
+            st.error(f"絞り込み条件の検索に失敗しました: {str(e)}")
+            return
+        if record_ids is not None:
+            st.caption(f"{len(record_ids)} 件の文献に絞り込んで検索します。")
+
+        # 質問の埋め込みを1回だけ計算し、回答キャッシュの照合とベクトル検索の両方に使う
+        query_embedding = None
+        cache_version = index_version(st.session_state["library_index_dir"])
+        # 検索対象の文献が異なる質問の回答は再利用しない
+        cache_mode = f"{mode}:nprobe={nprobe}"
+        if record_ids is not None:
+            cache_mode += ":records=" + hashlib.sha256(",".join(map(str, sorted(record_ids))).encode()).hexdigest()
+        if mode != SEARCH_LEXICAL:
+            try:
+                query_embedding = embed_query(question)
+            except Exception as e:
+                st.error(f"質問の埋め込みに失敗しました: {str(e)}")
+                return
+            if use_answer_cache:
+                cached = get_answer_cache().lookup(cache_version, cache_mode, query_embedding, require_answer=synthesize)
+                if cached:
+                    with st.chat_message("assistant"):
+                        st.caption(f"以前の質問「{cached['question']}」の結果を再利用しました（類似度 {cached['similarity']:.3f}）")
+                        format_sources(cached["sources"])
+                        content = summarize_sources(cached["sources"])
+                        if synthesize:
+                            st.markdown("---")
+                            st.markdown("#### 回答")
+                            st.markdown(cached["answer"])
+                            content = f"{cached['answer']}\n\n{content}"
+                    st.session_state.messages.append({"role": "assistant", "content": content})
+                    return
+
+        result = search_index(question, index, mode, lexical, query_embedding, record_ids)
+        if result is None:
+            return
+        answer = None
+        with st.chat_message("assistant"):
+            # 検索結果を先に表示し、回答はその下にストリーミングで表示する
+            format_sources(result["sources"])
+            content = summarize_sources(result["sources"])
+            if synthesize and result["nodes"]:
+                st.markdown("---")
+                st.markdown("#### 回答")
+                answer = stream_synthesis(question, result["nodes"])
+                if answer:
+                    content = f"{answer}\n\n{content}"
+        st.session_state.messages.append({"role": "assistant", "content": content})
 
-        if responses:
-            st.session_state.messages.append({"role": "assistant", "content": "検索結果を表示中..."})
-            format_results(responses)
+        if query_embedding is not None and result["sources"]:
+            get_answer_cache().store(cache_version, cache_mode, question, query_embedding, answer, result["sources"])
 
 if __name__ == "__main__":
     main()
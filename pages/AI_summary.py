@@ -1,7 +1,6 @@
 import streamlit as st
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
-import sqlite3
 import os
 import tempfile
 import shutil
@@ -17,7 +16,8 @@ from bs4 import BeautifulSoup
 from sqlalchemy import Column, Integer, String, Boolean, create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-from database import get_session, Metadata
+from database import get_session, Metadata, update_record
+from sqlalchemy.exc import OperationalError
 
 from openai import OpenAI
 from llama_index.core import download_loader, VectorStoreIndex, Settings, SimpleDirectoryReader
@@ -28,7 +28,8 @@ import pytesseract
 from pdf2image import convert_from_path
 # 関数読込
 
-from function import store_metadata_in_db, handle_pdf_upload,store_metadata_in_db_ai,download_file,extract_text_from_pdf,translate_and_summarize,upload_db_to_google_drive
+from function import store_metadata_in_db, handle_pdf_upload,store_metadata_in_db_ai,translate_and_summarize,upload_db_to_google_drive
+from function import get_metadata_df,compute_text_hash,get_drive_md5,is_summary_current,load_or_extract_text,SUMMARY_MODEL,SUMMARY_PROMPT_VERSION,SUMMARY_FAILED
 
 # ページ設定
 st.set_page_config(
@@ -45,11 +46,13 @@ DB_FILE = "literature_database.db"
 def main():
     st.markdown("### アップロード済PDFのAI自動要約")
 
-    conn = sqlite3.connect(DB_FILE)
-
     # 文献リスト読み込み
-    edited_df = st.session_state["df"].copy()
-    default_rows = edited_df[edited_df['要約'].isna() | (edited_df['要約'] == '')]['id']
+    edited_df = get_metadata_df(DB_FILE).copy()
+    # Google DriveにPDFがある文献だけを要約の対象にする（一括取り込みした文献にはPDFが無い）
+    has_pdf = edited_df['ファイルリンク'].fillna('').str.contains('id=') if not edited_df.empty else pd.Series(dtype=bool)
+    pdf_df = edited_df[has_pdf]
+    # 要約が未作成、または要約に失敗した文献を初期選択（選択した文献の要約設定が古いかは「変更があった文献のみ再要約する」で判定する）
+    default_rows = pdf_df[pdf_df['要約'].isna() | pdf_df['要約'].isin(['', SUMMARY_FAILED])]['id']
 
     # 表示画面用の column_config 設定
     column_config = {
@@ -63,7 +66,7 @@ def main():
     st.markdown("##### 文献リスト")
     # 特定カラムを表示上除外してデータを表示
     st.dataframe(
-        edited_df.drop(columns=['開始ページ', '終了ページ', 'ファイルリンク']),
+        edited_df.drop(columns=['開始ページ', '終了ページ', 'ファイルリンク', 'text_hash', 'pdf_md5']),
         column_config=column_config, 
         hide_index=True, 
         use_container_width=True
@@ -71,9 +74,11 @@ def main():
 
 
     # 文献選択（IDとタイトルをフォーマットして表示）
+    if len(pdf_df) < len(edited_df):
+        st.caption(f"PDFがアップロードされていない文献（{len(edited_df) - len(pdf_df)}件）は選択できません。")
     selected_rows = st.multiselect(
         "要約を行う文献を選択してください",
-        options=edited_df['id'],
+        options=pdf_df['id'],
         default=default_rows,
         format_func=lambda x: f"{x} - {edited_df[edited_df['id'] == x]['タイトル'].iloc[0]}"
     )
@@ -91,64 +96,89 @@ def main():
                 st.write(f"**年**: {doc_info['年'].iloc[0]}")
                 st.write(f"**DOI URL**: {doc_info['doi_url'].iloc[0]}")
 
+    # 再要約モードの選択
+    only_stale = st.checkbox(
+        "変更があった文献のみ再要約する",
+        value=True,
+        help="PDFの内容または要約設定（モデル・プロンプト）が変わっていない文献はスキップします。"
+    )
+
     # 「要約」ボタンの表示
     if st.button("要約", key="summarize_button"):
         progress_bar = st.progress(0)
 
         for i, row_id in enumerate(selected_rows):
-            selected_file_path = edited_df[edited_df['id'] == row_id]["ファイルリンク"].iloc[0]
+            row = edited_df[edited_df['id'] == row_id].iloc[0]
+            st.markdown("##### タイトル")
+            st.write(row["タイトル"])
+
+            selected_file_path = row["ファイルリンク"]
             file_id = selected_file_path.split("id=")[-1]
-            pdf_file_path = download_file(drive, file_id)
-            content = extract_text_from_pdf(pdf_file_path)
 
-            # 要約とキーワード・カテゴリの取得
-            summary, keyword_res, category_res = translate_and_summarize(content)
+            # 要約が最新かつPDFが未変更ならダウンロードせずにスキップ
+            drive_md5 = get_drive_md5(drive, file_id)
+            if only_stale and is_summary_current(row) and row.get("pdf_md5") == drive_md5:
+                st.info("要約は最新のためスキップしました。")
+                progress_bar.progress((i + 1) / len(selected_rows))
+                continue
+
+            # 抽出テキストはデータベースに保存済みのものを使い、未保存またはPDFが更新されている場合だけダウンロードする
+            content, pdf_md5 = load_or_extract_text(drive, DB_FILE, row_id, file_id, drive_md5)
+            text_hash = compute_text_hash(content)
+
+            # PDFは更新されたが抽出テキストが同じ場合は要約を再利用
+            if only_stale and is_summary_current(row) and row.get("text_hash") == text_hash:
+                update_summary_source(row_id, text_hash, pdf_md5)
+                st.info("抽出テキストに変更がないため要約を再利用しました。")
+                progress_bar.progress((i + 1) / len(selected_rows))
+                continue
+
+            # 要約とキーワード・カテゴリの取得（要約は逐次表示）
+            summary, keyword_res, category_res = translate_and_summarize(content, stream_container=st.container())
             keywords_str = ','.join(keyword_res)
 
+            # 結果が揃い次第、該当行のみデータベースへ書き込む
+            update_summary_row(row_id, summary, keywords_str, category_res, text_hash, pdf_md5)
+
             # データフレーム更新
             edited_df.loc[edited_df["id"] == row_id, "キーワード"] = keywords_str
             edited_df.loc[edited_df["id"] == row_id, "要約"] = summary
             edited_df.loc[edited_df["id"] == row_id, "カテゴリ"] = category_res
 
-            st.success(f"要約完了: {edited_df.loc[edited_df['id'] == row_id, 'タイトル'].iloc[0]}")
-            st.markdown("##### タイトル")
-            st.write(edited_df.loc[edited_df["id"] == row_id, "タイトル"].iloc[0])
             st.markdown("##### カテゴリ")
             st.write(category_res)
             st.markdown("##### キーワード")
             st.write(keywords_str)
-            st.markdown("##### 要約")
-            st.write(summary)
+            st.success(f"要約完了: {edited_df.loc[edited_df['id'] == row_id, 'タイトル'].iloc[0]}")
 
             # プログレスバー更新
             progress_bar.progress((i + 1) / len(selected_rows))
 
-        # データベース更新処理
-        update_database(conn, edited_df)
-
         st.success("変更が保存されました")
         upload_db_to_google_drive(DB_FILE, drive)
-        # アップロード成功後、再読み込みフラグを立てる
-        st.session_state['refresh_data'] = True
-def update_database(conn, edited_df):
-    """データベース更新処理。"""
-    edited_df.to_sql("temp_metadata", conn, if_exists="replace", index=False)
-    existing_ids = pd.read_sql("SELECT id FROM metadata", conn)["id"]
-    new_ids = edited_df["id"]
-    ids_to_delete = existing_ids[~existing_ids.isin(new_ids)]
-
-    with conn:
-        try:
-            if not ids_to_delete.empty:
-                conn.execute(f"DELETE FROM metadata WHERE id IN ({','.join(map(str, ids_to_delete))})")
-            conn.execute("DELETE FROM metadata WHERE id IN (SELECT id FROM temp_metadata)")
-            conn.execute("""
-                INSERT INTO metadata (タイトル,著者,ジャーナル,巻,号,開始ページ,終了ページ,年,要約,キーワード,カテゴリ,doi,doi_url,ファイルリンク,メモ,Read)
-                SELECT タイトル,著者,ジャーナル,巻,号,開始ページ,終了ページ,年,要約,キーワード,カテゴリ,doi,doi_url,ファイルリンク,メモ,Read FROM temp_metadata
-            """)
-            conn.execute("DROP TABLE temp_metadata")
-        except sqlite3.OperationalError as err:
-            st.error(f"オペレーショナルエラー: {err}")
+
+def update_summary_row(row_id, summary, keywords_str, category_res, text_hash, pdf_md5):
+    """要約結果と生成元情報を該当行のみに書き込む。"""
+    succeeded = summary != SUMMARY_FAILED
+    try:
+        update_record(DB_FILE, row_id, {
+            "要約": summary,
+            "キーワード": keywords_str,
+            "カテゴリ": category_res,
+            "text_hash": text_hash,
+            "pdf_md5": pdf_md5,
+            "summary_model": SUMMARY_MODEL if succeeded else None,
+            "summary_prompt_version": SUMMARY_PROMPT_VERSION if succeeded else None,
+        })
+    except OperationalError as err:
+        st.error(f"オペレーショナルエラー: {err}")
+
+def update_summary_source(row_id, text_hash, pdf_md5):
+    """要約を再利用する場合に、生成元のハッシュ値のみ更新する。"""
+    try:
+        update_record(DB_FILE, row_id, {"text_hash": text_hash, "pdf_md5": pdf_md5})
+    except OperationalError as err:
+        st.error(f"オペレーショナルエラー: {err}")
 
 
 
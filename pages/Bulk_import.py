@@ -0,0 +1,90 @@
+import streamlit as st
+import pandas as pd
+
+from bibliography import parse_bibliography, needs_metadata, resolve_missing
+from database import find_existing_dois, insert_records
+from function import get_metadata_from_doi, upload_db_to_google_drive
+
+# ページ設定
+st.set_page_config(
+    page_title="Bulk Import",
+    layout="wide",
+    initial_sidebar_state="expanded",
+)
+#Google drive
+drive=st.session_state['drive']
+
+DB_FILE = "literature_database.db"
+
+# プレビューに表示するカラム
+PREVIEW_COLUMNS = ["doi", "タイトル", "著者", "ジャーナル", "年", "キーワード"]
+
+# DOIから文献情報を取得（別スレッドで実行するため、APIのエラーは表示しない）
+def resolve_doi(doi):
+    return get_metadata_from_doi(doi, warn=lambda message: None)
+
+# アップロードされたファイルを読み込み、DOIのない文献・ファイル内の重複・登録済みの文献を除く
+def load_new_records(uploaded_files):
+    records = []
+    for uploaded_file in uploaded_files:
+        try:
+            records.extend(parse_bibliography(uploaded_file.getvalue().decode("utf-8-sig", errors="replace"), uploaded_file.name))
+        except ValueError as e:
+            st.error(f"{uploaded_file.name} の読み込みに失敗しました: {e}")
+
+    unique = {}
+    for record in records:
+        if record["doi"]:
+            unique.setdefault(record["doi"].lower(), record)
+    existing = find_existing_dois(DB_FILE, unique)
+    new_records = [record for doi, record in unique.items() if doi not in existing]
+    counts = {
+        "読み込み": len(records),
+        "DOIなし": sum(1 for record in records if not record["doi"]),
+        "ファイル内の重複": sum(1 for record in records if record["doi"]) - len(unique),
+        "登録済み": len(existing),
+        "追加対象": len(new_records),
+    }
+    return new_records, counts
+
+def main():
+    st.markdown("### 文献リストの一括取り込み")
+    st.caption("他の文献管理ソフトから書き出した BibTeX (.bib)・RIS (.ris)・CSL-JSON (.json) を取り込みます。DOIのない文献は取り込みません。")
+
+    uploaded_files = st.file_uploader("ファイルをアップロード (複数選択可能)", type=["bib", "ris", "json", "txt"], accept_multiple_files=True)
+    if not uploaded_files:
+        return
+
+    new_records, counts = load_new_records(uploaded_files)
+    st.write(" / ".join(f"{label}: {count}件" for label, count in counts.items()))
+    if not new_records:
+        st.info("追加する文献はありません。")
+        return
+
+    st.dataframe(pd.DataFrame(new_records)[PREVIEW_COLUMNS], hide_index=True, use_container_width=True)
+
+    missing = sum(1 for record in new_records if needs_metadata(record))
+    resolve = st.checkbox(f"不足している文献情報をDOIから補完する（{missing}件）", value=missing > 0, disabled=missing == 0)
+    category = st.selectbox("関連テーマ（任意）", [""] + st.session_state.get("categories_all", []))
+
+    if st.button("取り込み", key="bulk_import_button"):
+        if resolve and missing:
+            progress = st.progress(0.0, text="文献情報を補完中...")
+            failed = resolve_missing(
+                new_records, resolve_doi,
+                on_progress=lambda done, total: progress.progress(done / total, text=f"文献情報を補完中... {done}/{total}"),
+            )
+            if failed:
+                st.warning(f"{len(failed)}件の文献情報を取得できませんでした（取得できた項目のみで取り込みます）。")
+
+        if category:
+            for record in new_records:
+                record["カテゴリ"] = category
+        row_ids = insert_records(DB_FILE, new_records)
+        st.success(f"{len(row_ids)}件の文献を追加しました。")
+
+        # 取り込み後に1回だけGoogle Driveへアップロード
+        upload_db_to_google_drive(DB_FILE, drive)
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,16 @@ from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
 import os
 import tempfile
-import shutil
 import pandas as pd
 import openai  # OpenAIライブラリをインポート
-from llama_index.core import VectorStoreIndex, Settings
-from llama_index.llms.openai import OpenAI  # OpenAIクラスのインポート
-from llama_index.embeddings.openai import OpenAIEmbedding
-import tiktoken
-from function import extract_text_from_pdf
+from function import documents_to_pages, extract_pdf_text, get_metadata_df, pages_to_documents, thread_local_drive, upload_db_to_google_drive
+from database import load_fulltext, store_fulltext
+from rag import (
+    BUILD_ADDED, BUILD_SKIPPED, LEGACY_INDEX_SUFFIX, LIBRARY_INDEX_FILE, build_files, create_library_index,
+    download_embedding_cache, embedding_cache_stats, indexed_files, load_library_index, migrate_legacy_indices,
+    plan_library_sync, record_metadata, records_by_file_id, remove_file_from_index, reset_embedding_cache_stats,
+    upload_embedding_cache, upload_library_index,
+)
 
 # ページ設定
 st.set_page_config(layout="wide")
@@ -18,9 +20,82 @@ st.set_page_config(layout="wide")
 # Google Drive接続
 drive = st.session_state['drive']
 
+# データベースファイル
+DB_FILE = "literature_database.db"
+
 # OpenAI APIキーの設定
 openai.api_key = st.secrets["openai_api_key"]
 
+# 全体インデックスを取得（未作成の場合は空のインデックスを作成）
+def get_library_index():
+    if st.session_state.get("library_index") is None:
+        with st.spinner("全体インデックスを読み込んでいます..."):
+            download_embedding_cache(drive)
+            index = load_library_index(drive)
+        st.session_state["library_index"] = index if index is not None else create_library_index()
+    return st.session_state["library_index"]
+
+# Google DriveからPDFを一時ファイルにダウンロード（パイプラインのスレッドで実行）
+def download_pdf(file):
+    # 同名のPDFを並列にダウンロードしても衝突しないよう、ダウンロードごとに一時ファイルを作成する
+    fd, temp_pdf_path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    thread_local_drive(drive).CreateFile({'id': file['id']}).GetContentFile(temp_pdf_path)
+    return temp_pdf_path
+
+# データベースに保存済みの抽出テキストを読み込む（文献に紐付いていない、またはPDFが更新されている場合はNone）
+def load_stored_text(job):
+    metadata = job["metadata"]
+    if metadata.get("record_id") is None or not metadata.get("content_hash"):
+        return None
+    stored = load_fulltext(DB_FILE, metadata["record_id"], metadata["content_hash"])
+    return None if stored is None else pages_to_documents(stored["pages"], job["name"])
+
+# 選択したPDFを並列にインデックス化（内容が変わっていないPDFは埋め込みを行わない）
+# 抽出テキストが保存済みのPDFはダウンロードせず、新たに抽出したテキストはデータベースに保存する
+def run_build(index, target_files, records, force=False):
+    jobs = [
+        {"name": file['title'], "source": file, "metadata": record_metadata(file['id'], records.get(file['id']), file.get('md5Checksum'))}
+        for file in target_files
+    ]
+    if not jobs:
+        return {}
+    progress_bar = st.progress(0)
+
+    def on_progress(name, status, done, total):
+        progress_bar.progress(done / total, text=f"{done}/{total} {name}")
+        if status == BUILD_ADDED:
+            st.success(f"{name} を全体インデックスに登録しました。")
+        elif status == BUILD_SKIPPED:
+            st.info(f"{name} は変更がないためスキップしました。")
+        else:
+            st.error(f"{name} のインデックス化に失敗しました: {status}")
+
+    stored = []
+
+    def save_text(job, documents, ocr):
+        metadata = job["metadata"]
+        if metadata.get("record_id") is not None and metadata.get("content_hash"):
+            store_fulltext(DB_FILE, metadata["record_id"], metadata["content_hash"], documents_to_pages(documents), ocr)
+            stored.append(job["name"])
+
+    results = build_files(
+        index, jobs, download_pdf, extract_pdf_text, on_progress=on_progress, force=force,
+        load_text=load_stored_text, save_text=save_text,
+    )
+    if stored:
+        upload_db_to_google_drive(DB_FILE, drive)
+    return results
+
+# インデックスと埋め込みキャッシュをGoogle Driveに保存し、埋め込みキャッシュのヒット率を表示
+def save_index(index):
+    upload_library_index(drive, index)
+    upload_embedding_cache(drive)
+    stats = embedding_cache_stats()
+    if stats["hits"] + stats["misses"]:
+        st.info(f"埋め込みキャッシュ: ヒット {stats['hits']} 件 / 新規 {stats['misses']} 件（ヒット率 {stats['hit_rate']:.0%}）")
+    reset_embedding_cache_stats()
+
 # メイン関数
 def main():
     st.title(":robot_face: RAG Setting")
@@ -41,11 +116,47 @@ def main():
     pdf_df = pd.DataFrame(file_data)
     st.dataframe(pdf_df)
 
-    # Google DriveからインデックスZIPリストを取得
-    st.markdown("#### 既存のインデックスファイル")
-    index_files = drive.ListFile({'q': "title contains '_index.zip' and trashed=false"}).GetList()
-    index_file_names = [file['title'] for file in index_files]
-    st.write(index_file_names if index_file_names else "インデックスファイルはまだありません。")
+    # 文献レコード（ノードのメタデータに使用）
+    records = records_by_file_id(get_metadata_df(DB_FILE))
+
+    # 全体インデックスの状態
+    st.markdown("#### 全体インデックス")
+    index = get_library_index()
+    indexed_ids = set(indexed_files(index))
+    st.write(f"{LIBRARY_INDEX_FILE}: {len(indexed_ids)} 件のPDFをインデックス化済み")
+
+    # 旧形式（PDFごと）のインデックスからの移行
+    legacy_files = [
+        f for f in drive.ListFile({'q': f"title contains '{LEGACY_INDEX_SUFFIX}' and trashed=false"}).GetList()
+        if f['title'] != LIBRARY_INDEX_FILE
+    ]
+    if legacy_files:
+        st.markdown("#### 旧形式のインデックスファイル")
+        st.write([f['title'] for f in legacy_files])
+        if st.button("旧形式のインデックスを全体インデックスに統合"):
+            progress_bar = st.progress(0)
+            failed = migrate_legacy_indices(
+                drive, index, pdf_files, records,
+                on_progress=lambda done, total, title: progress_bar.progress(done / total, text=title),
+            )
+            for title, error in failed:
+                st.error(f"{title} の統合に失敗しました: {error}")
+            save_index(index)
+            st.success("旧形式のインデックスを統合し、全体インデックスをアップロードしました。")
+            indexed_ids = set(indexed_files(index))
+
+    # 文献データベースとの同期（追加・更新・削除された文献のみ反映）
+    st.markdown("#### 文献データベースと同期")
+    to_add, to_update, to_delete = plan_library_sync(index, pdf_files, records)
+    st.write(f"追加: {len(to_add)} 件 / 更新: {len(to_update)} 件 / 削除: {len(to_delete)} 件")
+    if st.button("ライブラリと同期", disabled=not (to_add or to_update or to_delete)):
+        files = indexed_files(index)
+        for file_id in to_delete:
+            remove_file_from_index(index, file_id, files)
+        run_build(index, to_add + to_update, records, force=True)
+        save_index(index)
+        st.success("文献データベースとインデックスを同期しました。")
+        indexed_ids = set(indexed_files(index))
 
     # インデックス化するPDFを選択
     st.markdown("#### インデックス化するPDFを選択")
@@ -64,7 +175,7 @@ def main():
 
     with col2:
         if st.button("未実施のみ選択"):
-            st.session_state.selected_files = [file for file in pdf_names if f"{file}_index.zip" not in index_file_names]
+            st.session_state.selected_files = [file['title'] for file in pdf_files if file['id'] not in indexed_ids]
 
     with col3:
         if st.button("選択解除"):
@@ -74,65 +185,19 @@ def main():
     selected_files = st.multiselect("インデックス化するPDFを選択してください:", pdf_names, default=st.session_state.selected_files)
     st.session_state.selected_files = selected_files  # セッションステートを更新
 
+    force_rebuild = st.checkbox("変更がないPDFも再生成する", value=False)
+
     # インデックス作成処理開始
     if st.button("インデックス生成開始"):
-        progress_bar = st.progress(0)
-        actual_files_to_index = []
-
-        for file in pdf_files:
-            if file['title'] in st.session_state.selected_files:
-                actual_files_to_index.append(file)
-
-        for idx, file in enumerate(actual_files_to_index):
-            file_title = file['title']
-            file_id = file['id']
-
-            # インデックスが既に存在する場合は削除
-            if f"{file_title}_index.zip" in index_file_names:
-                st.info(f"{file_title}はすでにインデックス化されています。既存のインデックスファイルを削除します。")
-                existing_file = [i for i in index_files if i['title'] == f"{file_title}_index.zip"][0]
-                existing_file.Delete()
-
-            # Google DriveからPDFファイルをダウンロード
-            downloaded_file = drive.CreateFile({'id': file_id})
-            temp_pdf_path = os.path.join(tempfile.gettempdir(), file_title)
-            downloaded_file.GetContentFile(temp_pdf_path)
-
-            # PDFファイルをテキスト抽出
-            documents = extract_text_from_pdf(temp_pdf_path)
-
-            # ベクトル化して保存
-            Settings.llm = OpenAI(model="gpt-4o-mini", temperature=0.1)
-            Settings.embed_model = OpenAIEmbedding(model="text-embedding-3-small", embed_batch_size=100)
-            Settings.tokenizer = tiktoken.encoding_for_model("gpt-4o-mini").encode
-
-            index = VectorStoreIndex.from_documents(documents)
-
-            # 一時ディレクトリに保存
-            index_dir = tempfile.mkdtemp()
-            index.storage_context.persist(persist_dir=index_dir)
-
-            # ZIPファイル作成
-            zip_file_path = os.path.join(tempfile.gettempdir(), f"{file_title}_index.zip")
-            shutil.make_archive(zip_file_path.replace('.zip', ''), 'zip', index_dir)
-
-            # Google Driveにアップロード
-            index_file = drive.CreateFile({'title': f"{file_title}_index.zip"})
-            index_file.SetContentFile(zip_file_path)
-            try:
-                index_file.Upload()
-                st.success(f"{file_title}_index.zip がGoogle Driveにアップロードされました！")
-            except Exception as e:
-                st.error(f"Google Driveへのアップロードに失敗しました: {str(e)}")
-
-            # クリーンアップ
-            shutil.rmtree(index_dir)
-            os.remove(temp_pdf_path)
-            os.remove(zip_file_path)
-
-            # プログレスバー更新
-            progress_percent = (idx + 1) / len(actual_files_to_index)
-            progress_bar.progress(progress_percent)
+        actual_files_to_index = [file for file in pdf_files if file['title'] in st.session_state.selected_files]
+        run_build(index, actual_files_to_index, records, force=force_rebuild)
+
+        # 全体インデックスをGoogle Driveにアップロード
+        try:
+            save_index(index)
+            st.success(f"{LIBRARY_INDEX_FILE} がGoogle Driveにアップロードされました！")
+        except Exception as e:
+            st.error(f"Google Driveへのアップロードに失敗しました: {str(e)}")
 
         st.success("すべてのインデックスが生成されました！")
 
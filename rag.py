@@ -0,0 +1,659 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import tiktoken
+from llama_index.core import Settings, StorageContext, VectorStoreIndex, load_index_from_storage
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores import FilterOperator, MetadataFilter, MetadataFilters
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.llms.openai import OpenAI
+
+from answer_cache import ANSWER_CACHE_FILE
+from binary_docstore import BinaryDocumentStore
+from embedding_cache import EMBEDDING_CACHE_FILE, CachedEmbedding, open_embedding_cache
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from numpy_vector_store import NumpyVectorStore, is_numpy_vector_store
+
+# 全文献を1つにまとめたインデックスのファイル名（Google Drive上）
+LIBRARY_INDEX_FILE = "library_index.zip"
+# 旧形式（PDFごと）のインデックスファイルの接尾辞
+LEGACY_INDEX_SUFFIX = "_index.zip"
+# 検索で取得するチャンク数
+SIMILARITY_TOP_K = 8
+# 検索方式（ベクトル・キーワード（BM25）・両者をRRFで統合したハイブリッド）
+SEARCH_VECTOR = "vector"
+SEARCH_LEXICAL = "lexical"
+SEARCH_HYBRID = "hybrid"
+# 回答生成に渡す各チャンクの最大文字数
+SYNTHESIS_CHUNK_CHARS = 2000
+# ハイブリッド検索で統合前に各方式から取得する件数（top_kの倍数）
+HYBRID_CANDIDATE_FACTOR = 3
+# キーワード検索用の転置インデックスの保存ファイル（インデックスのZIPに同梱）
+LEXICAL_INDEX_FILE = "lexical_index.npz"
+# インデックスの保存形式（埋め込みはfloat16の生配列、ノードは長さ付きバイナリレコード）と、その構成を記した管理ファイル
+SHARD_FORMAT = "library-shard-v1"
+SHARD_MANIFEST_FILE = "shard_manifest.json"
+DOCSTORE_FILE = "docstore.bin"
+# ベクトルストアの保存ファイル（LlamaIndexの既定のファイル名）と埋め込みの保存精度
+VECTOR_STORE_FILE = "default__vector_store.json"
+VECTOR_DTYPE = "float16"
+# インデックス生成パイプラインの並列度
+DOWNLOAD_WORKERS = 4
+EXTRACT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+EMBED_WORKERS = 4
+# ダウンロード済みで未処理のPDFを溜め込みすぎないための上限
+MAX_FILES_IN_FLIGHT = 8
+# パイプラインの処理結果
+BUILD_ADDED = "added"
+BUILD_SKIPPED = "skipped"
+# ローカルのキャッシュディレクトリ（埋め込みキャッシュなど）
+LOCAL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "literature_management")
+EMBEDDING_CACHE_PATH = os.path.join(LOCAL_CACHE_DIR, EMBEDDING_CACHE_FILE)
+ANSWER_CACHE_PATH = os.path.join(LOCAL_CACHE_DIR, ANSWER_CACHE_FILE)
+# 展開済みインデックスのキャッシュと、その管理情報（Drive上のmd5Checksum・modifiedDate）
+INDEX_CACHE_DIR = os.path.join(LOCAL_CACHE_DIR, "indices")
+INDEX_MANIFEST_PATH = os.path.join(INDEX_CACHE_DIR, "manifest.json")
+
+# ノードに付与する文献メタデータ（埋め込み計算には含めない）
+DOC_METADATA_KEYS = ["drive_file_id", "content_hash", "record_id", "タイトル", "著者", "年", "ジャーナル"]
+# 埋め込み計算から除外するキー（一時ファイルのパスで埋め込みキャッシュが外れないようにする）
+EMBED_EXCLUDED_KEYS = DOC_METADATA_KEYS + ["file_path"]
+# LLMに渡すメタデータから除外するキー
+LLM_EXCLUDED_KEYS = ["drive_file_id", "content_hash", "record_id", "file_path"]
+
+
+_settings_configured = False
+# 同じプロセス内の複数セッションが同時にキャッシュを更新しないようにする
+_index_cache_lock = threading.Lock()
+
+
+# LLMと埋め込みモデルの設定（インデックス作成時と検索時で同じモデルを使う）
+# チャンクの埋め込みはキャッシュを経由し、同じテキストは再計算しない
+def configure_settings():
+    global _settings_configured
+    if _settings_configured:
+        return
+    Settings.llm = OpenAI(model="gpt-4o-mini", temperature=0.1)
+    Settings.embed_model = CachedEmbedding(
+        OpenAIEmbedding(model="text-embedding-3-small", embed_batch_size=100),
+        open_embedding_cache(EMBEDDING_CACHE_PATH),
+    )
+    Settings.tokenizer = tiktoken.encoding_for_model("gpt-4o-mini").encode
+    _settings_configured = True
+
+
+# 埋め込みキャッシュのヒット率などの集計値
+def embedding_cache_stats():
+    configure_settings()
+    return Settings.embed_model.stats()
+
+
+def reset_embedding_cache_stats():
+    configure_settings()
+    Settings.embed_model.reset_stats()
+
+
+# DataFrameの文献レコードからノード用メタデータを作成
+# content_hashにはPDFのMD5（Google Driveのmd5Checksum）を使う
+def record_metadata(file_id, record=None, content_hash=None):
+    metadata = {"drive_file_id": file_id, "content_hash": content_hash}
+    if record is not None:
+        metadata["record_id"] = int(record["id"])
+        for key in ["タイトル", "著者", "年", "ジャーナル"]:
+            value = record.get(key)
+            metadata[key] = "" if value is None or value != value else str(value)
+    return metadata
+
+
+# Documentまたはノードに文献メタデータを付与
+def attach_metadata(item, metadata):
+    item.metadata.update(metadata)
+    item.excluded_embed_metadata_keys = sorted(set(item.excluded_embed_metadata_keys) | set(EMBED_EXCLUDED_KEYS))
+    item.excluded_llm_metadata_keys = sorted(set(item.excluded_llm_metadata_keys) | set(LLM_EXCLUDED_KEYS))
+    return item
+
+
+# ファイルリンク（https://drive.google.com/uc?id=...）をファイルIDをキーとするレコードの辞書に変換
+def records_by_file_id(df):
+    records = {}
+    for record in df.to_dict("records"):
+        link = record.get("ファイルリンク")
+        if isinstance(link, str) and "id=" in link:
+            records[link.split("id=")[-1]] = record
+    return records
+
+
+# 空の全体インデックスを作成
+def create_library_index():
+    configure_settings()
+    storage_context = StorageContext.from_defaults(
+        docstore=BinaryDocumentStore(), vector_store=NumpyVectorStore(dtype=VECTOR_DTYPE)
+    )
+    return VectorStoreIndex(nodes=[], storage_context=storage_context)
+
+
+# 保存ディレクトリのベクトルストアを読み込む
+# NumPy形式はメモリマップで開き、旧形式（SimpleVectorStoreのJSON）はNumPy形式に変換する
+def load_vector_store(persist_dir):
+    persist_path = os.path.join(persist_dir, VECTOR_STORE_FILE)
+    if is_numpy_vector_store(persist_path):
+        return NumpyVectorStore.from_persist_path(persist_path)
+    return NumpyVectorStore.from_simple_vector_store_file(persist_path, dtype=VECTOR_DTYPE)
+
+
+# 保存ディレクトリの管理ファイルを読み込む（旧形式の場合はNone）
+def read_shard_manifest(persist_dir):
+    path = os.path.join(persist_dir, SHARD_MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# 展開済みディレクトリからインデックスを読み込む
+# 旧形式（LlamaIndex標準のJSON）のドキュメントストアは、次回の保存でバイナリ形式になるよう変換する
+def load_index_dir(persist_dir):
+    configure_settings()
+    if read_shard_manifest(persist_dir) is not None:
+        docstore = BinaryDocumentStore.from_persist_path(os.path.join(persist_dir, DOCSTORE_FILE))
+        storage_context = StorageContext.from_defaults(
+            persist_dir=persist_dir, docstore=docstore, vector_store=load_vector_store(persist_dir)
+        )
+    else:
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir, vector_store=load_vector_store(persist_dir))
+        storage_context.docstore = BinaryDocumentStore.from_simple_docstore(storage_context.docstore)
+    return load_index_from_storage(storage_context)
+
+
+# インデックスを保存（ベクトル・ノード・キーワード検索用インデックスと管理ファイル）
+def persist_library_index(index, persist_dir):
+    storage_context = index.storage_context
+    storage_context.persist(persist_dir=persist_dir, docstore_fname=DOCSTORE_FILE)
+    # 標準のドキュメントストアのまま作成されたインデックスは、バイナリ形式で書き直す
+    if not isinstance(storage_context.docstore, BinaryDocumentStore):
+        docstore = BinaryDocumentStore.from_simple_docstore(storage_context.docstore)
+        docstore.persist(os.path.join(persist_dir, DOCSTORE_FILE))
+    build_lexical_index(index).save(os.path.join(persist_dir, LEXICAL_INDEX_FILE))
+
+    files = {
+        name: os.path.getsize(os.path.join(persist_dir, name))
+        for name in sorted(os.listdir(persist_dir)) if name != SHARD_MANIFEST_FILE
+    }
+    manifest = {
+        "format": SHARD_FORMAT,
+        "nodes": index.vector_store.count(),
+        "dtype": index.vector_store.dtype,
+        "files": files,
+    }
+    with open(os.path.join(persist_dir, SHARD_MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+# 展開済みのインデックス（旧形式を含む）を現在の形式で別のディレクトリに保存し直す
+def convert_index_dir(source_dir, target_dir):
+    return persist_library_index(load_index_dir(source_dir), target_dir)
+
+
+# インデックスのZIP（旧形式を含む）を現在の形式のZIPに変換（埋め込みAPIは呼び出さない）
+def convert_index_zip(source_zip, target_zip):
+    source_dir = tempfile.mkdtemp()
+    target_dir = tempfile.mkdtemp()
+    try:
+        shutil.unpack_archive(source_zip, source_dir, "zip")
+        manifest = convert_index_dir(source_dir, target_dir)
+        base = target_zip[:-len(".zip")] if target_zip.endswith(".zip") else target_zip
+        shutil.make_archive(base, "zip", target_dir)
+        return manifest
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+
+# Google Drive上のZIPをダウンロードして展開し、インデックスを読み込む
+def load_index_from_drive_file(gfile):
+    zip_file_path = os.path.join(tempfile.gettempdir(), gfile['title'])
+    extract_dir = tempfile.mkdtemp()
+    try:
+        gfile.GetContentFile(zip_file_path)
+        shutil.unpack_archive(zip_file_path, extract_dir, "zip")
+        return load_index_dir(extract_dir)
+    finally:
+        if os.path.exists(zip_file_path):
+            os.remove(zip_file_path)
+        # メモリマップ中の.npyは、ディレクトリ削除後もプロセス内では参照できる（POSIX）
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+# Google Drive上のファイルをタイトルで検索（存在しない場合はNone）
+def find_drive_file(drive, title):
+    file_list = drive.ListFile({'q': f"title='{title}' and trashed=false"}).GetList()
+    return file_list[0] if file_list else None
+
+
+# Google Driveから全体インデックスを取得（存在しない場合はNone）
+def find_library_index_file(drive):
+    return find_drive_file(drive, LIBRARY_INDEX_FILE)
+
+
+# 埋め込みキャッシュがローカルに無ければGoogle Driveから取得（設定の初期化前に呼び出す）
+def download_embedding_cache(drive):
+    if _settings_configured or os.path.exists(EMBEDDING_CACHE_PATH):
+        return False
+    gfile = find_drive_file(drive, EMBEDDING_CACHE_FILE)
+    if gfile is None:
+        return False
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    gfile.GetContentFile(EMBEDDING_CACHE_PATH)
+    return True
+
+
+# 埋め込みキャッシュをGoogle Driveにアップロード（別環境でも再利用できるようにする）
+def upload_embedding_cache(drive):
+    if not os.path.exists(EMBEDDING_CACHE_PATH):
+        return
+    gfile = find_drive_file(drive, EMBEDDING_CACHE_FILE) or drive.CreateFile({'title': EMBEDDING_CACHE_FILE})
+    gfile.SetContentFile(EMBEDDING_CACHE_PATH)
+    gfile.Upload()
+
+
+# ローカルのインデックスキャッシュの管理情報を読み込む（{ファイル名: {id, md5Checksum, modifiedDate, dir}}）
+def read_index_manifest():
+    try:
+        with open(INDEX_MANIFEST_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_index_manifest(manifest):
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    temp_path = INDEX_MANIFEST_PATH + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, INDEX_MANIFEST_PATH)
+
+
+# 展開先はmd5ごとに分ける（読み込み済みの版のファイルを上書きしない）
+def cached_index_dir(title, md5):
+    stem = title[:-len(".zip")] if title.endswith(".zip") else title
+    return os.path.join(INDEX_CACHE_DIR, f"{stem}-{md5}")
+
+
+# 展開済みのインデックスをマニフェストに登録し、古い版のディレクトリを削除
+def register_cached_index(gfile, index_dir):
+    manifest = read_index_manifest()
+    previous = manifest.get(gfile['title'])
+    manifest[gfile['title']] = {
+        "id": gfile['id'],
+        "md5Checksum": gfile['md5Checksum'],
+        "modifiedDate": gfile.get('modifiedDate'),
+        "dir": index_dir,
+    }
+    write_index_manifest(manifest)
+    # メモリマップ中の古い版は、ディレクトリ削除後もプロセス内では参照できる（POSIX）
+    if previous and previous.get("dir") and previous["dir"] != index_dir:
+        shutil.rmtree(previous["dir"], ignore_errors=True)
+
+
+# マニフェストと照合し、Drive上のZIPが変わっている場合のみ取得して展開（展開先を返す）
+def sync_cached_index(gfile):
+    with _index_cache_lock:
+        entry = read_index_manifest().get(gfile['title'])
+        if entry and entry.get("md5Checksum") == gfile['md5Checksum'] and os.path.isdir(entry.get("dir", "")):
+            return entry["dir"]
+
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        index_dir = cached_index_dir(gfile['title'], gfile['md5Checksum'])
+        fd, zip_file_path = tempfile.mkstemp(suffix=".zip", dir=INDEX_CACHE_DIR)
+        os.close(fd)
+        extract_dir = index_dir + ".tmp"
+        try:
+            gfile.GetContentFile(zip_file_path)
+            shutil.rmtree(extract_dir, ignore_errors=True)
+            shutil.unpack_archive(zip_file_path, extract_dir, "zip")
+            shutil.rmtree(index_dir, ignore_errors=True)
+            os.replace(extract_dir, index_dir)
+        finally:
+            os.remove(zip_file_path)
+            shutil.rmtree(extract_dir, ignore_errors=True)
+        register_cached_index(gfile, index_dir)
+        return index_dir
+
+
+# 全体インデックスの展開先を返す（Driveに接続できない場合はキャッシュ済みの版、無ければNone）
+def resolve_library_index_dir(drive):
+    try:
+        gfile = find_library_index_file(drive)
+    except Exception:
+        entry = read_index_manifest().get(LIBRARY_INDEX_FILE)
+        if entry and os.path.isdir(entry.get("dir", "")):
+            return entry["dir"]
+        raise
+    if gfile is None:
+        return None
+    return sync_cached_index(gfile)
+
+
+def load_library_index(drive):
+    index_dir = resolve_library_index_dir(drive)
+    if index_dir is None:
+        return None
+    return load_index_dir(index_dir)
+
+
+# 全体インデックスをZIP化してGoogle Driveにアップロード（既存ファイルは上書き）
+# 保存したディレクトリはそのままローカルキャッシュに登録し、次回の読み込みで再取得しない
+def upload_library_index(drive, index):
+    index_dir = tempfile.mkdtemp()
+    zip_base = os.path.join(tempfile.mkdtemp(), LIBRARY_INDEX_FILE.replace(".zip", ""))
+    try:
+        persist_library_index(index, index_dir)
+        zip_file_path = shutil.make_archive(zip_base, 'zip', index_dir)
+        gfile = find_library_index_file(drive) or drive.CreateFile({'title': LIBRARY_INDEX_FILE})
+        gfile.SetContentFile(zip_file_path)
+        gfile.Upload()
+        if gfile.get('md5Checksum'):
+            with _index_cache_lock:
+                cache_dir = cached_index_dir(LIBRARY_INDEX_FILE, gfile['md5Checksum'])
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+                shutil.move(index_dir, cache_dir)
+                register_cached_index(gfile, cache_dir)
+        return gfile
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+        shutil.rmtree(os.path.dirname(zip_base), ignore_errors=True)
+
+
+# 旧形式インデックスのノードを、保存済みの埋め込みベクトル付きで取り出す
+def nodes_from_legacy_index(index, metadata):
+    vector_store = index.vector_store
+    nodes = []
+    for node_id, node in index.docstore.docs.items():
+        try:
+            node.embedding = vector_store.get(node_id)
+        except KeyError:
+            node.embedding = None  # 埋め込みが無い場合は挿入時に再計算される
+        nodes.append(attach_metadata(node, metadata))
+    return nodes
+
+
+# PDFごとの旧インデックス（*_index.zip）を全体インデックスへ統合する
+# 埋め込みベクトルは再利用するため、埋め込みAPIは呼び出さない
+def migrate_legacy_indices(drive, index, pdf_files, records, on_progress=None):
+    pdf_by_title = {f['title']: f for f in pdf_files}
+    legacy_files = drive.ListFile({'q': f"title contains '{LEGACY_INDEX_SUFFIX}' and trashed=false"}).GetList()
+    legacy_files = [f for f in legacy_files if f['title'] != LIBRARY_INDEX_FILE]
+
+    failed = []
+    for i, legacy_file in enumerate(legacy_files):
+        pdf_file = pdf_by_title.get(legacy_file['title'][:-len(LEGACY_INDEX_SUFFIX)], {})
+        file_id = pdf_file.get('id')
+        try:
+            legacy_index = load_index_from_drive_file(legacy_file)
+            metadata = record_metadata(file_id, records.get(file_id), pdf_file.get('md5Checksum'))
+            if file_id is not None:
+                remove_file_from_index(index, file_id)
+            index.insert_nodes(nodes_from_legacy_index(legacy_index, metadata))
+        except Exception as e:
+            failed.append((legacy_file['title'], str(e)))
+        if on_progress is not None:
+            on_progress(i + 1, len(legacy_files), legacy_file['title'])
+    return failed
+
+
+# インデックス済みのPDFごとに、ドキュメントIDの一覧と内容のハッシュ値をまとめる
+def indexed_files(index):
+    files = {}
+    for ref_doc_id, info in index.ref_doc_info.items():
+        file_id = info.metadata.get("drive_file_id")
+        entry = files.setdefault(file_id, {"ref_doc_ids": [], "content_hash": info.metadata.get("content_hash")})
+        entry["ref_doc_ids"].append(ref_doc_id)
+    return files
+
+
+# 指定したPDF（Google DriveのファイルID）に由来するドキュメントをインデックスから削除
+def remove_file_from_index(index, file_id, files=None):
+    files = indexed_files(index) if files is None else files
+    ref_doc_ids = files.get(file_id, {}).get("ref_doc_ids", [])
+    for ref_doc_id in ref_doc_ids:
+        index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+    return len(ref_doc_ids)
+
+
+# PDFから抽出したDocumentに文献メタデータを付与し、チャンク（ノード）に分割
+# ドキュメントIDは「ファイルID:ページ順」とし、同じPDFを再登録しても重複しないようにする
+def documents_to_nodes(documents, metadata):
+    for page_number, document in enumerate(documents, start=1):
+        document.id_ = f"{metadata['drive_file_id']}:{page_number}"
+        attach_metadata(document, metadata)
+    return run_transformations(documents, Settings.transformations)
+
+
+# ノードの埋め込みをまとめて計算（埋め込みモデル側でバッチ分割される）
+def embed_nodes(nodes):
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    for node, embedding in zip(nodes, Settings.embed_model.get_text_embedding_batch(texts)):
+        node.embedding = embedding
+    return nodes
+
+
+# PDFから抽出したDocumentを全体インデックスに追加
+def add_documents(index, documents, metadata):
+    index.insert_nodes(documents_to_nodes(documents, metadata))
+
+
+# 内容のハッシュ値が変わっている（または未登録の）PDFか判定
+def needs_update(files, metadata, force=False):
+    existing = files.get(metadata["drive_file_id"])
+    if existing is None or force or not metadata.get("content_hash"):
+        return True
+    return existing["content_hash"] != metadata["content_hash"]
+
+
+# 複数PDFのインデックス化を、ダウンロード・テキスト抽出・埋め込みの各段階を重ねて並列に実行する
+#   jobs: {"name": 表示名, "source": downloadに渡す値, "metadata": record_metadata()の結果} のリスト
+#   download(source) -> 一時PDFのパス（スレッドで実行、抽出後に削除する）
+#   extract(path) -> (Documentのリスト, OCRで抽出したか)（プロセスプールで実行するため、モジュールレベルの関数を渡す）
+#   on_progress(name, status, done, total): statusはBUILD_ADDED / BUILD_SKIPPED / 例外
+#   load_text(job) -> 保存済みの抽出テキストのDocumentのリスト、または None（あればダウンロード・抽出を省く）
+#   save_text(job, documents, ocr): 抽出したテキストを保存する
+# インデックスへの書き込みは呼び出し元のスレッドだけで行い、失敗したPDFは他のPDFの処理に影響しない
+def build_files(index, jobs, download, extract, on_progress=None, force=False, load_text=None, save_text=None):
+    files = indexed_files(index)
+    results = {}
+    total = len(jobs)
+    queue = deque()
+
+    def finish(job, status):
+        results[job["name"]] = status
+        if on_progress is not None:
+            on_progress(job["name"], status, len(results), total)
+
+    for job in jobs:
+        if needs_update(files, job["metadata"], force):
+            queue.append(job)
+        else:
+            finish(job, BUILD_SKIPPED)
+
+    pending = {}
+    with ThreadPoolExecutor(DOWNLOAD_WORKERS) as downloads, \
+            ProcessPoolExecutor(EXTRACT_WORKERS) as extractors, \
+            ThreadPoolExecutor(EMBED_WORKERS) as embedders:
+
+        def start_downloads():
+            in_flight = len({id(job) for _, job in pending.values()})
+            while queue and in_flight < MAX_FILES_IN_FLIGHT:
+                job = queue.popleft()
+                try:
+                    documents = load_text(job) if load_text is not None else None
+                    if documents is not None:
+                        nodes = documents_to_nodes(documents, job["metadata"])
+                        pending[embedders.submit(embed_nodes, nodes)] = ("embed", job)
+                    else:
+                        pending[downloads.submit(download, job["source"])] = ("download", job)
+                except Exception as e:
+                    finish(job, e)
+                    continue
+                in_flight += 1
+
+        start_downloads()
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, job = pending.pop(future)
+                try:
+                    value = future.result()
+                    if stage == "download":
+                        job["path"] = value
+                        pending[extractors.submit(extract, value)] = ("extract", job)
+                    elif stage == "extract":
+                        remove_temp_file(job.get("path"))
+                        documents, ocr = value
+                        if save_text is not None:
+                            save_text(job, documents, ocr)
+                        nodes = documents_to_nodes(documents, job["metadata"])
+                        pending[embedders.submit(embed_nodes, nodes)] = ("embed", job)
+                    else:
+                        file_id = job["metadata"]["drive_file_id"]
+                        remove_file_from_index(index, file_id, files)
+                        index.insert_nodes(value)
+                        files.pop(file_id, None)
+                        finish(job, BUILD_ADDED)
+                except Exception as e:
+                    remove_temp_file(job.get("path"))
+                    finish(job, e)
+            start_downloads()
+    return results
+
+
+def remove_temp_file(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+# 文献データベース（metadataテーブル）と全体インデックスの差分を求める
+# 戻り値: 追加するPDF, 内容が変わったPDF, 削除するファイルIDのリスト
+def plan_library_sync(index, pdf_files, records):
+    files = indexed_files(index)
+    library = [f for f in pdf_files if f['id'] in records]
+    to_add = [f for f in library if f['id'] not in files]
+    to_update = [
+        f for f in library
+        if f['id'] in files and f.get('md5Checksum') and files[f['id']]["content_hash"] != f.get('md5Checksum')
+    ]
+    library_ids = {f['id'] for f in library}
+    to_delete = [file_id for file_id in files if file_id not in library_ids]
+    return to_add, to_update, to_delete
+
+
+# キーワード検索の対象テキスト（本文に加えて、タイトルと著者でも検索できるようにする）
+def lexical_text(node):
+    metadata = node.metadata
+    return " ".join([
+        str(metadata.get("タイトル") or ""),
+        str(metadata.get("著者") or ""),
+        node.get_content(metadata_mode=MetadataMode.NONE),
+    ])
+
+
+# インデックス内の全チャンクからキーワード検索用の転置インデックスを作成
+def build_lexical_index(index):
+    return BM25Index.build(
+        (node_id, lexical_text(node), node.metadata.get("record_id"))
+        for node_id, node in index.docstore.docs.items()
+    )
+
+
+# 展開済みインデックスに同梱された転置インデックスを読み込む（旧形式のZIPでは作成する）
+def load_lexical_index(index_dir, index):
+    path = os.path.join(index_dir, LEXICAL_INDEX_FILE)
+    if os.path.exists(path):
+        return BM25Index.load(path)
+    return build_lexical_index(index)
+
+
+def lexical_search(index, lexical, prompt, top_k=SIMILARITY_TOP_K, record_ids=None):
+    results = []
+    for node_id, score in lexical.search(prompt, top_k, record_ids=record_ids):
+        node = index.docstore.get_node(node_id, raise_error=False)
+        if node is not None:
+            results.append(NodeWithScore(node=node, score=score))
+    return results
+
+
+# 文献IDによるベクトル検索の事前フィルタ
+def record_filters(record_ids):
+    if record_ids is None:
+        return None
+    return MetadataFilters(filters=[
+        MetadataFilter(key="record_id", value=[int(i) for i in record_ids], operator=FilterOperator.IN)
+    ])
+
+
+# 検索方式に応じて上位のチャンクを取得（キーワード検索はAPIを呼び出さない）
+# query_embedding: 計算済みの質問の埋め込み（指定時はベクトル検索で再計算しない）
+# record_ids: 検索対象とする文献のID（データベースで絞り込んだ結果。Noneは全文献）
+def retrieve_library(index, prompt, top_k=SIMILARITY_TOP_K, mode=SEARCH_VECTOR, lexical=None, query_embedding=None,
+                     record_ids=None):
+    if record_ids is not None and not record_ids:
+        return []
+    if mode == SEARCH_LEXICAL:
+        return lexical_search(index, lexical, prompt, top_k, record_ids)
+    query = QueryBundle(query_str=prompt, embedding=query_embedding)
+    filters = record_filters(record_ids)
+    if mode == SEARCH_VECTOR or lexical is None:
+        return index.as_retriever(similarity_top_k=top_k, filters=filters).retrieve(query)
+
+    candidates = top_k * HYBRID_CANDIDATE_FACTOR
+    vector_results = index.as_retriever(similarity_top_k=candidates, filters=filters).retrieve(query)
+    lexical_results = lexical_search(index, lexical, prompt, candidates, record_ids)
+    nodes = {result.node.node_id: result.node for result in vector_results + lexical_results}
+    fused = reciprocal_rank_fusion([
+        [result.node.node_id for result in vector_results],
+        [result.node.node_id for result in lexical_results],
+    ])
+    return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in fused[:top_k]]
+
+
+# 質問の埋め込み（埋め込みキャッシュを経由する）
+def embed_query(question):
+    configure_settings()
+    return Settings.embed_model.get_query_embedding(question)
+
+
+# インデックスの版（展開先のディレクトリ名はDrive上のZIPのmd5を含む）
+def index_version(index_dir):
+    return os.path.basename(os.path.normpath(index_dir))
+
+
+# 検索結果のチャンクから回答生成用のプロンプトを作成（番号で出典を示させる）
+def synthesis_prompt(question, nodes):
+    passages = []
+    for i, result in enumerate(nodes, start=1):
+        metadata = result.node.metadata
+        title = metadata.get("タイトル") or metadata.get("file_name", "")
+        page = metadata.get("page_label", "")
+        text = result.node.get_content(metadata_mode=MetadataMode.NONE)[:SYNTHESIS_CHUNK_CHARS]
+        passages.append(f"[{i}] {title} p.{page}\n{text}")
+    return (
+        "以下は文献から検索した抜粋です。抜粋の内容のみに基づいて質問に日本語で回答し、"
+        "根拠とした抜粋を [番号] で示してください。抜粋に答えが無い場合はそのように答えてください。\n\n"
+        + "\n\n".join(passages)
+        + f"\n\n質問: {question}"
+    )
+
+
+# 検索結果に基づく回答を1回のLLM呼び出しで生成し、テキストを逐次返す
+def stream_answer(question, nodes):
+    configure_settings()
+    for response in Settings.llm.stream_complete(synthesis_prompt(question, nodes)):
+        if response.delta:
+            yield response.delta
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# リポジトリ直下のモジュールと、ベンチマークの合成データ・疑似Driveを読み込めるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
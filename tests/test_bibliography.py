@@ -0,0 +1,78 @@
+import json
+
+import database
+from bibliography import normalize_doi, parse_bibliography, parse_bibtex, parse_csl_json, parse_ris
+
+
+def test_bibtex_nested_braces_and_quotes():
+    text = r"""
+    @string{jcp = "J. Chem. Phys."}
+    @article{key1,
+      title = {The {RNA} World and {M{\"o}ssbauer} "Spectra"},
+      author = "Doe, John and {Acme and Partners} and Jane {van} Smith",
+      journal = jcp # { Letters},
+      pages = {10--19},
+      year = 2020,
+      doi = {https://doi.org/10.1000/ABC.123}
+    }
+    """
+    [record] = parse_bibtex(text)
+    assert record["タイトル"] == 'The RNA World and Mössbauer "Spectra"'
+    assert record["著者"] == "Doe John, Acme and Partners, Smith Jane van"
+    assert record["ジャーナル"] == "J. Chem. Phys. Letters"
+    assert (record["開始ページ"], record["終了ページ"]) == ("10", "19")
+    assert record["年"] == 2020
+    assert record["doi"] == "10.1000/ABC.123"
+    assert record["Read"] is False
+
+
+def test_ris_multiline_fields():
+    text = "\n".join([
+        "TY  - JOUR",
+        "TI  - A long title",
+        "      continued on the next line",
+        "AU  - Doe, John",
+        "AU  - Roe, Jane",
+        "JO  - Journal of Tests",
+        "PY  - 2019/05/01",
+        "SP  - 5",
+        "EP  - 9",
+        "KW  - alpha",
+        "KW  - beta; gamma",
+        "DO  - 10.1000/xyz",
+        "ER  - ",
+        "",
+    ])
+    [record] = parse_ris(text)
+    assert record["タイトル"] == "A long title continued on the next line"
+    assert record["著者"] == "Doe John, Roe Jane"
+    assert record["年"] == 2019
+    assert (record["開始ページ"], record["終了ページ"]) == ("5", "9")
+    assert record["キーワード"] == "alpha,beta,gamma"
+
+
+def test_csl_issued_date_parts():
+    items = [
+        {"title": "With parts", "DOI": "10.1000/a", "issued": {"date-parts": [[2018, 3, 2]]},
+         "author": [{"family": "Doe", "given": "John"}, {"literal": "Acme Consortium"}]},
+        {"title": "With raw date", "DOI": "10.1000/b", "issued": {"raw": "2015-07"}},
+    ]
+    first, second = parse_csl_json(json.dumps(items))
+    assert first["年"] == 2018
+    assert first["著者"] == "Doe John, Acme Consortium"
+    assert second["年"] == 2015
+    assert parse_bibliography(json.dumps(items))[0]["タイトル"] == "With parts"
+
+
+def test_doi_duplicates_are_case_insensitive(tmp_path):
+    db_file = str(tmp_path / "library.db")
+    database.init_db(db_file)
+    try:
+        assert normalize_doi("doi: 10.1000/MixedCase.") == "10.1000/MixedCase"
+        row_ids = database.insert_records(db_file, parse_bibtex("@article{a, title={A}, doi={10.1000/MixedCase}}"))
+        assert database.find_existing_dois(db_file, ["10.1000/mixedcase", "10.1000/other"]) == {"10.1000/mixedcase"}
+        # 大文字小文字だけが異なるDOIは追加されず、登録済みの文献を返す
+        assert database.insert_records(db_file, [{"doi": "10.1000/MIXEDCASE", "タイトル": "B"}]) == row_ids
+        assert database.find_record_ids(db_file, read=False) == row_ids
+    finally:
+        database.dispose_engine(db_file)
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+import database
+import db_sync
+from sync_benchmark import FakeDrive, create_library, snapshot_rows
+
+
+@pytest.fixture
+def devices(tmp_path):
+    paths = []
+
+    def device(name):
+        db_file = str(tmp_path / name / "literature_database.db")
+        os.makedirs(os.path.dirname(db_file))
+        paths.append(db_file)
+        return db_file
+
+    yield device
+    for db_file in paths:
+        database.dispose_engine(db_file)
+
+
+def journal_titles(drive):
+    return sorted(entry["title"] for entry in drive.files.values() if entry["title"].endswith(db_sync.JOURNAL_SUFFIX))
+
+
+def test_journals_round_trip_to_new_device(devices):
+    db_file = devices("device1")
+    create_library(db_file, 30, 2)
+    drive = FakeDrive()
+    sync = db_sync.DBSync(db_file, drive)
+    sync.sync()
+    snapshot_bytes = drive.uploaded_bytes
+
+    database.update_record(db_file, 3, {"要約": "更新した要約", "Read": True})
+    sync.flush()
+    database.insert_records(db_file, [{"doi": "10.1000/new", "タイトル": "New"}])
+    sync.flush()
+    database.apply_row_changes(db_file, deleted=[7])
+    sync.flush()
+
+    # 編集ごとにジャーナルだけを送り、スナップショットは送り直さない
+    assert len(journal_titles(drive)) == 3
+    assert drive.uploaded_bytes - snapshot_bytes < snapshot_bytes / 10
+
+    other_file = devices("device2")
+    result = db_sync.DBSync(other_file, drive).pull()
+    assert result == {"downloaded": True, "journals": 3}
+    assert snapshot_rows(other_file) == snapshot_rows(db_file)
+
+
+def test_journals_from_two_devices_are_replayed_in_order(devices):
+    first_file = devices("device1")
+    create_library(first_file, 20, 1)
+    drive = FakeDrive()
+    first = db_sync.DBSync(first_file, drive)
+    first.sync()
+
+    second_file = devices("device2")
+    second = db_sync.DBSync(second_file, drive)
+    second.pull()
+
+    database.update_record(second_file, 2, {"メモ": "second"})
+    second.flush()
+    # 先に他の環境のジャーナルを反映してから、次の番号で送る
+    database.update_record(first_file, 5, {"メモ": "first"})
+    first.flush()
+    assert [db_sync.journal_number(first_file, database.get_sync_state(first_file)["snapshot"], title)
+            for title in journal_titles(drive)] == [1, 2]
+
+    second.pull()
+    third_file = devices("device3")
+    db_sync.DBSync(third_file, drive).pull()
+    assert snapshot_rows(first_file) == snapshot_rows(second_file) == snapshot_rows(third_file)
+
+
+def test_compaction_replaces_snapshot_and_removes_journals(devices, monkeypatch):
+    monkeypatch.setattr(db_sync, "COMPACT_JOURNALS", 3)
+    db_file = devices("device1")
+    create_library(db_file, 20, 1)
+    drive = FakeDrive()
+    sync = db_sync.DBSync(db_file, drive)
+    sync.sync()
+    first_snapshot = database.get_sync_state(db_file)["snapshot"]
+
+    for i in range(3):
+        database.update_record(db_file, i + 1, {"要約": f"要約 {i}"})
+        sync.flush()
+
+    state = database.get_sync_state(db_file)
+    assert state["snapshot"] != first_snapshot
+    assert int(state["journal"]) == 0
+    assert journal_titles(drive) == []
+    assert not database.has_pending_changes(db_file)
+
+    other_file = devices("device2")
+    assert db_sync.DBSync(other_file, drive).pull() == {"downloaded": True, "journals": 0}
+    assert snapshot_rows(other_file) == snapshot_rows(db_file)
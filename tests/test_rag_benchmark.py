@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import rag
+import rag_benchmark
+
+# 小さな合成文献で、検索方式ごとの recall@k と MRR が下限を下回らないことを確認する（APIは呼び出さない）
+# 下限は、この設定での計測値（vector 0.600/0.419, lexical 0.800/0.800, hybrid 0.725/0.549）から余裕を持たせた値
+THRESHOLDS = {
+    rag.SEARCH_VECTOR: (0.5, 0.3),
+    rag.SEARCH_LEXICAL: (0.7, 0.6),
+    rag.SEARCH_HYBRID: (0.6, 0.4),
+}
+
+
+@pytest.fixture(scope="module")
+def library(tmp_path_factory):
+    rag_benchmark.use_fake_models()
+    corpus, questions = rag_benchmark.synthetic_corpus(40, 4, 20, 0.2, np.random.default_rng(0))
+    persist_dir = str(tmp_path_factory.mktemp("library_index"))
+    rag.persist_library_index(rag_benchmark.build_index(corpus), persist_dir)
+    index = rag.load_index_dir(persist_dir)
+    return index, rag.load_lexical_index(persist_dir, index), questions
+
+
+@pytest.mark.parametrize("mode", list(THRESHOLDS))
+def test_recall_and_mrr(library, mode):
+    index, lexical, questions = library
+    recall, mrr, _ = rag_benchmark.evaluate(index, lexical, questions, mode, rag.SIMILARITY_TOP_K)
+    min_recall, min_mrr = THRESHOLDS[mode]
+    assert recall >= min_recall
+    assert mrr >= min_mrr